@@ -0,0 +1,223 @@
+# Benchmark: feeds a chat transcript through the bot's message handler, using the stand-in chat client in fakechat.py,
+# and reports how quickly the messages were handled.
+#
+#   python bench.py [--games N] [--clues N] [--seed N] [--save FILE]   (a synthetic transcript)
+#   python bench.py --transcript FILE                                  (a recorded one)
+#   python bench.py --replay LOG                                       (plays a game's event log back; see eventlog.py)
+#
+# A transcript has one message per line: the user's id, the user's name and the message content (as chat sends it,
+# i.e. HTML), separated by tabs.  The bot's files (Contact.db etc.) are created in a temporary directory.
+from __future__ import print_function
+import argparse
+import codecs
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO)
+
+import fakechat
+import helpers
+
+BENCH_ROOM = 1
+WORDS = ["APPLE", "BANANA", "CHERRY", "DAMSON", "ELDERBERRY", "FIG", "GRAPE", "HUCKLEBERRY", "KIWI", "LEMON", "MANGO",
+         "ORANGE", "PAPAYA", "QUINCE", "RASPBERRY", "SATSUMA", "TANGERINE", "WATERMELON", "ABACUS", "ANCHOR", "APRON", "ARROW"]
+
+# A made-up transcript of `games` games, with about `clues` clues each.  Returns a list of (user id, user name, content).
+def synthetic(games, clues, seed):
+    rnd = random.Random(seed)
+    players = [(100 + i, "player%s" % (i)) for i in range(12)]
+    lines = []
+    for g in range(games):
+        defender = players[g % len(players)]
+        attackers = [p for p in players if p != defender]
+        word = rnd.choice(WORDS)
+        letters = 1
+        lines.append(defender + ("%s defending: <b>%s</b>" % (defender[1], word[:letters]),))
+        active = {} # Clue number -> (setter, contacters)
+        number = 0
+        for i in range(clues):
+            # Someone sets a clue, and a few people contact it.
+            number += 1
+            setter = rnd.choice(attackers)
+            answer = word[:letters] + rnd.choice(WORDS)
+            lines.append(setter + ("%s: <b>something like %s, but not quite</b>" % (number, answer.lower()),))
+            contacters = rnd.sample([p for p in attackers if p != setter], rnd.randint(0, 3))
+            for contacter in contacters:
+                lines.append(contacter + ("c%s" % (number),))
+            if contacters and rnd.random() < 0.1:
+                lines.append(contacters.pop() + ("u%s" % (number),))
+            active[number] = (setter, contacters)
+            if rnd.random() < 0.05:
+                lines.append(rnd.choice(attackers) + ("o/",))
+
+            roll = rnd.random()
+            if roll < 0.4:
+                # The defender has a go at it, and is wrong.
+                lines.append(defender + ("%s %s" % (number, word[:letters] + "XYZ"),))
+                lines.append(setter + ("%s no" % (number),))
+            elif roll < 0.6 and contacters and letters < len(word):
+                # The defender can't get it, so passes.  The contacters guess, and the first one is right.
+                lines.append(defender + ("pass %s" % (number),))
+                for contacter in contacters:
+                    lines.append(contacter + ("%s %s" % (number, answer),))
+                lines.append(setter + ("%s yes" % (number),))
+                del active[number]
+                # A new letter, and everyone says whether their clues still work.
+                letters += 1
+                lines.append(defender + ("%s defending: <b>%s</b>" % (defender[1], word[:letters]),))
+                for n, (s, c) in list(active.items()):
+                    if rnd.random() < 0.5:
+                        lines.append(s + ("%s lives" % (n),))
+                    else:
+                        lines.append(s + ("%s dies" % (n),))
+                        del active[n]
+        lines.append(defender + ("my word was %s" % (word),))
+    return lines
+
+def load_transcript(path):
+    lines = []
+    with codecs.open(path, "r", "utf-8") as f:
+        for line in f:
+            user_id, user_name, content = line.rstrip("\r\n").split("\t", 2)
+            lines.append((int(user_id), user_name, content))
+    return lines
+
+def save_transcript(path, lines):
+    with codecs.open(path, "w", "utf-8") as f:
+        for user_id, user_name, content in lines:
+            f.write(u"%s\t%s\t%s\n" % (user_id, user_name, content))
+
+# The value below which the given fraction of the (sorted) values fall
+def percentile(values, fraction):
+    return values[int(round(fraction * (len(values) - 1)))] if values else 0
+
+# Set the bot up as main() would, but talking to a fakechat client.  Returns the bot module, the client and the room's game.
+def start_bot(user_ids):
+    import bot
+    chat = fakechat.Client()
+    bot.chatexchange = fakechat
+    bot.client = chat
+    bot.my_user = chat.get_me()
+    bot.user_names = bot.users.directory(lambda user_id: chat.get_user(user_id).name)
+    bot.whitelist = set(str(id) for id in user_ids)
+    bot.init_db()
+    bot.contact_db = bot.database.database('Contact.db')
+    bot.reminders = bot.scheduler.scheduler()
+    bot.side_work = bot.workers.pool(bot.SIDE_WORK_THREADS, "side-work")
+    room = chat.get_room(BENCH_ROOM)
+    # Chat's rate limits don't apply to the stand-in.
+    outgoing = bot.outbox.outbox(room, message_rate=1e6, message_burst=1e6, action_rate=1e6, action_burst=1e6)
+    contact_game = bot.games[BENCH_ROOM] = bot.ContactGame(room, outgoing)
+    contact_game.start()
+    room.watch(bot.on_message)
+    return bot, chat, contact_game
+
+def run(lines):
+    bot, chat, contact_game = start_bot(set(user_id for user_id, user_name, content in lines))
+    latencies = []
+    console, sys.stdout = sys.stdout, open(os.devnull, "w") # The bot's debugging output would only slow it down
+    try:
+        started = timeit.default_timer()
+        for user_id, user_name, content in lines:
+            user = chat.get_user(user_id, user_name)
+            before = timeit.default_timer()
+            chat.post(contact_game.room, user, content)
+            latencies.append(timeit.default_timer() - before)
+        contact_game.worker.flush()
+        handled = timeit.default_timer() - started
+    finally:
+        sys.stdout.close()
+        sys.stdout = console
+
+    # Let the background threads finish their work, so that the counts are complete.
+    bot.side_work.close()
+    contact_game.worker.close()
+    contact_game.outgoing.flush()
+    contact_game.snapshots.close()
+    contact_game.events.close()
+    bot.contact_db.close()
+    elapsed = timeit.default_timer() - started
+
+    latencies.sort()
+    kinds = {}
+    for kind, value in chat.sent:
+        kinds[kind] = kinds.get(kind, 0) + 1
+    print("Messages handled:     %s in %.2fs (%.0f messages/sec)" % (len(lines), handled, len(lines) / handled if handled else 0))
+    print("Delivery latency:     p50 %.3fms, p99 %.3fms, max %.3fms" % (percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, latencies[-1] * 1000 if latencies else 0))
+    print("Handling latency:     p50 %.3fms, p99 %.3fms" % tuple(p * 1000 for p in bot.perf.stages.histograms["on_message"].percentiles(0.5, 0.99)))
+    print("Including background: %.2fs" % (elapsed))
+    print("SQLite writes:        %s in %s commits" % (bot.contact_db.writes, bot.contact_db.commits))
+    print("Chat posts:           %s (%s messages combined into earlier posts)" % (contact_game.outgoing.sent, contact_game.outgoing.combined))
+    print("Chat requests:        %s" % (", ".join("%s %s" % (count, kind) for kind, count in sorted(kinds.items()))))
+    print("Events logged:        %s;  snapshots saved: %s" % (contact_game.events.written, contact_game.snapshots.saves))
+    print("")
+    for line in bot.perf.stages.report():
+        print(line)
+
+# The name of a value of one of game.py's enums
+def state_name(enum, value):
+    for name, v in vars(enum).items():
+        if v == value and not name.startswith("_"):
+            return name
+    return value
+
+# Play an event log back, and report how quickly it was replayed and the state the game ended up in.
+def replay(path):
+    import eventlog
+    from game import Clue_state, Game_state
+    started = timeit.default_timer()
+    events = list(eventlog.read(path))
+    read = timeit.default_timer() - started
+    state = eventlog.replay(events)
+    replayed = timeit.default_timer() - started - read
+    print("Events read:          %s in %.2fs" % (len(events), read))
+    print("Events replayed:      %s in %.2fs (%.0f events/sec); %s skipped" % (state.events, replayed, state.events / replayed if replayed else 0, state.skipped))
+    print("")
+    print("Game #%s: %s, defended by %s (%s), at %s" % (state.game_id, state_name(Game_state, state.game_state), state.defender_name, state.defender_id, state.defending_text or "-"))
+    print("%s active clues, %s dead" % (len(state.clues), len(state.dead_clues)))
+    for c in sorted(state.clues.itervalues(), key=lambda c: c.timestamp):
+        line = "  %s: %s (by %s) %s" % (c.number, c.clue_text, c.setter_name, state_name(Clue_state, c.state))
+        if c.contacts:
+            line += ", contacted by %s" % (", ".join(c.contacts.values()))
+        if c.guess:
+            line += ", guessed %s by %s" % (c.guess, c.guesser_name)
+        print(line.encode("utf-8") if isinstance(line, unicode) else line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Feed a chat transcript through the bot, and report how quickly it was handled.")
+    parser.add_argument("--transcript", help="a recorded transcript to use, instead of a synthetic one")
+    parser.add_argument("--games", type=int, default=20, help="number of games in the synthetic transcript")
+    parser.add_argument("--clues", type=int, default=100, help="number of clues per game in the synthetic transcript")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the synthetic transcript")
+    parser.add_argument("--save", help="also save the synthetic transcript to this file")
+    parser.add_argument("--replay", metavar="LOG", help="play a game's event log back instead, and show the state it ends in")
+    args = parser.parse_args()
+
+    if args.replay:
+        replay(args.replay)
+        return
+
+    if args.transcript:
+        lines = load_transcript(args.transcript)
+    else:
+        lines = synthetic(args.games, args.clues, args.seed)
+        if args.save:
+            save_transcript(args.save, lines)
+
+    workdir = tempfile.mkdtemp(prefix="contact-bench-")
+    helpers.configure_logging(path=os.path.join(workdir, "errorLogs.txt")) # The log, too, goes with the rest of the bot's files
+    os.chdir(workdir)
+    try:
+        run(lines)
+    finally:
+        helpers.flush_log()
+        os.chdir(REPO)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -10,55 +10,36 @@ import StringIO
 import urllib2, urllib
 import json
 import random
+import collections
 import traceback
 import HTMLParser
-unescape = HTMLParser.HTMLParser().unescape
 
 import re
 import os
+import signal
 import time
+import calendar
+import _strptime # datetime.strptime imports this on first use, which can fail if two threads get there at once
 import sqlite3
+import threading
 
 import requests
 from requests.auth import HTTPBasicAuth
-from helpers import log, log_exception
-
-# Define an enum structure that we can use to define our own enums
-def enum(*sequential, **named):
-    enums = dict(zip(sequential, range(len(sequential))), **named)
-    return type('Enum', (), enums)
-    
-# Holds all info related to a single clue
-class clue:
-    def __init__(self):
-        self.number = -1  # The clue number as chosen by the setter
-        self.message = None # A reference to the chat message containing the clue
-        self.setter_id = -1 # The SE chat ID of the setter of the clue
-        self.setter_name = "" # The SE chat name of the setter of the clue
-        self.clue_text = "" # The actual text of the clue (bare text)
-        self.guess = "" # The guess (if any) currently awaiting confimation
-        self.guesser_name = "" # The username of the user who made the guess
-        self.contacts = {} # A dictionary of players who have contacted this clue (id:timestamp)
-        self.set_state(Clue_state.None) # The state of the clue starts out as None. 
-        self.timestamp = None # The time the clue was set (UTC)
-        self.warned = False # Indicates whether the bot has already prompted the user to declare this clue alive/dead after a letter has been given up.
-    
-    # Sets the state to one of the values in enum Clue_state
-    def set_state(self, state): 
-        self.state = state 
-        self.state_timestamp = datetime.utcnow() # The UTC time that the clue entered this state
-        self.warned = False # If the clue changes state, it's eligible for another warning.
-        if TESTING: print("Clue #%s: state changed to %s" % (self.number, state))
-
-    def set_guess(self, guess, user_name):
-        self.guess = guess.upper()
-        self.guesser_name = user_name
-        self.guess_timestamp = datetime.utcnow() # The UTC time that the guess was made
-        self.guess_warned = False
-        
-# Enums to keep track of the clue state and the game state.
-Clue_state = enum("None", "Set", "Passed", "Schroedinger", "Solved", "Dead") # Schroedinger means a pass happened, and the clue hasn't been declared alive or dead.
-Game_state = enum("None", "Guessing", "Passed", "WaitingForLetter", "Finished")
+from helpers import log, log_exception, configure_logging, LOG_LEVELS
+import dispatch
+import database
+import scheduler
+import outbox
+import snapshot
+import eventlog
+import perf
+import workers
+import users
+import words
+import commands
+from commands import Access
+import game
+from game import clue, Clue_state, Game_state
 
 #Configurable values
 TESTING = False  # Enables verbose debug output to console, and disables user checking for various clue/guess/contact events.  Also changes the chat room used. Should be turned off for production.
@@ -70,39 +51,36 @@ MAX_CLUES = 10 # If this many clues are active, the bot will suggest not posting
 DEFAULT_MUTE_LENGTH = 600 # The number of seconds the bot will stay silent when muted, if a time isn't explicitly provided.
 CONTACT_THRESHOLD = 5 # The minimum number of contacts required before the bot suggests that the defender pass (only if clues are above MAX_CLUES)
 MESSAGE_DUPE_DELAY = 10 # The time period within which the bot cannot post two identical messages.
+DEAD_CLUE_LIMIT = 100 # The number of dead/solved clues to remember.
+TIMER_SLACK = 1 # Reminders that fall due within this many seconds of each other are sent together.
+SIDE_WORK_THREADS = 4 # The number of threads for work that doesn't change the game state (user name lookups, statistics...)
+ROOMS = os.environ.get('ContactRooms', '80561' if TESTING else '53490') # The chat rooms to play in (comma-separated IDs).  80561 is my sandbox, 53490 is Contact.
+SNAPSHOT_FILE = os.environ.get('ContactSnapshots', 'GameState-%s.json') # Where each room's game state is saved (by room ID), so that it can be restored if the bot is restarted.
+HEARTBEAT_FILE = os.environ.get('ContactHeartbeat') # Where the bot notes every few seconds that it's still working, for nocrash.py (which sets it).
+EVENT_LOG_FILE = 'GameEvents-%s.log' # Where every change to each room's game state is recorded (by room ID; see eventlog.py).
+USERS_FILE = 'Users.json' # Where the names of the chat users the bot knows of are saved (see users.py).
+USER_NAME_TTL = 7 * 24 * 3600 # The number of seconds a user's name is trusted for, before it's looked up again.
+WORDS_FILE = os.environ.get('ContactWords') # A dictionary to check the defender's letters and guesses against (built with words.py), if any.
+LOG_LEVEL = os.environ.get('ContactLogLevel') # The least important messages to log: debug, info, warning or error (all of them, if not set).
+LOG_CONSOLE = os.environ.get('ContactLogConsole') # Set to 0 to stop log messages being shown on the console (they are still written to the log file).
+LOG_FILE = os.environ.get('ContactLogFile') # Where the log is written (errorLogs.txt, if not set).
+LOG_MAX_BYTES = os.environ.get('ContactLogMaxBytes') # How big the log file gets before it's rotated (1 MiB, if not set).
+LOG_BACKUPS = os.environ.get('ContactLogBackups') # The number of rotated log files kept (3, if not set).
+PERF_FILE = 'perf.json' # Where !perf dump writes the timing statistics.
+SNAPSHOT_INTERVAL = 60 # The maximum number of seconds between snapshots of the game state (they are also saved whenever it changes).
 
 client = None # The ChatExchange client reference
-room = None # The ChatExchange room reference
+contact_db = None # The game database (Contact.db).  Writes to it are queued and committed in the background.
+reminders = None # Runs timed reminders and other delayed events (see scheduler.py)
+side_work = None # Runs work that doesn't change the game state, like user name lookups, on a pool of threads (see workers.py)
 my_user = None # This bot's user ID
 shutdown = False # Indicates whether the bot has been shut down
-clues = {} # Holds all the active clues, indexed by clue number
-dead_clues = [] # Holds all dead/solved clues.
 whitelist = set()  # Users who are allowed to command the bot
 pinglist = set() # Users who want to be notified when a new game is starting.
-recent_messages = {} # Keep track of the last few messages sent, so we don't repeat ourselves unnecessarily.
-last_clue_solved = None # The last clue solved is going to be the one that wins the game.  We need that info at game end.
-last_clue_guessed = None # If we don't have a "last clue solved", we'll go with the last one guessed instead.
-pass_with_no_contact = False # If someone passes before a clue is contacted, it means they think someone has it.  We have different rules in that situation.
-
-game_state = Game_state.None
-num_contact_guesses = 0 # How many guesses have been made after a pass (by those who contacted the clue)
-verbose = True # When true, the bot talks more.
-
-# Unique IDs for the database tables
-game_id = -1
-defence_id = -1
-
-# Defender info
-defender_id = -1 # Chat ID
-defender_name = ""
-defending_text = "" # The portion of the word being defended
-defending_message = None # A reference to the message containing the defended text
-defending_timestamp = None # The time the message was posted.
-
-muted_timestamp = None # When the bot was told to !shutup
-mute_length = DEFAULT_MUTE_LENGTH # Seconds until the bot may speak again.
-
-waves = {} # Timestamps of the most recent waves ( o/ ) posted in the room.
+user_names = None # The names of chat users, by user ID (see users.py)
+word_list = None # The dictionary (see words.py), or None if there isn't one.  It's opened when it's first used.
+games = {} # The game in each room the bot is in (a ContactGame), by room ID
+last_event = None # When (time.time()) the last chat event arrived, from any room
 
 # Regular expression match patterns for the various game-related inputs:
 clue_number = "\d+(?:\.\d+)?'*"
@@ -122,10 +100,13 @@ end_pattern = re.compile(r"\s*.*(?:defended|was defending|my word (?:was|is))[\s
 end_pattern_2 = re.compile(r"\s*(?:<[bi]>)?\"?([A-Z]+)\"?(?:</[bi]>)?\s+(?:was|is) my word.*\s*$", re.IGNORECASE)
 end_pattern_3 = re.compile(r"\s*(?:DH|direct hit)[\s:;.,!]*(?:<[bi]>)?([A-Z]+)?(?:</[bi]>)?\s*$", re.IGNORECASE)
 end_pattern_4 = re.compile(ur"\s*(?:<[bi]>)?([A-Z]+)(?:</[bi]>)?[\s:;.,]*(?:\u2713+|\u2714+)\s*$", re.IGNORECASE) # Doesn't seem to work.
+restored_pattern = re.compile(r"\s*(?:<div class='full'>)?\s*Restored clues for game #(\d+)", re.IGNORECASE)
 wave_pattern = re.compile(r"\s*(\\(?:o|O|0)|(?:o|O|0)/|<code>(\\0|0/)</code>)\s*", re.IGNORECASE)
 
 def main():
-    global room, my_user, client, whitelist, pinglist
+    global my_user, client, whitelist, pinglist, contact_db, reminders, side_work, user_names, word_list
+
+    configure_logging_from_environment()
 
     # Check if a whitelist/pinglist` exists in the DB.  If no, initialize it in the DB; if yes, load it from the DB.
     whitelist = init_list(whitelist, "whitelist")
@@ -134,14 +115,15 @@ def main():
     # Initialize the database that stores all game data/statistics
     # If it doesn't exist, create it.
     init_db()
+    contact_db = database.database('Contact.db')
+    reminders = scheduler.scheduler()
+    side_work = workers.pool(SIDE_WORK_THREADS, "side-work")
+    if WORDS_FILE:
+        word_list = words.dictionary(WORDS_FILE)
 
     # Set ChatExchange variables
     host_id = 'stackexchange.com'
-    room_id = -1
-    if TESTING:
-        room_id = '80561'  # My sandbox
-    else:
-        room_id = '53490'  # Contact
+    room_ids = [room_id.strip() for room_id in ROOMS.split(',') if room_id.strip()]
 
     # Get username and password to log in to ChatExchange.
     if 'ChatExchangeU' in os.environ:
@@ -153,1077 +135,1603 @@ def main():
     else:
         password = getpass.getpass("Password: ")
 
-    # Initialize connection and log in
+    # Initialize connection and log in.  One client serves all the rooms; each room has a game of its own.
     client = chatexchange.client.Client(host_id)
     client.login(email, password)
     my_user = client.get_me()
-    room = client.get_room(room_id)
-    room.join()
-    room.watch(on_message)
+    user_names = users.directory(lambda user_id: client.get_user(user_id).name, USERS_FILE, USER_NAME_TTL)
+    for room_id in room_ids:
+        room = client.get_room(room_id)
+        room.join()
+        games[int(room_id)] = ContactGame(room)
 
-    log('info', "(You are now in room #%s on %s.)" % (room_id, host_id))
+    # If we were restarted in the middle of a game, pick up where we left off.
+    for contact_game in games.values():
+        contact_game.start()
+        contact_game.room.watch(on_message)
+
+    log('info', "(You are now in room(s) %s on %s.)" % (", ".join("#%s" % (room_id) for room_id in room_ids), host_id))
 
     # Don't exit until the shutdown variable is set. All the real stuff happens in on_message().
+    signal.signal(signal.SIGTERM, on_terminate)
     while not shutdown:
+        write_heartbeat()
         time.sleep(2)
-
-# Do this each time a message is posted/edited
-def on_message(message, client):
-    global whitelist, pinglist, shutdown
-    is_edit = isinstance(message, chatexchange.events.MessageEdited)
-
-    # If the message containing a clue is deleted, remove the clue from the list of active clues.
-    if isinstance(message, chatexchange.events.MessageDeleted):
+    # Stop handling events first, then save and send whatever they left behind.  The games' queued events go first, then the
+    # side work they started (e.g. !stats queries), which hands its results back to the games, and only then are the games'
+    # workers stopped.  The database goes last, since all the rest may write to it.
+    for contact_game in games.values():
+        contact_game.worker.flush()
+    side_work.close()
+    for contact_game in games.values():
+        contact_game.worker.close()
+    for contact_game in games.values():
+        contact_game.snapshots.close()
+    for contact_game in games.values():
+        contact_game.outgoing.close()
+        contact_game.events.close()
+    user_names.save()
+    user_names.close()
+    if word_list is not None:
+        word_list.close()
+    contact_db.close()
+    client.logout()
+
+# Apply the Contact* logging settings.  A setting that can't be used is left at its default, with a warning, rather than
+# stopping the bot from starting.
+def configure_logging_from_environment():
+    problems = []
+    level = LOG_LEVEL.strip().lower() if LOG_LEVEL else None
+    if level is not None and level not in LOG_LEVELS:
+        problems.append("ContactLogLevel=%r isn't one of %s" % (LOG_LEVEL, ", ".join(sorted(LOG_LEVELS, key=LOG_LEVELS.get))))
+        level = None
+    def whole_number(name, value, minimum):
+        if not value:
+            return None
         try:
-            deleted_clue = None
-            for c in clues.itervalues():
-                if c.message == message.message:
-                    deleted_clue = c
-            if deleted_clue is not None:
-                remove_clue(deleted_clue, Clue_state.Dead)
-        except:
-            log_exception(*sys.exc_info())
-    
-    if isinstance(message, chatexchange.events.MessagePosted) or is_edit:
+            number = int(value)
+        except ValueError:
+            number = None
+        if number is None or number < minimum:
+            problems.append("%s=%r isn't a whole number of at least %s" % (name, value, minimum))
+            return None
+        return number
+    configure_logging(level=level, console=LOG_CONSOLE != '0' if LOG_CONSOLE is not None else None, path=LOG_FILE,
+                      max_bytes=whole_number('ContactLogMaxBytes', LOG_MAX_BYTES, 1), backups=whole_number('ContactLogBackups', LOG_BACKUPS, 0))
+    for problem in problems:
+        log('warning', "%s; using the default instead" % (problem))
+
+# nocrash.py asks the bot to stop (e.g. when it seems to be stuck) with SIGTERM.  Stop as if told to !shutdown, so
+# that the games are saved.
+def on_terminate(signum, frame):
+    global shutdown
+    shutdown = True
+
+# Let nocrash.py know we're alive, and whether we're still hearing from chat and getting through our work.
+def write_heartbeat():
+    if HEARTBEAT_FILE is None:
+        return
+    now = time.time()
+    busy = [now - contact_game.worker.busy_since for contact_game in games.values() if contact_game.worker.busy_since is not None]
+    try:
+        snapshot.save(HEARTBEAT_FILE, {
+            "time": now, "pid": os.getpid(), "last_event": last_event,
+            "busy": max(busy) if busy else 0, # The longest any game's worker has been stuck on the same call
+            "queued": sum(contact_game.worker.pending() for contact_game in games.values()),
+        })
+    except Exception:
+        log_exception(*sys.exc_info())
+
+# Everything the input handlers need to know about the message currently being processed.
+class message_context(object):
+    def __init__(self, game, message, input, is_edit):
+        self.game = game # The ContactGame for the room the message was posted in
+        self.message = message
+        self.input = input # The message content, with HTML encodings removed
+        self.is_edit = is_edit
 
         # Access levels for different commands
-        is_bot = (message.user.id == my_user.id)
-        is_super_user = (is_bot or message.user.is_moderator)
-        is_trusted_user = (is_super_user or message.user in room.owners or str(message.user.id) in whitelist)
+        self.is_bot = (message.user.id == my_user.id)
+        self.is_super_user = (self.is_bot or message.user.is_moderator)
+        self.is_trusted_user = (self.is_super_user or message.user in game.room.owners or str(message.user.id) in whitelist)
+        self.access = Access.Super if self.is_super_user else Access.Trusted if self.is_trusted_user else Access.Anyone
 
-        try:
-            # Remove all weird HTML encodings (like &amp; for &)
-            input = unescape(message.content)
-            
-            # This will fail if there are any unicode characters in the input. Mostly a problem with check mark.
-            # Not a concern when TESTING is False.
-            # print(">> (%s / %s) %s" % (message.user.name, repr(message.user.id), input))
-
-            # Match the input using all the patterns defined above, to determine what type of input it is
-            clue_match = re.match(clue_pattern, input)
-            defender_match = re.match(defender_pattern, input)
-            yes_match = re.match(yes_pattern, input)
-            guess_match = re.match(guess_pattern, input)
-            no_match = re.match(no_pattern, input)
-            contact_match = re.match(contact_pattern, input)
-            uncontact_match = re.match(uncontact_pattern, input)
-            pass_match = re.match(pass_pattern, input)
-            dies_match = re.match(dies_pattern, input)
-            lives_match = re.match(lives_pattern, input)
-            end_match = re.match(end_pattern, input)
-            end_match_2 = re.match(end_pattern_2, input)
-            end_match_3 = re.match(end_pattern_3, input)
-            end_match_4 = re.match(end_pattern_4, input)
-            
-            ### NOTE: ###
-            # The order of the if/elif statements below is important.  Some input matches more than one pattern, so it's important that we match certain ones before others.
-            
-            # Negation of guess
-            if not is_bot and no_match is not None:
-                if TESTING: print("Matched negation for #%s" % (guess_match.groups()[0].strip()))
-                deny_guess(no_match.groups()[0].strip(), no_match.groups()[1].strip(), message.user)
-                    
-            # Confirmation of guess
-            elif not is_bot and yes_match is not None:
-                if TESTING: print("Matched affirmation for #%s" % (yes_match.groups()[0].strip()))
-                confirm_guess(yes_match.groups()[0].strip(), yes_match.groups()[1].strip(), message.user)
-                    
-            # Confirmation that clue dies
-            elif not is_bot and dies_match is not None:
-                if TESTING: print("Matched death for %s" % (dies_match.groups()[0].strip()))
-                kill_clue(dies_match.groups()[0].strip(), dies_match.groups()[1].strip(), message.user, True)
-            
-            # Confirmation that clue lives
-            elif not is_bot and lives_match is not None:
-                if TESTING: print("Matched life for %s" % (lives_match.groups()[0].strip()))
-                confirm_life(lives_match.groups()[0].strip(), lives_match.groups()[1].strip(), message.user)
-            
-            # Clue
-            elif clue_match is not None:
-                numbers = [number.strip() for number in clue_match.groups()[0].split(',')]
-                for number in numbers:
-                    if TESTING: print("Matched clue %s: %s" % (number, clue_match.groups()[1]))
-                    add_clue(message, number, clue_match.groups()[1].strip(), is_edit)
-                
-            # Game over
-            elif message.user.id == defender_id and end_match is not None:
-                if TESTING: print("Matched end of game (1)")
-                end_game(end_match.groups()[0].strip())
-            elif message.user.id == defender_id and end_match_2 is not None:
-                if TESTING: print("Matched end of game (2)")
-                end_game(end_match_2.groups()[0].strip())
-            elif message.user.id == defender_id and end_match_3 is not None:
-                if TESTING: print("Matched end of game (3)")
-                word = last_clue_solved.guess if last_clue_solved is not None else last_clue_guessed.guess
-                end_game(word)
-            elif message.user.id == defender_id and end_match_4 is not None:
-                if TESTING: print("Matched end of game (4)")
-                end_game(end_match_4.groups()[0].strip())
-                    
-            # "Defending" message
-            elif defender_match is not None:
-                if TESTING: print("Matched defender: %s, defending %s" % (message.user.name, defender_match.groups()[0].strip()))
-                repin_defender(message, defender_match.groups()[0].strip())
-                
-            # Guess
-            elif not is_bot and guess_match is not None:
-                if TESTING: print("Matched guess %s for #%s" % (guess_match.groups()[1].strip(), guess_match.groups()[0].strip()))
-                add_guess(guess_match.groups()[0].strip(), guess_match.groups()[1].strip(), message.user)
-                    
-            # Contact
-            elif not is_bot and contact_match is not None:
-                if TESTING: print("Matched contact for #%s" % (contact_match.groups()[0].strip()))
-                add_contact(message, [number.strip() for number in contact_match.groups()[0].strip().split(',')])
-                    
-            # Uncontact
-            elif not is_bot and uncontact_match is not None:
-                if TESTING: print("Matched uncontact for #%s" % (uncontact_match.groups()[0].strip()))
-                remove_contact(message, [number.strip() for number in uncontact_match.groups()[0].strip().split(',')])
-                
-            # Pass
-            elif not is_bot and pass_match is not None:
-                if TESTING: print("Matched pass for #%s" % (pass_match.groups()[0].strip()))
-                pass_clue(message, pass_match.groups()[0].strip())
-                
-            ### Bot commands ###
-            
-            # Reset (unstar/unpin) all current game messages, and reset game variables
-            elif is_trusted_user and input.lower().strip() == "!reset":
-                if TESTING: print("Matched !reset command")
-                reset()
-                
-            # List active clues, including authors, contacts, and Schroedinger status
-            elif is_trusted_user and input.lower().strip() =="!clues":
-                if TESTING: print("Matched !clues command")
-                display_clues(False)
-                
-            # List any active unstarred clues
-            elif is_trusted_user and input.lower().strip() =="!unstarred":
-                if TESTING: print("Matched !unstarred command")
-                display_clues(True)
-                
-            # List all contacted clues with who contacted them, or those who contacted a specific clue
-            elif is_trusted_user and input.lower().startswith("!contacts"):
-                if TESTING: print("Matched !contacts command")
-                display_contacts(input.lower())
-                
-            # Silence the bot for a given length of time
-            elif is_trusted_user and input.lower().startswith("!shutup"):
-                if TESTING: print("Matched !shutup command")
-                mute(input)
-                
-            # Waken a bot that has been silenced
-            elif is_trusted_user and input.lower().strip() == "!speak":
-                if TESTING: print("Matched !speak command")
-                unmute()
-                
-            # Enable/disable more game messages from the bot, mostly when things go wrong
-            elif is_trusted_user and input.lower().startswith("!verbose"):
-                if TESTING: print("Matched !verbose command")
-                toggle_verbosity(input[9:])
-
-            # Resume a game that was interrupted, or where the bot went down partway through.
-            elif is_trusted_user and input.lower().startswith("!resume"):
-                if TESTING: print("Matched !resume command")
-                load_game(input[8:])
-
-            # If the bot recognized a pass in error, reverse the pass.
-            elif is_trusted_user and input.lower().strip() == "!unpass":
-                reverse_pass()
-            
-            # Remove a clue that was added in error.  Similar to "<clue> dies", but will work for clues you don't own.
-            elif is_trusted_user and input.lower().startswith("!kill"):
-                kill_clue(input[6:], "", message.user, True)
-                
-            # Remove a contact that was added in error.  Similar to "uncontact <clue>", but can remove someone else's contact.
-            elif is_trusted_user and input.lower().startswith("!uncontact"):
-                tokens = input.split(" ")
-                if len(tokens) != 2: send_message("Syntax: **`!uncontact <clueNum>`**")
-                remove_contact(message, [tokens[1]], True) # remove all contacts for this clue
-            
-            # Tell the bot that the game is over
-            elif is_trusted_user and input.lower().strip() == "!gameover":
-                end_game()
-            
-            # Notify everyone in the pinglist of a game/potential game
-            elif is_super_user and input.lower().strip() == "!ping":
-                if TESTING: print("Matched !ping command")
-                ping()
-                
-            # Add/remove or list users on the whitelist
-            elif is_super_user and input.lower().startswith("!whitelist"):
-                if TESTING: print("Matched !whitelist command")
-                modify_list(whitelist, input[11:], "whitelist")
-
-            # Add/remove or list users on the pinglist
-            elif is_trusted_user and input.lower().startswith("!pinglist"):
-                if TESTING: print("Matched !pinglist command")
-                modify_list(pinglist, input[10:], "pinglist")
-    
-            # Output a list of commands, and a brief introduction to the bot
-            elif input.lower().strip() == "!help":
-                if TESTING: print("Matched !help command")
-                info()
-                
-            # Output game statistics
-            elif is_trusted_user and input.lower().startswith("!stats"):
-                if TESTING: print("Matched !stats command")
-                game_stats(input[7:])
-                
-            # Shut down the bot remotely
-            elif is_super_user and input.lower().strip() == "!shutdown":
-                print("Matched !shutdown command")
-                shutdown = True
-                client.logout()
-                sys.exit()
-                
-            # Count the number of people waving in the room.  If enough, ping others to join.
-            elif re.match(wave_pattern, input) is not None:
-                if TESTING: print("Matched wave")
-                waves[message.user.id] = datetime.utcnow()
-                
-            # Check for invalid command/insufficient permissions.
-            elif input[0] == "!" :
-                if not is_trusted_user:
-                    send_message("I'm sorry, I've been told not to listen to you. Try asking a mod to add you to the whitelist.")
-                else:
-                    send_message("I don't recognize that command, or you don't have sufficient permission.  Type `!help` for a list of valid commands.")
-
-            ### Check various statuses ###
-            
-            # If clues haven't been confirmed as alive/dead after a certain time has elapsed since the last new letter, let the clue setter know.
-            if verbose: check_clue_status()
-            
-            # If someone hasn't confirmed/denied a guess after a certain time has elapsed, let them know.
-            if verbose: check_guess_status()
-            
-            # Check if a sufficient number of people have waved in the last while, to warrant pinging other users.
-            check_waves()
+# Do this each time a message is posted/edited, in any of the rooms.  It's queued for that room's game, whose worker
+# handles the room's messages in order; chat's event thread goes straight back to listening.
+def on_message(message, client):
+    global last_event
+    last_event = time.time()
+    contact_game = games.get(int(message.room.id))
+    if contact_game is None:
+        return
+    user_names.note(message.user.id, message.user.name)
+    perf.stages.count("event queue depth", contact_game.worker.pending())
+    contact_game.worker.submit(contact_game.on_event, message)
+
+### Input rules ###
+
+# Each rule below is tried in the order it is declared, and only the first match is handled.
+# The order is important: some input matches more than one pattern, so it's important that we match certain ones before others.
+# Rules only run their pattern if the input could possibly match it (based on its first character, or words it must contain).
+input_rules = dispatch.dispatcher(perf.stages)
+
+def not_bot(context):
+    return not context.is_bot
+
+def from_bot(context):
+    return context.is_bot
+
+def from_defender(context):
+    return context.message.user.id == context.game.defender_id
+
+# The list of clues the bot posts when resuming a game
+@input_rules.on(restored_pattern, contains=("restored clues",), guard=from_bot)
+def on_restored_clues(context, match):
+    if TESTING: print("Matched restored clues for game #%s" % (match.groups()[0]))
+    context.game.attach_restored_clues(context.message)
+
+# Negation of guess
+@input_rules.on(no_pattern, starts=dispatch.DIGITS, guard=not_bot)
+def on_negation(context, match):
+    if TESTING: print("Matched negation for #%s" % (match.groups()[0].strip()))
+    context.game.deny_guess(match.groups()[0].strip(), match.groups()[1].strip(), context.message.user)
+
+# Confirmation of guess
+@input_rules.on(yes_pattern, starts=dispatch.DIGITS, guard=not_bot)
+def on_affirmation(context, match):
+    if TESTING: print("Matched affirmation for #%s" % (match.groups()[0].strip()))
+    context.game.confirm_guess(match.groups()[0].strip(), match.groups()[1].strip(), context.message.user)
+
+# Confirmation that clue dies
+@input_rules.on(dies_pattern, starts=dispatch.DIGITS, guard=not_bot)
+def on_death(context, match):
+    if TESTING: print("Matched death for %s" % (match.groups()[0].strip()))
+    context.game.kill_clue(match.groups()[0].strip(), match.groups()[1].strip(), context.message.user, True)
+
+# Confirmation that clue lives
+@input_rules.on(lives_pattern, starts=dispatch.DIGITS, guard=not_bot)
+def on_life(context, match):
+    if TESTING: print("Matched life for %s" % (match.groups()[0].strip()))
+    context.game.confirm_life(match.groups()[0].strip(), match.groups()[1].strip(), context.message.user)
+
+# Clue
+@input_rules.on(clue_pattern, starts=dispatch.DIGITS)
+def on_clue(context, match):
+    numbers = [number.strip() for number in match.groups()[0].split(',')]
+    for number in numbers:
+        if TESTING: print("Matched clue %s: %s" % (number, match.groups()[1]))
+        context.game.add_clue(context.message, number, match.groups()[1].strip(), context.is_edit)
+
+# Game over
+@input_rules.on(end_pattern, contains=("defended", "was defending", "my word"), guard=from_defender)
+def on_end(context, match):
+    if TESTING: print("Matched end of game (1)")
+    context.game.end_game(match.groups()[0].strip())
+
+@input_rules.on(end_pattern_2, contains=("my word",), guard=from_defender)
+def on_end_2(context, match):
+    if TESTING: print("Matched end of game (2)")
+    context.game.end_game(match.groups()[0].strip())
+
+@input_rules.on(end_pattern_3, starts="d", guard=from_defender)
+def on_end_3(context, match):
+    if TESTING: print("Matched end of game (3)")
+    word = context.game.last_clue_solved.guess if context.game.last_clue_solved is not None else context.game.last_clue_guessed.guess
+    context.game.end_game(word)
+
+@input_rules.on(end_pattern_4, contains=(u"\u2713", u"\u2714"), guard=from_defender)
+def on_end_4(context, match):
+    if TESTING: print("Matched end of game (4)")
+    context.game.end_game(match.groups()[0].strip())
+
+# "Defending" message
+@input_rules.on(defender_pattern, contains=("defending",))
+def on_defender(context, match):
+    if TESTING: print("Matched defender: %s, defending %s" % (context.message.user.name, match.groups()[0].strip()))
+    context.game.repin_defender(context.message, match.groups()[0].strip())
+
+# Guess
+@input_rules.on(guess_pattern, starts=dispatch.DIGITS, guard=not_bot)
+def on_guess(context, match):
+    if TESTING: print("Matched guess %s for #%s" % (match.groups()[1].strip(), match.groups()[0].strip()))
+    context.game.add_guess(match.groups()[0].strip(), match.groups()[1].strip(), context.message.user)
+
+# Contact
+@input_rules.on(contact_pattern, starts="c", guard=not_bot)
+def on_contact(context, match):
+    if TESTING: print("Matched contact for #%s" % (match.groups()[0].strip()))
+    context.game.add_contact(context.message, [number.strip() for number in match.groups()[0].strip().split(',')])
+
+# Uncontact
+@input_rules.on(uncontact_pattern, starts="u", guard=not_bot)
+def on_uncontact(context, match):
+    if TESTING: print("Matched uncontact for #%s" % (match.groups()[0].strip()))
+    context.game.remove_contact(context.message, [number.strip() for number in match.groups()[0].strip().split(',')])
+
+# Pass
+@input_rules.on(pass_pattern, starts="iap", guard=not_bot)
+def on_pass(context, match):
+    if TESTING: print("Matched pass for #%s" % (match.groups()[0].strip()))
+    context.game.pass_clue(context.message, match.groups()[0].strip())
+
+# Bot commands (see the command handlers below)
+@input_rules.on(None, starts="!")
+def on_command(context, match):
+    token, arg = commands.split(context.input)
+    entry = bot_commands.lookup(token)
+
+    # Check for invalid command/insufficient permissions.
+    if entry is None or entry.access > context.access:
+        if not context.is_trusted_user:
+            context.game.send_message("I'm sorry, I've been told not to listen to you. Try asking a mod to add you to the whitelist.")
+        else:
+            context.game.send_message("I don't recognize that command, or you don't have sufficient permission.  Type `!help` for a list of valid commands.")
+        return
 
-        except:
-            log_exception(*sys.exc_info())
+    if TESTING: print("Matched %s command" % (entry.name))
+    try:
+        args = entry.parser(arg)
+    except ValueError:
+        context.game.send_message("Syntax: **`%s`**" % (entry.usage))
+        return
+    entry.handler(context, *args)
+
+# Count the number of people waving in the room.  If enough, ping others to join.
+@input_rules.on(wave_pattern, starts="\\o0<")
+def on_wave(context, match):
+    if TESTING: print("Matched wave")
+    timestamp = datetime.utcnow()
+    context.game.waves[context.message.user.id] = timestamp
+    context.game.call_later(WAVE_DEATH, context.game.expire_wave, context.message.user.id, timestamp)
+
+    # Check if a sufficient number of people have waved in the last while, to warrant pinging other users.
+    context.game.check_waves()
+
+### Command handlers ###
+
+# Commands are looked up by their first word.  The access level, argument parser and help text for each one are
+# declared with it, and !help lists them in the order they appear here.
+bot_commands = commands.registry()
+
+@bot_commands.command("!clues", description="list all active clues")
+def cmd_clues(context):
+    context.game.display_clues(False)
+
+@bot_commands.command("!unstarred", description="list any active clues that haven't been starred")
+def cmd_unstarred(context):
+    context.game.display_clues(True)
+
+@bot_commands.command("!contacts", parser=commands.optional_arg, usage="!contacts [<clueNum>]",
+                      description="list contacts for a specific clue or all clues")
+def cmd_contacts(context, number):
+    context.game.display_contacts(number)
+
+@bot_commands.command("!words", description="count the words in my dictionary that start with the letters being defended")
+def cmd_words(context):
+    context.game.count_words()
+
+@bot_commands.command("!unpass", description='undo a "pass" if you made a mistake')
+def cmd_unpass(context):
+    context.game.reverse_pass()
+
+@bot_commands.command("!kill", parser=commands.required_arg, usage="!kill <clueNum>",
+                      description="remove a clue from the list of active clues. This will kill anyone's clue, not just your own.")
+def cmd_kill(context, number):
+    context.game.kill_clue(number, "", context.message.user, True)
+
+@bot_commands.command("!uncontact", parser=commands.required_arg, usage="!uncontact <clueNum>",
+                      description="remove all contacts for clue <clueNum>")
+def cmd_uncontact(context, number):
+    context.game.remove_contact(context.message, [number], True) # remove all contacts for this clue
+
+@bot_commands.command("!shutup", parser=commands.optional_arg, usage="!shutup [<minutes>]",
+                      description="silence me completely for the specified amount of time (defaults to 10 min)")
+def cmd_shutup(context, minutes):
+    context.game.mute(minutes)
+
+@bot_commands.command("!speak", description="undo a !shutup command")
+def cmd_speak(context):
+    context.game.unmute()
+
+@bot_commands.command("!verbose", parser=commands.optional_arg, usage="!verbose [on|off]",
+                      description="in verbose mode, I'll comment more on game events. No parameter lists the current state")
+def cmd_verbose(context, setting):
+    context.game.toggle_verbosity(setting.lower())
+
+@bot_commands.command("!resume", parser=commands.optional_arg, usage="!resume <gameNum>",
+                      description="if I died or a game was otherwise interrupted, restore the game state")
+def cmd_resume(context, number):
+    context.game.load_game(number)
+
+@bot_commands.command("!stats", parser=commands.required_arg, usage="!stats <gameNum>",
+                      description="displays some statistical information for the specified game")
+def cmd_stats(context, number):
+    context.game.game_stats(number)
+
+@bot_commands.command("!leaderboard", parser=commands.optional_arg, usage="!leaderboard [<board>]",
+                      description="show the players with the most solved clues, successful contacts or games defended, across all games (<board> is setters, contacters or defenders)")
+def cmd_leaderboard(context, board):
+    context.game.leaderboard(board)
+
+@bot_commands.command("!player", parser=commands.required_arg, usage="!player <user>",
+                      description="displays statistics for a player (by user number or name), across all games")
+def cmd_player(context, who):
+    context.game.player_stats(who)
+
+@bot_commands.command("!perf", parser=commands.optional_arg, usage="!perf [dump]",
+                      description="show how long each stage of my work is taking (p50/p95/p99), or save the figures to a file")
+def cmd_perf(context, arg):
+    if arg.lower() == "dump":
+        perf.stages.dump(PERF_FILE)
+        context.game.send_message("Saved timing statistics to %s." % (PERF_FILE))
+    elif arg != "":
+        context.game.send_message("Syntax: **`!perf [dump]`**")
+    else:
+        context.game.send_message("\n".join("    " + line for line in perf.stages.report()), False) # Indented, so it's shown in a fixed-width font
 
-# Someone has posted a new clue.
-def add_clue(msg, number, text, is_edit):
-    global clues
+@bot_commands.command("!gameover", description="immediately ends the current game, removing clues and displaying statistics for the game")
+def cmd_gameover(context):
+    context.game.end_game()
 
-    if is_edit and number in clues:
-        clues[number].clue_text = text
-        db = sqlite3.connect('Contact.db')
-        db.execute('UPDATE clue SET Text = ? WHERE Id = ?', (text, clues[number].db_id))
-        db.commit()
-        db.close()
-        return
+@bot_commands.command("!reset", description="unstar all messages from the current game and reset my game data, without recording an end to the game")
+def cmd_reset(context):
+    context.game.reset()
 
-    elif game_state == Game_state.Passed:
-        passed_clue_number = [c.number for c in clues.values() if c.state == Clue_state.Passed][0] # There should only ever be one clue in the Passed state.
-        send_message("%s has passed on clue #%s. Please don't post any new clues until the pass has been resolved. I recommend deleting this clue, and reposting after the pass is resolved. (I am ignoring it.)" % (defender_name, passed_clue_number))
-    elif game_state == Game_state.WaitingForLetter:
-        send_message("We are waiting on %s to provide a new letter. Please don't post any new clues until they have done so. I recommend deleting this clue (I am ignoring it)" % (defender_name))
-    elif game_state == Game_state.Finished:
-        if verbose: send_message("The game is over. No clues are being accepted.")
-    elif game_state == Game_state.Guessing:
-        if msg.user.id == defender_id and not TESTING:
-            send_message("You are the defender -- you can't post clues!")
-        elif number in clues:
-            if msg.user.id == my_user.id: #The bot posted this as part of resuming a game
-                clues[number].message = msg.message
-                #Hack to star our own message:  Pin, then unpin
-                toggle_pinning(msg.message)
-                time.sleep(1.1)
-                toggle_pinning(msg.message)
-            else:
-                send_message("There is already an active clue #%s.  Please edit or repost with a different number." % (number))
-        else: # Initialize a new clue instance
-            c = clue()
-            c.number = number
-            c.setter_id  = msg.user.id
-            c.setter_name = msg.user.name
-            c.timestamp = msg.time_stamp
-            c.message = msg.message
-            c.clue_text = text
-            c.set_state(Clue_state.Set)
-            clues[number] = c
-            if TESTING: print("Message has %s stars" % (msg.message.stars))
-            if msg.message.stars == 0: # Sometimes a single message contains several clues (e.g. 4,5: Fifth space on a Monopoly board = READING RAILROAD). Only attempt to star if it hasn't already been starred.
-                msg.message.star()
-            
-            if len(clues) >= MAX_CLUES:
-                # If there are too many active clues, give an appropriate message.
-                if verbose: send_message("There are now %s unsolved clues.  Please don't post any more clues until some have been resolved." % (len(clues)))
-                total_contacts = 0
-                # Count the total number of contacts on all clues
-                for cl in clues.itervalues():
-                    total_contacts += len(cl.contacts)
-                if total_contacts >= CONTACT_THRESHOLD:
-                    # If there are a lot of contacts, suggest that the defender pass
-                    if verbose: send_message("%s, there are a total of %s contacts on existing clues.  You might want to think about passing if you can't solve any of them. (Use `!contacts` to see current contacts.)" % (defender_name, total_contacts))
-                else:
-                    # Otherwise, suggest that people focus on solving clues
-                    if verbose: send_message("There aren't very many contacts on existing clues.  Why don't you focus on solving some of them instead of posting more?")
-
-            db = sqlite3.connect('Contact.db')
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO clue (ClueNumber, SetterId, SetterName, Text, GameId, DefenceId, ChatId, PostTimeUTC) values (?, ?, ?, ?, ?, ?, ?, ?)', 
-                            (number, msg.user.id, msg.user.name, text, game_id, defence_id, msg.message.id, datetime.utcnow()))
-            c.db_id = cursor.lastrowid
-            db.commit()
-            db.close()
+@bot_commands.command("!whitelist", Access.Super, parser=commands.optional_arg, usage="!whitelist [[+|-]<userNum>]",
+                      description="add/remove a user from the whitelist, or list users on the whitelist")
+def cmd_whitelist(context, param):
+    context.game.modify_list(whitelist, param, "whitelist")
 
-    else: # Should never happen
-        print("Add clue in None state")
+@bot_commands.command("!pinglist", parser=commands.optional_arg, usage="!pinglist [[+|-]<userName>]",
+                      description="add/remove a user from the pinglist, or list users on the pinglist")
+def cmd_pinglist(context, param):
+    context.game.modify_list(pinglist, param, "pinglist")
 
-        
-# Someone has posted a new guess.  Generally anything that starts with a number and doesn't match something else (confirmation/denial, death/life, etc.) is considered a guess.
-def add_guess(number, guess, guesser):
-    global clues, num_contact_guesses, last_clue_guessed, last_clue_solved
+@bot_commands.command("!ping", Access.Super, description="ping all users on the pinglist to indicate that you want to start a game")
+def cmd_ping(context):
+    context.game.ping()
 
-    guess = guess.upper()
+@bot_commands.command("!help", Access.Anyone)
+def cmd_help(context):
+    context.game.info()
 
-    # Can't make another guess if there is a guess outstanding (except after a pass). 
-    if number in clues and clues[number].guess != "" and game_state != Game_state.Passed:
-        send_message("We are currently waiting on %s to confirm %s's guess for clue #%s.  Please wait until that has been done before making another guess." % (clues[number].setter_name, clues[number].guesser_name, number))
-        return
+@bot_commands.command("!shutdown", Access.Super, description="shut me down permanently. I will need to be restarted by the bot owner")
+def cmd_shutdown(context):
+    global shutdown
+    print("Matched !shutdown command")
+    shutdown = True # main() closes everything down, in order, so all the queued game data is written and everything we meant to say gets said
 
-    # Regular game progress
-    if game_state == Game_state.Guessing:
-        # Defender posted the guess, and game state is Guessing
-        if guesser.id == defender_id or TESTING:
-            add_defender_guess(number, guess, guesser)
-        # Someone else posted the guess when they shouldn't be guessing.
-        else:
-            if guess[:3] == "WAS": # Swallow messages like "3 was ANIMAL".  They're just after-the-fact discussion about a clue
-                pass
-            elif number in clues:
-                if verbose: send_message("You can't make guesses right now; that's the defender's job.  Wait till a clue has been passed.")
+# Decorator for a ContactGame method: ignore calls made within `seconds` of the last one for the same game.
+def cooldown(seconds):
+    def inner(fn):
+        def ret_fn(self, *args, **kwargs):
+            if time.time() > ret_fn.last_time_stamps.get(self, 0) + seconds:
+                fn(self, *args, **kwargs)
+                ret_fn.last_time_stamps[self] = time.time()
+
+        ret_fn.last_time_stamps = {} # ContactGame -> time of the last call
+        return ret_fn
+    return inner
+
+### Game ###
+
+# The game in one chat room: the clues, the defence, and everything else that belongs to that room rather than to the bot
+# as a whole.  The bot can be in several rooms at once (see ROOMS), with a ContactGame for each; they share the chat client,
+# the database, the reminders and the side_work pool.
+#
+# Everything that changes a game's state runs on its worker, one call at a time, holding its lock.  Work done elsewhere
+# (timers, side_work) hands back to the worker when it needs to touch the game or say something (see call_later and post).
+class ContactGame(object):
+    def __init__(self, room, outgoing=None):
+        self.room = room # The ChatExchange room reference
+        self.lock = threading.RLock() # Held while the game's state is being changed (or saved)
+        self.worker = workers.worker("game-%s" % (room.id), self.lock) # Handles the room's messages and timed events, in order
+        self.outgoing = outgoing if outgoing is not None else outbox.outbox(room) # Sends messages and star/pin requests to the room in the background (see outbox.py)
+        self.snapshot_file = SNAPSHOT_FILE % (room.id)
+        self.snapshots = None # Saves the game state to snapshot_file in the background, once the game has started (see snapshot.py)
+        self.events = eventlog.eventlog(EVENT_LOG_FILE % (room.id)) # Records game events (see eventlog.py)
+        self.clues = game.GameState(self.clue_state_changed, self.clue_guess_changed) # Holds all the active clues, indexed by clue number (and by message, state and setter)
+        self.dead_clues = collections.deque(maxlen=DEAD_CLUE_LIMIT) # The most recent dead/solved clues (as game.dead_clue records).
+        self.recent_messages = outbox.dedupe_cache(MESSAGE_DUPE_DELAY) # Keep track of the last few messages sent, so we don't repeat ourselves unnecessarily.
+        self.last_clue_solved = None # The last clue solved is going to be the one that wins the game.  We need that info at game end.
+        self.last_clue_guessed = None # If we don't have a "last clue solved", we'll go with the last one guessed instead.
+        self.pass_with_no_contact = False # If someone passes before a clue is contacted, it means they think someone has it.  We have different rules in that situation.
+
+        self.game_state = Game_state.None
+        self.num_contact_guesses = 0 # How many guesses have been made after a pass (by those who contacted the clue)
+        self.verbose = True # When true, the bot talks more.
+
+        # Unique IDs for the database tables
+        self.game_id = -1
+        self.defence_id = -1
+
+        # Defender info
+        self.defender_id = -1 # Chat ID
+        self.defender_name = ""
+        self.defending_text = "" # The portion of the word being defended
+        self.defending_message = None # A reference to the message containing the defended text
+        self.defending_timestamp = None # The time the message was posted.
+
+        self.muted_timestamp = None # When the bot was told to !shutup
+        self.mute_length = DEFAULT_MUTE_LENGTH # Seconds until the bot may speak again.
+
+        self.waves = {} # Timestamps of the most recent waves ( o/ ) posted in the room.
+
+    # Restore the game from its snapshot (if we were restarted in the middle of it), or failing that from its event log, and
+    # start saving snapshots.
+    def start(self):
+        state = snapshot.load(self.snapshot_file)
+        if state is None and os.path.isfile(self.events.path) and os.path.getsize(self.events.path) > 0:
+            replayed = eventlog.replay(eventlog.read(self.events.path))
+            log('info', "No snapshot for room %s; replayed %s events from %s" % (self.room.id, replayed.events, self.events.path))
+            state = replayed_snapshot(replayed)
+        with self.lock:
+            self.restore_snapshot(state)
+        self.snapshots = snapshot.snapshotter(self.snapshot_file, self.capture_snapshot, self.lock, interval=SNAPSHOT_INTERVAL)
+
+    # Write out everything still waiting to be saved or sent.
+    def close(self):
+        self.worker.close()
+        if self.snapshots is not None:
+            self.snapshots.close()
+        self.outgoing.close()
+        self.events.close()
+
+    # A chat event for this room.  Runs on the worker.
+    def on_event(self, message):
+        start = perf.clock()
+        self.handle_message(message)
+        perf.stages.add("on_message", perf.clock() - start)
+        if self.snapshots is not None:
+            self.snapshots.mark()
+
+    def handle_message(self, message):
+        is_edit = isinstance(message, chatexchange.events.MessageEdited)
+
+        # If the message containing a clue is deleted, remove the clue from the list of active clues.
+        if isinstance(message, chatexchange.events.MessageDeleted):
+            try:
+                for deleted_clue in self.clues.by_message(message.message):
+                    self.remove_clue(deleted_clue, Clue_state.Dead)
+            except:
+                log_exception(*sys.exc_info())
+
+        if isinstance(message, chatexchange.events.MessagePosted) or is_edit:
+            try:
+                # Remove all weird HTML encodings (like &amp; for &)
+                context = message_context(self, message, unescape(message.content), is_edit)
+
+                # This will fail if there are any unicode characters in the input. Mostly a problem with check mark.
+                # Not a concern when TESTING is False.
+                # print(">> (%s / %s) %s" % (message.user.name, repr(message.user.id), context.input))
+
+                # Find the first input rule (see below) that matches, and let it handle the message.
+                # (Reminders about clue status and guesses are sent by timers; see clue.set_state and clue.set_guess.)
+                input_rules.dispatch(context.input, context)
+
+            except:
+                log_exception(*sys.exc_info())
+
+    # Someone has posted a new clue.
+    def add_clue(self, msg, number, text, is_edit):
+
+        if is_edit and number in self.clues:
+            self.clues[number].clue_text = text
+            self.record(eventlog.ClueEdited, number, text)
+            contact_db.execute('UPDATE clue SET Text = ? WHERE Id = ?', (text, self.clues[number].db_id))
+            return
+
+        elif self.game_state == Game_state.Passed:
+            passed_clue_number = self.clues.in_state(Clue_state.Passed)[0].number # There should only ever be one clue in the Passed state.
+            self.send_message("%s has passed on clue #%s. Please don't post any new clues until the pass has been resolved. I recommend deleting this clue, and reposting after the pass is resolved. (I am ignoring it.)" % (self.defender_name, passed_clue_number))
+        elif self.game_state == Game_state.WaitingForLetter:
+            self.send_message("We are waiting on %s to provide a new letter. Please don't post any new clues until they have done so. I recommend deleting this clue (I am ignoring it)" % (self.defender_name))
+        elif self.game_state == Game_state.Finished:
+            if self.verbose: self.send_message("The game is over. No clues are being accepted.")
+        elif self.game_state == Game_state.Guessing:
+            if msg.user.id == self.defender_id and not TESTING:
+                self.send_message("You are the defender -- you can't post clues!")
+            elif number in self.clues:
+                self.send_message("There is already an active clue #%s.  Please edit or repost with a different number." % (number))
+            else: # Initialize a new clue instance
+                c = clue()
+                c.number = number
+                c.setter_id  = msg.user.id
+                c.setter_name = msg.user.name
+                c.timestamp = msg.time_stamp
+                c.message = msg.message
+                c.clue_text = text
+                c.set_state(Clue_state.Set)
+                self.clues.add(c)
+                self.record(eventlog.ClueSet, number, msg.user.id, msg.user.name, text, msg.message.id)
+                add_player_stats(msg.user.id, msg.user.name, CluesSet=1)
+                self.outgoing.perform(star_once, msg.message)
+
+                if len(self.clues) >= MAX_CLUES:
+                    # If there are too many active clues, give an appropriate message.
+                    if self.verbose: self.send_message("There are now %s unsolved clues.  Please don't post any more clues until some have been resolved." % (len(self.clues)))
+                    total_contacts = 0
+                    # Count the total number of contacts on all clues
+                    for cl in self.clues.itervalues():
+                        total_contacts += len(cl.contacts)
+                    if total_contacts >= CONTACT_THRESHOLD:
+                        # If there are a lot of contacts, suggest that the defender pass
+                        if self.verbose: self.send_message("%s, there are a total of %s contacts on existing clues.  You might want to think about passing if you can't solve any of them. (Use `!contacts` to see current contacts.)" % (self.defender_name, total_contacts))
+                    else:
+                        # Otherwise, suggest that people focus on solving clues
+                        if self.verbose: self.send_message("There aren't very many contacts on existing clues.  Why don't you focus on solving some of them instead of posting more?")
+
+                c.db_id = contact_db.execute('INSERT INTO clue (ClueNumber, SetterId, SetterName, Text, GameId, DefenceId, ChatId, PostTimeUTC) values (?, ?, ?, ?, ?, ?, ?, ?)', 
+                                (number, msg.user.id, msg.user.name, text, self.game_id, self.defence_id, msg.message.id, datetime.utcnow()))
+
+        else: # Should never happen
+            print("Add clue in None state")
+
+    # Someone has posted a new guess.  Generally anything that starts with a number and doesn't match something else (confirmation/denial, death/life, etc.) is considered a guess.
+    def add_guess(self, number, guess, guesser):
+
+        guess = guess.upper()
+
+        # Can't make another guess if there is a guess outstanding (except after a pass). 
+        if number in self.clues and self.clues[number].guess != "" and self.game_state != Game_state.Passed:
+            self.send_message("We are currently waiting on %s to confirm %s's guess for clue #%s.  Please wait until that has been done before making another guess." % (self.clues[number].setter_name, self.clues[number].guesser_name, number))
+            return
+
+        # Regular game progress
+        if self.game_state == Game_state.Guessing:
+            # Defender posted the guess, and game state is Guessing
+            if guesser.id == self.defender_id or TESTING:
+                self.add_defender_guess(number, guess, guesser)
+            # Someone else posted the guess when they shouldn't be guessing.
             else:
-                if verbose: send_message("Clue text must be **bold** (surround it with `**` or `__`).  Please try again.")
-
-    # Defender has passed.  
-    elif game_state == Game_state.Passed:
-        # Still allow guesses by the defender on other clues, even while pass is pending.
-        if guesser.id == defender_id and not TESTING:
-            if number not in clues:
-                send_message("There doesn't appear to be an active clue with the number %s, so you can't make a guess." % (number))
-            elif clues[number].state == Clue_state.Set:
-                add_defender_guess(number, guess, guesser)
+                if guess[:3] == "WAS": # Swallow messages like "3 was ANIMAL".  They're just after-the-fact discussion about a clue
+                    pass
+                elif number in self.clues:
+                    if self.verbose: self.send_message("You can't make guesses right now; that's the defender's job.  Wait till a clue has been passed.")
+                else:
+                    if self.verbose: self.send_message("Clue text must be **bold** (surround it with `**` or `__`).  Please try again.")
+
+        # Defender has passed.  
+        elif self.game_state == Game_state.Passed:
+            # Still allow guesses by the defender on other clues, even while pass is pending.
+            if guesser.id == self.defender_id and not TESTING:
+                if number not in self.clues:
+                    self.send_message("There doesn't appear to be an active clue with the number %s, so you can't make a guess." % (number))
+                elif self.clues[number].state == Clue_state.Set:
+                    self.add_defender_guess(number, guess, guesser)
+                else:
+                    self.send_message("You passed on clue #%s.  Please refrain from making guesses until the pass is resolved." % (number))
+            # Someone tries to post a guess for another clue
+            elif number not in self.clues or self.clues[number].state != Clue_state.Passed:
+                self.send_message("%s has passed on clue #%s. We are currently only accepting guesses for that clue from those who have contacted it." % (self.defender_name, number))
+            # The guesser is someone who contacted this clue (or no one contacted this clue)
+            elif guesser.id in self.clues[number].contacts.keys() or self.pass_with_no_contact:
+                self.clues[number].set_guess(guess, guesser.name)
+                self.record(eventlog.GuessMade, number, guess, guesser.id, guesser.name, True)
+                self.num_contact_guesses += 1
+                self.last_clue_guessed = self.clues[number]
+                self.last_clue_solved = None
+                if TESTING: print("Guess for clue #%s:\n%s" % (number, guess))
+            # The guesser didn't contact this clue
             else:
-                send_message("You passed on clue #%s.  Please refrain from making guesses until the pass is resolved." % (number))
-        # Someone tries to post a guess for another clue
-        elif number not in clues or clues[number].state != Clue_state.Passed:
-            send_message("%s has passed on clue #%s. We are currently only accepting guesses for that clue from those who have contacted it." % (defender_name, number))
-        # The guesser is someone who contacted this clue (or no one contacted this clue)
-        elif guesser.id in clues[number].contacts.keys() or pass_with_no_contact:
-            clues[number].set_guess(guess, guesser.name)
-            num_contact_guesses += 1
-            last_clue_guessed = clues[number]
-            last_clue_solved = None
-            if TESTING: print("Guess for clue #%s:\n%s" % (number, guess))
-        # The guesser didn't contact this clue
+                self.send_message("You haven't contacted clue #%s.  Only those who have contacted the clue may guess.  (To see who has contacted it, use **`!contacts %s`**)" % (number, number))
+        elif self.game_state == Game_state.WaitingForLetter:
+            self.send_message("We are currently waiting for %s to provide an additional letter.  No guesses (or clues) are being accepted right now." % (self.defender_name))
+        elif self.game_state == Game_state.Finished:
+            if self.verbose: self.send_message("The game is over.  No more guesses are being accepted.")
+        else: # Should never happen
+            print("Guess in None state")
+
+    # Helper function to process a valid guess by the defender.
+    def add_defender_guess(self, number, guess, guesser):
+        start_of_guess = guess.strip().replace(" ","")[:len(self.defending_text)] # Grab the first X letters of the guess (minus spaces), where X is the length of the currently defended text
+        if number not in self.clues:
+            # Trying to guess for a non-existent clue
+            if self.verbose: self.send_message("There doesn't appear to be an active clue with the number %s, so you can't make a guess." % (number))
+        elif start_of_guess != self.defending_text:
+            # Guess doesn't start with the right letters
+            self.send_message("The word being defended starts with **%s**.  Your guess starts with **%s**.  Try again." % (self.defending_text, start_of_guess))
         else:
-            send_message("You haven't contacted clue #%s.  Only those who have contacted the clue may guess.  (To see who has contacted it, use **`!contacts %s`**)" % (number, number))
-    elif game_state == Game_state.WaitingForLetter:
-        send_message("We are currently waiting for %s to provide an additional letter.  No guesses (or clues) are being accepted right now." % (defender_name))
-    elif game_state == Game_state.Finished:
-        if verbose: send_message("The game is over.  No more guesses are being accepted.")
-    else: # Should never happen
-        print("Guess in None state")
-
-# Helper function to process a valid guess by the defender.
-def add_defender_guess(number, guess, guesser):
-    start_of_guess = guess.strip().replace(" ","")[:len(defending_text)] # Grab the first X letters of the guess (minus spaces), where X is the length of the currently defended text
-    if number not in clues:
-        # Trying to guess for a non-existent clue
-        if verbose: send_message("There doesn't appear to be an active clue with the number %s, so you can't make a guess." % (number))
-    elif start_of_guess != defending_text:
-        # Guess doesn't start with the right letters
-        send_message("The word being defended starts with **%s**.  Your guess starts with **%s**.  Try again." % (defending_text, start_of_guess))
-    else:
-        # Valid guess
-        clues[number].set_guess(guess, guesser.name)
-        if TESTING: print("Guess for clue #%s:\n%s" % (number, guess))
-
-# Someone is confirming a guess
-def confirm_guess(number, text, user):
-    global clues, dead_clues, last_clue_solved, pass_with_no_contact
-    if number not in clues:
-        # Trying to confirm a guess that doesn't exist
-        send_message("There is no clue #%s.  What exactly are you confirming?" % (number))
-    elif user.id != clues[number].setter_id:
-        # Someone trying to confirm a guess for a clue they didn't set
-        add_guess(number, text, user) #If this isn't the setter of the clue, they're probably guessing, not confirming.
-    elif clues[number].guess == "":
-        # Someone trying to confirm a guess for their clue, when no guess has been made.
-        send_message("There was no guess made for #%s.  What exactly are you confirming?" % (number))
-    else:
-        # Someone properly confirming a guess for their own clue
-        this_clue = clues[number]
-        if game_state == Game_state.Passed and this_clue.state == Clue_state.Passed:
-            # If this correct guess was for a passed clue, the defender needs to give up a letter.
-            num_contact_guesses = 0
-            set_game_state(Game_state.WaitingForLetter)
-            last_clue_solved = this_clue
-            if not pass_with_no_contact:
-                if verbose: send_message("You guessed correctly.  %s must give up a letter!" % (defender_name))
-            pass_with_no_contact = False
-
-        remove_clue(clues[number], Clue_state.Solved, None, user)
-
-# Someone is indicating that a guess is incorrect.
-def deny_guess(number, text, user):
-    global clues
-    
-    if number not in clues:
-        # Trying to deny a guess that doesn't exist.
-        send_message("There is no clue #%s.  What exactly are you saying *no* to?" % (number))
-    elif user.id != clues[number].setter_id:
-        # Someone trying to deny a guess for a clue they didn't set
-        add_guess(number, text, user) #If this isn't the setter of the clue, they're probably guessing, not denying.
-    elif clues[number].guess == "":
-        # Someone trying to deny a guess for their clue, when no guess has been made.
-        send_message("There was no guess made for #%s.  What exactly are you saying *no* to?" % (number))
-    elif clues[number].state == Clue_state.Passed and num_contact_guesses >= len(clues[number].contacts) and not pass_with_no_contact:  #This is the last contacter to guess
-        # Someone properly denying a guess for their own clue, when the defender has passed
-        send_message("It looks like no one guessed right.  Clue #%s is now dead. Carry on." % (number))
-        print("Last contact's guess was wrong.  Clue is dead.  Resuming regular game.")
-        clues[number].set_guess("", "")
-        
-        remove_clue(clues[number], Clue_state.Dead, Game_state.Guessing)
-        if TESTING: print("Clues: %s" % (clues))
-        if TESTING: print("Dead: %s" % (dead_clues))
-    else:
-        # Someone properly denying a guess for their own clue in Guessing state,
-        # or for not-the-last guess when the defender has passed,
-        # or for any guess when the defender passed with no contacts
-        clues[number].set_guess("", "")
-
-# Someone has contacted a clue
-def add_contact(msg, numbers):
-    global clues
-    # We allow multiple contacts in a single message.  Loop through them and process each one.
-    for number in numbers:
-        number = number.strip()
-        # Trying to contact a non-existent clue
-        if number not in clues:
-            send_message("There doesn't appear to be an active clue with the number %s, therefore you can't contact it." % (number))
-        # Trying to contact one's own clue
-        elif clues[number].setter_id == msg.user.id and not TESTING:
-            send_message("You can't contact your own clue!")
-        # Valid contact.  Add to the list
-        else:
-            clues[number].contacts[msg.user.id] = msg.user.name
-            db = sqlite3.connect('Contact.db')
-            db.execute('INSERT INTO contact (ContacterId, ContacterName, ClueId) values (?, ?, ?)', (msg.user.id, msg.user.name, clues[number].db_id))
-            db.commit()
-            db.close()
-            
-            if TESTING: print("Contacts for clue #%s:\n%s" % (number, clues[number].contacts.values()))
+            # Valid guess
+            if word_list is not None and word_list.contains(guess) is False:
+                self.send_message("Note: **%s** isn't in my dictionary." % (guess.strip()))
+            self.clues[number].set_guess(guess, guesser.name)
+            self.record(eventlog.GuessMade, number, guess, guesser.id, guesser.name, False)
+            if TESTING: print("Guess for clue #%s:\n%s" % (number, guess))
 
-# Someone has uncontacted a clue
-def remove_contact(msg, numbers, remove_all = False):
-    global clues
-    # We allow multiple uncontacts in a single message.  Loop through them and process each one.
-    for number in numbers:
-        number = number.strip()
-        # Trying to uncontact a non-existent clue
-        if number not in clues:
-            send_message("There doesn't appear to be an active clue with the number %s, therefore you can't uncontact it." % (number))
-        # We are using a bot command to remove all contacts
-        elif remove_all:
-            clues[number].contacts = {}
-            send_message("Cleared all contacts for clue #%s." % (number))
-        # The contact exists.  Remove it.
-        elif msg.user.id in clues[number].contacts.keys():
-            del clues[number].contacts[msg.user.id]
-            db = sqlite3.connect('Contact.db')
-            db.execute('DELETE FROM contact WHERE Id IN (SELECT Id FROM contact WHERE ContacterId = ? AND ClueId = ?)', (msg.user.id, clues[number].db_id))
-            db.commit()
-            db.close()
-            
-            if TESTING: print("Contacts for clue #%s:\n%s" % (number, clues[number].contacts.values()))
-        # The contact does not exist
+    # Someone is confirming a guess
+    def confirm_guess(self, number, text, user):
+        if number not in self.clues:
+            # Trying to confirm a guess that doesn't exist
+            self.send_message("There is no clue #%s.  What exactly are you confirming?" % (number))
+        elif user.id != self.clues[number].setter_id:
+            # Someone trying to confirm a guess for a clue they didn't set
+            self.add_guess(number, text, user) #If this isn't the setter of the clue, they're probably guessing, not confirming.
+        elif self.clues[number].guess == "":
+            # Someone trying to confirm a guess for their clue, when no guess has been made.
+            self.send_message("There was no guess made for #%s.  What exactly are you confirming?" % (number))
         else:
-            send_message("You can't uncontact a clue you never contacted! (#%s)" % (number))
-
-# Someone has declared a clue dead after a new letter has been revealed
-def kill_clue(number, text, user, override = False):
-    global clues
-    # Trying to kill a non-existent clue
-    if number not in clues:
-        return
-        # send_message("There is no clue #%s." % (number))
-    # The owner of the clue is legit killing it (can be in any game state), or someone issued the !kill command
-    elif clues[number].setter_id == user.id or override:
-        remove_clue(clues[number], Clue_state.Dead)
-    else: #someone else is saying it dies.  More likely to be a guess.
-        add_guess(number, text, user)
-        
-# Someone has declared a clue still alive after a new letter has been revealed
-def confirm_life(number, text, user):
-    global clues
-    # Trying to confirm a non-existent clue
-    if number not in clues:
-        send_message("There is no clue #%s." % (number))
-    # The owner of the clue is declaring it legit
-    elif clues[number].setter_id == user.id:
-        clues[number].set_state(Clue_state.Set)
-        clues[number].warned = False
-    else: #someone else is saying it lives.  More likely to be a guess.
-        add_guess(number, text, user)
-
-# The defender has passed on a clue
-def pass_clue(msg, number):
-    global clues, pass_with_no_contact
-    # Make sure it's the defender passing.
-    if msg.user.id != defender_id:
-        send_message("Only the defender can pass on clues.")
-    # Trying to pass on a non-existent clue
-    elif number not in clues:
-        send_message("There is no current clue #%s. Try passing on an *existing* clue!" % (number))
-    else:
-        # Go into "pass" mode. Let the contacter(s) know that they need to guess.
-        clues[number].set_state(Clue_state.Passed)
-        set_game_state(Game_state.Passed)
-        # Trying to pass when a clue hasn't been contacted (we do it anyway, but mention it just in case)
-        if len(clues[number].contacts) == 0:
-            if verbose: send_message("...but clue #%s hasn't been contacted!?  Ok, I guess you know what you're doing... (You can **`!unpass`** if you made a mistake.)" % (number))
-            pass_with_no_contact = True
+            # Someone properly confirming a guess for their own clue
+            this_clue = self.clues[number]
+            if self.game_state == Game_state.Passed and this_clue.state == Clue_state.Passed:
+                # If this correct guess was for a passed clue, the defender needs to give up a letter.
+                self.num_contact_guesses = 0
+                self.set_game_state(Game_state.WaitingForLetter)
+                self.last_clue_solved = this_clue
+                if not self.pass_with_no_contact:
+                    if self.verbose: self.send_message("You guessed correctly.  %s must give up a letter!" % (self.defender_name))
+                self.pass_with_no_contact = False
+
+            self.remove_clue(self.clues[number], Clue_state.Solved, None, user)
+
+    # Someone is indicating that a guess is incorrect.
+    def deny_guess(self, number, text, user):
+
+        if number not in self.clues:
+            # Trying to deny a guess that doesn't exist.
+            self.send_message("There is no clue #%s.  What exactly are you saying *no* to?" % (number))
+        elif user.id != self.clues[number].setter_id:
+            # Someone trying to deny a guess for a clue they didn't set
+            self.add_guess(number, text, user) #If this isn't the setter of the clue, they're probably guessing, not denying.
+        elif self.clues[number].guess == "":
+            # Someone trying to deny a guess for their clue, when no guess has been made.
+            self.send_message("There was no guess made for #%s.  What exactly are you saying *no* to?" % (number))
+        elif self.clues[number].state == Clue_state.Passed and self.num_contact_guesses >= len(self.clues[number].contacts) and not self.pass_with_no_contact:  #This is the last contacter to guess
+            # Someone properly denying a guess for their own clue, when the defender has passed
+            self.send_message("It looks like no one guessed right.  Clue #%s is now dead. Carry on." % (number))
+            print("Last contact's guess was wrong.  Clue is dead.  Resuming regular game.")
+            self.clues[number].set_guess("", "")
+            self.record(eventlog.GuessDenied, number)
+
+            self.remove_clue(self.clues[number], Clue_state.Dead, Game_state.Guessing)
+            if TESTING: print("Clues: %s" % (self.clues))
+            if TESTING: print("Dead: %s" % (self.dead_clues))
         else:
-            pass_msg = "Clue #%s (**%s**) was contacted by: ***%s***. Make your guess" \
-                    % (number, html_to_markdown(clues[number].clue_text), ", ".join(user for user in clues[number].contacts.values()))
-            if len(clues[number].contacts) > 1:
-                pass_msg += "es (one each)"
-            pass_msg += "! "
-            send_message(pass_msg)
-            if len(clues[number].contacts) > 1:
-                send_message("(Multiple guesses will be ignored until the first is confirmed.)")
-        
-# Reverse a pass that was made in error
-def reverse_pass():
-    number = -1
-    # Find a clue that has a state of "Passed" (there should only be one)
-    for clue in clues.itervalues():
-        if clue.state == Clue_state.Passed:
+            # Someone properly denying a guess for their own clue in Guessing state,
+            # or for not-the-last guess when the defender has passed,
+            # or for any guess when the defender passed with no contacts
+            self.clues[number].set_guess("", "")
+            self.record(eventlog.GuessDenied, number)
+
+    # Someone has contacted a clue
+    def add_contact(self, msg, numbers):
+        # We allow multiple contacts in a single message.  Loop through them and process each one.
+        for number in numbers:
+            number = number.strip()
+            # Trying to contact a non-existent clue
+            if number not in self.clues:
+                self.send_message("There doesn't appear to be an active clue with the number %s, therefore you can't contact it." % (number))
+            # Trying to contact one's own clue
+            elif self.clues[number].setter_id == msg.user.id and not TESTING:
+                self.send_message("You can't contact your own clue!")
+            # Already contacted; nothing to do
+            elif msg.user.id in self.clues[number].contacts:
+                if TESTING: print("%s has already contacted clue #%s" % (msg.user.name, number))
+            # Valid contact.  Add to the list
+            else:
+                self.clues[number].contacts[msg.user.id] = msg.user.name
+                self.record(eventlog.Contacted, number, msg.user.id, msg.user.name)
+                contact_db.execute('INSERT INTO contact (ContacterId, ContacterName, ClueId) values (?, ?, ?)', (msg.user.id, msg.user.name, self.clues[number].db_id))
+                add_player_stats(msg.user.id, msg.user.name, Contacts=1)
+
+                if TESTING: print("Contacts for clue #%s:\n%s" % (number, self.clues[number].contacts.values()))
+
+    # Someone has uncontacted a clue
+    def remove_contact(self, msg, numbers, remove_all = False):
+        # We allow multiple uncontacts in a single message.  Loop through them and process each one.
+        for number in numbers:
+            number = number.strip()
+            # Trying to uncontact a non-existent clue
+            if number not in self.clues:
+                self.send_message("There doesn't appear to be an active clue with the number %s, therefore you can't uncontact it." % (number))
+            # We are using a bot command to remove all contacts
+            elif remove_all:
+                for contacter_id, contacter_name in self.clues[number].contacts.iteritems():
+                    add_player_stats(contacter_id, contacter_name, Contacts=-1)
+                contact_db.execute('DELETE FROM contact WHERE ClueId = ?', (self.clues[number].db_id,))
+                self.clues[number].contacts = {}
+                self.record(eventlog.Uncontacted, number, None)
+                self.send_message("Cleared all contacts for clue #%s." % (number))
+            # The contact exists.  Remove it.
+            elif msg.user.id in self.clues[number].contacts.keys():
+                del self.clues[number].contacts[msg.user.id]
+                self.record(eventlog.Uncontacted, number, msg.user.id)
+                contact_db.execute('DELETE FROM contact WHERE Id IN (SELECT Id FROM contact WHERE ContacterId = ? AND ClueId = ?)', (msg.user.id, self.clues[number].db_id))
+                add_player_stats(msg.user.id, msg.user.name, Contacts=-1)
+
+                if TESTING: print("Contacts for clue #%s:\n%s" % (number, self.clues[number].contacts.values()))
+            # The contact does not exist
+            else:
+                self.send_message("You can't uncontact a clue you never contacted! (#%s)" % (number))
+
+    # Someone has declared a clue dead after a new letter has been revealed
+    def kill_clue(self, number, text, user, override = False):
+        # Trying to kill a non-existent clue
+        if number not in self.clues:
+            return
+            # send_message("There is no clue #%s." % (number))
+        # The owner of the clue is legit killing it (can be in any game state), or someone issued the !kill command
+        elif self.clues[number].setter_id == user.id or override:
+            self.remove_clue(self.clues[number], Clue_state.Dead)
+        else: #someone else is saying it dies.  More likely to be a guess.
+            self.add_guess(number, text, user)
+
+    # Someone has declared a clue still alive after a new letter has been revealed
+    def confirm_life(self, number, text, user):
+        # Trying to confirm a non-existent clue
+        if number not in self.clues:
+            self.send_message("There is no clue #%s." % (number))
+        # The owner of the clue is declaring it legit
+        elif self.clues[number].setter_id == user.id:
+            self.clues[number].set_state(Clue_state.Set)
+            self.clues[number].warned = False
+            self.record(eventlog.ClueLives, number)
+        else: #someone else is saying it lives.  More likely to be a guess.
+            self.add_guess(number, text, user)
+
+    # The defender has passed on a clue
+    def pass_clue(self, msg, number):
+        # Make sure it's the defender passing.
+        if msg.user.id != self.defender_id:
+            self.send_message("Only the defender can pass on clues.")
+        # Trying to pass on a non-existent clue
+        elif number not in self.clues:
+            self.send_message("There is no current clue #%s. Try passing on an *existing* clue!" % (number))
+        else:
+            # Go into "pass" mode. Let the contacter(s) know that they need to guess.
+            self.clues[number].set_state(Clue_state.Passed)
+            self.record(eventlog.Passed, number, len(self.clues[number].contacts) == 0)
+            self.set_game_state(Game_state.Passed)
+            # Trying to pass when a clue hasn't been contacted (we do it anyway, but mention it just in case)
+            if len(self.clues[number].contacts) == 0:
+                if self.verbose: self.send_message("...but clue #%s hasn't been contacted!?  Ok, I guess you know what you're doing... (You can **`!unpass`** if you made a mistake.)" % (number))
+                self.pass_with_no_contact = True
+            else:
+                pass_msg = "Clue #%s (**%s**) was contacted by: ***%s***. Make your guess" \
+                        % (number, self.clues[number].markdown, ", ".join(user for user in self.clues[number].contacts.values()))
+                if len(self.clues[number].contacts) > 1:
+                    pass_msg += "es (one each)"
+                pass_msg += "! "
+                self.send_message(pass_msg)
+                if len(self.clues[number].contacts) > 1:
+                    self.send_message("(Multiple guesses will be ignored until the first is confirmed.)")
+
+    # Reverse a pass that was made in error
+    def reverse_pass(self):
+        number = -1
+        # Find a clue that has a state of "Passed" (there should only be one)
+        for clue in self.clues.in_state(Clue_state.Passed):
             clue.set_state(Clue_state.Set)
             number = clue.number
-    if number == -1 or game_state != Game_state.Passed:
-        # If we didn't find a clue, or the game is not in the "Passed" state
-        send_message('There is nothing to undo.  No clues are currently "passed".')
-    else:
-        set_game_state(Game_state.Guessing)
-        send_message("Okay, I've cleaned up your mess.  Clue #%s is no longer passed.  Next time, say what you mean!" % (number))
-        
-# The defender has posted a (new) letter.
-def repin_defender(msg, text):
-    global defending_message, defending_text, defending_timestamp, defender_name, defender_id, waves, defence_id, game_id
+        if number == -1 or self.game_state != Game_state.Passed:
+            # If we didn't find a clue, or the game is not in the "Passed" state
+            self.send_message('There is nothing to undo.  No clues are currently "passed".')
+        else:
+            self.record(eventlog.Unpassed, number)
+            self.set_game_state(Game_state.Guessing)
+            self.send_message("Okay, I've cleaned up your mess.  Clue #%s is no longer passed.  Next time, say what you mean!" % (number))
 
-    defending_text = text.upper().strip().replace(" ", "")
-    
-    if msg.user.id != my_user.id: #If the bot is posting a "defending" message, it's resuming a saved game, so skip all this.
-        # Try to unpin the existing "defending" message
-        try:
-            defending_message.cancel_stars()
-        # If it can't be unpinned, there probably isn't one, and this is the start of a new game.
-        except:
-            reset()
-            waves = {}
+    # The defender has posted a (new) letter.
+    def repin_defender(self, msg, text):
 
-            db = sqlite3.connect('Contact.db')
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO game (DefenderId, DefenderName, StartTimeUTC) values (?, ?, ?)', (msg.user.id, msg.user.name, datetime.utcnow()))
-            game_id = cursor.lastrowid
-            db.commit()
-            db.close()
+        self.defending_text = text.upper().strip().replace(" ", "")
 
-            send_message("New game ID is **%s** (you can use this to **`!resume`** an unfinished game if something goes wrong)." % (game_id))
-            
-            if TESTING: print("No existing defense message.  Assuming new game starting.")
+        if msg.user.id != my_user.id: #If the bot is posting a "defending" message, it's resuming a saved game, so skip all this.
+            # Unpin the existing "defending" message
+            if self.defending_message is not None:
+                self.outgoing.perform(self.defending_message.cancel_stars)
+            # If there isn't one, this is the start of a new game.
+            else:
+                self.reset()
+                self.waves = {}
 
-        defender_id = msg.user.id
-        defender_name = msg.user.name
-        defending_timestamp = msg.time_stamp
+                # We need the new game ID right away, so wait for it to be written.
+                self.game_id = contact_db.execute('INSERT INTO game (DefenderId, DefenderName, StartTimeUTC, RoomId) values (?, ?, ?, ?)', (msg.user.id, msg.user.name, datetime.utcnow(), self.room.id)).result()
+                self.record(eventlog.GameStarted, self.game_id, msg.user.id, msg.user.name)
 
-        db = sqlite3.connect('Contact.db')
-        cursor = db.cursor()
-        cursor.execute('INSERT INTO defence (Text, GameId, ChatId, StartTimeUTC) values (?, ?, ?, ?)', (defending_text, game_id, msg.message.id, datetime.utcnow()))
-        defence_id = cursor.lastrowid
-        db.commit()
-        db.close()
-        
-        # Set all extant clues to "uncertain" status
-        for clue in clues.itervalues():
-            clue.set_state(Clue_state.Schroedinger)
+                self.send_message("New game ID is **%s** (you can use this to **`!resume`** an unfinished game if something goes wrong)." % (self.game_id))
 
-    # Set the globals that have the defence data
-    defending_message = msg.message
-    set_game_state(Game_state.Guessing)
-    
-    time.sleep(1.1)
-    toggle_pinning(msg.message) # Pin the new "defending" message
-    
-            
-            
-# Helper function to invalidate a clue
-def remove_clue(clue, new_clue_state, new_game_state = None, user = None):
-    clue.set_state(new_clue_state)
-    dead_clues.append(clue)
-    message = clue.message # Temporary copy of message, to be used for unstarring below
-
-    # Add this clue to the database
-    db = sqlite3.connect('Contact.db')
-    if new_clue_state == Clue_state.Solved and user != None:
-        db.execute('UPDATE clue SET SolverId = ?, SolverName = ?, Solution = ?, DeathTimeUTC = ? WHERE Id = ?',
-                    (user.id, user.name, clue.guess, datetime.utcnow(), clue.db_id))
-    else:
-        db.execute('UPDATE clue SET DeathTimeUTC = ? WHERE Id = ?',
-                    (datetime.utcnow(), clue.db_id))
-    db.commit()
-    db.close()
-    
-    # If the game is over, we don't bother deleting individual clues; we'll just ditch the whole dictionary.
-    if new_game_state != Game_state.Finished:
-        del clues[clue.number] # Remove the clue from the list of active clues
-    
-    # Only cancel the star if there are no other clues in the same message (e.g. "4,5: Fifth space on a Monopoly board" for READING RAILROAD)
-    if not message.deleted and (not any([clue.message == message for clue in clues.itervalues()]) or new_game_state == Game_state.Finished):
-        message.cancel_stars()
-    if new_game_state is not None:
-        set_game_state(new_game_state)
-
-# The defender's word has been guessed.  End the game.
-def end_game(word = None):
-    last_clue = last_clue_solved if last_clue_solved is not None else last_clue_guessed
-    if last_clue is not None:
-        last_clue.set_state(Clue_state.Solved)
-        if word is not None:
-            send_message("Game over! %s wins with the clue **%s**, guessed by %s.  The solution (and presumably %s's word) was **%s**." % (last_clue.setter_name, html_to_markdown(last_clue.clue_text), last_clue.guesser_name, defender_name, word))
-
-    set_game_state(Game_state.Finished)
-
-    # Update game data in database
-    db = sqlite3.connect('Contact.db')
-    db.execute('UPDATE game SET EndTimeUTC = ?, WordDefended = ? WHERE Id = ?', (datetime.utcnow(), word, game_id))
-    db.commit()
-    db.close()
-    
-    # Since we're going to remove all pinned clues, display the remaining clues so people can discuss the answers if so desired.
-    if len(clues) > 0:
-        send_message("Remaining clues (for reference):")
-        display_clues(False)
+                if TESTING: print("No existing defense message.  Assuming new game starting.")
 
-    old_game_id = game_id
-    
-    # "Kill" all remaining clues, and unstar them.  Also update them in the database
-    reset()
-    game_stats(old_game_id)
+            self.defender_id = msg.user.id
+            self.defender_name = msg.user.name
+            self.defending_timestamp = msg.time_stamp
 
-def game_stats(id):
-    send_message("Stats for game #%s:\n" % (id))
-    message = ""
-    try:
-        db = sqlite3.connect('Contact.db')
-        row = db.execute("SELECT DefenderName, EndTimeUTC, StartTimeUTC from game WHERE Id = ?", (id,)).fetchall()[0]
-        message += "      Defender:          %s\n" % (row[0])
-
-        end_time = datetime.utcnow() if row[1] is None else datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S.%f")
-        total_seconds = (end_time - datetime.strptime(row[2], "%Y-%m-%d %H:%M:%S.%f")).total_seconds()
-        hours = total_seconds // 3600
-        minutes = total_seconds % 3600 // 60
-        seconds = total_seconds % 60
-        message += "      Duration:          %s%s%s\n" % ( (("%dh " % (hours)) if hours > 0 else ""), (("%dm " % (minutes)) if hours + minutes > 0 else ""), (("%ds" % (seconds)) if seconds > 0 else "") )
-        
-        row = db.execute("""SELECT COUNT(DISTINCT Id) AS Players from
-            (SELECT DISTINCT SetterId AS Id FROM clue WHERE GameId = ?
-                UNION ALL SELECT DISTINCT SolverId FROM clue WHERE GameId = ?
-                UNION ALL SELECT DISTINCT ContacterId FROM contact INNER JOIN clue ON contact.ClueId = Clue.Id WHERE GameId = ?
-                UNION ALL SELECT DISTINCT DefenderId FROM game WHERE Id = ?
-            ) 
-            WHERE Id IS NOT NULL""", (id, id, id, id)).fetchall()[0]
-        message += "      Players:           %d\n" % (row[0])
-
-        rows = db.execute("SELECT Solution FROM clue WHERE GameId = ?", (id,)).fetchall()
-        message += "      Clues:             %d\n" % (len(rows))
-        message += "      %% clues solved:    %.1f\n" % (len(list(filter(lambda row: row[0] is not None, rows))) * 100 / float(len(rows)))
-
-        rows = db.execute("SELECT COUNT(DefenceId) FROM clue LEFT JOIN defence ON clue.DefenceId = defence.Id WHERE defence.GameId = ? GROUP BY DefenceId", (id,)).fetchall()
-        message += "      Avg. clues/letter: %.1f\n" % (sum(row[0] for row in rows) / float(len(rows)))
-    except:
-        print(sys.exc_info())
-        message = "Unable to retrieve game statistics.  An error occurred: %s" % (sys.exc_info())
-        
-    send_message(message)
+            self.defence_id = contact_db.execute('INSERT INTO defence (Text, GameId, ChatId, StartTimeUTC) values (?, ?, ?, ?)', (self.defending_text, self.game_id, msg.message.id, datetime.utcnow()))
 
-# Load an unfinished game from the database, so it can be resumed.
-def load_game(number):
-    global defender_id, defender_name, defending_text, clues, defending_message, game_id
-    
-    number = number.strip()
-    if game_state != Game_state.Finished and game_state != Game_state.None:
-        send_message("You can't resume a game when you're in the middle of another.  If the current game is over, you can use **`!gameover`** to let me know.")
-        return
-    elif number is None or number == "":
-        send_message("Command syntax: **`!resume `*`<gameNumber>`***.  You were given a game number when the game began (when the defender posted the first letter).")
-        return
+            # Set all extant clues to "uncertain" status
+            for clue in self.clues.itervalues():
+                clue.set_state(Clue_state.Schroedinger)
+            self.record(eventlog.Defended, self.defending_text, msg.message.id)
 
-    db = sqlite3.connect('Contact.db')
-    results = db.execute('SELECT DefenderId, DefenderName, EndTimeUTC from game WHERE Id = ?', (number,))
-    rows = results.fetchall()
-    if not rows:
-        send_message("I couldn't find a game with ID **%s**.  Sorry, but it can't be resumed." % (number))
-    elif rows[0][2] is not None: #The game has an EndTime; it's already finished
-        send_message("Game #%s has already been completed.  It cannot be resumed." % (number))
-    else:
-        set_game_state(Game_state.Guessing)
-        defender_id = rows[0][0]
-        defender_name = rows[0][1]
-        
-        results = db.execute('SELECT Text, ChatId FROM defence WHERE GameId = ? ORDER BY StartTimeUTC DESC LIMIT 1', (number,))
-        rows = results.fetchall()
-        if rows:
-            defending_text = rows[0][0]
-            send_message("%s defending: **%s**" % (defender_name, defending_text))
-            
-        results = db.execute('SELECT ClueNumber, SetterId, SetterName, Text, Id FROM clue WHERE GameId = ? AND DeathTimeUTC IS NULL', (number,))
-        rows = results.fetchall()
-        if rows:
-            for row in rows:
-                c = clue()
-                c.number = row[0]
-                c.setter_id  = row[1]
-                c.setter_name = row[2]
-                c.clue_text = row[3]
-                c.db_id = row[4]
-                #c.message = client.get_message(row[3])
-                #c.message.star()
-                c.set_state(Clue_state.Set)
-                clues[row[0]] = c
-                send_message("%s: **%s** (*by %s*)" % (row[0], html_to_markdown(c.clue_text), c.setter_name))
-                
-        query = 'SELECT ContacterId, ContacterName, ClueId FROM contact WHERE ClueId IN (%s)' % (", ".join(['?'] * len(clues.keys())))
-        results = db.execute(query, (clues.keys()))
-        rows = results.fetchall()
-        if rows:
-            for row in rows:
-                for cl in clues.itervalues():
-                    if cl.db_id == row[2]:
-                        cl.contacts[row[0]] = row[1]
-        
-        game_id = number
-        send_message("Game #%s restored.  Note that any pending passes or guesses were not restored.  Play on!" % (number))
-
-# List active clues, along with their status
-def display_clues(only_unstarred):
-    clue_list = []
-    for c in sorted(clues.itervalues(), key=lambda cl: cl.timestamp, reverse=True):
-        # Loop through all clues, or only those without a star, depending on the value of only_unstarred
-        if c.message.stars == 0 or not only_unstarred:
-            this_clue = "%s : %s (by %s)" % (c.number, html_to_markdown(c.clue_text), c.setter_name)
-            if c.guess != "":
-                this_clue += " (waiting for confirmation of guess %s by %s)" % (c.guess, c.guesser_name)
-            if len(c.contacts) > 0: # Clue has been contacted
-                this_clue += " (contacted by %s)" % (", ".join(user for user in c.contacts.values()))
-            if c.state == Clue_state.Schroedinger: # Clue owner hasn't confirmed alive/dead.
-                this_clue += " (status uncertain)"
-            clue_list.append(this_clue)
-    if len(clue_list) > 0:
-        send_message("\n".join(clue_list), False) # No length check; message could easily be over 500 chars, and that's ok.
-    elif only_unstarred:
-        send_message("There are no active unstarred clues.  (Good work!)")
-    else:
-        send_message("There are no active clues." )
-    
-# List the contacts for a given clue or for all clues    
-def display_contacts(command):
+            if word_list is not None and word_list.count(self.defending_text) == 0:
+                self.send_message("No word in my dictionary starts with **%s**.  Is that right?" % (self.defending_text))
 
-    #Display contacts for a specific clue.
-    if len(command) > 9:
-        number = command[10:]
-        
-        # Try converting the text after "!contacts" (minus apostrophes) into a number. If it doesn't work, the command is invalid.
-        try: 
-            c = float(number.replace("'", "")) # Remove apostrophes before trying to convert to float
-        except:
-            send_message("Syntax of the **`!contacts`** command:  **`!contacts <optional clue number>`**")
-        
-        if c is not None: # We got a valid number
-            if TESTING: print(clues.keys())
-            if TESTING: print(number)
-            if number not in clues.keys():
-                send_message("There is no active clue with the number %s" % (number))
-            elif len(clues[number].contacts) == 0:
-                send_message("There are no current contacts for clue number %s" % (number))
-            else:
-                send_message("Clue #%s is currently contacted by: %s" % (number, ", ".join(user for user in clues[number].contacts.values())))
-    
-    else: #Display all clues and contacts
-        output = ""
-        for c in clues.keys():
-            if len(clues[c].contacts) > 0:
-                output += "  #%s by %s\n" % (c, ", ".join(user for user in clues[c].contacts.values()))
-        # Add a message if there are no contacts
-        if output == "":
-            snark = ""
-            if len(clues) == 0:
-                snark = ", which makes sense, since there are *no active clues*"
-            send_message("There are currently **no** contacted clues%s!  C'mon, people!  Pick it up!" % (snark))
-            if len(clues) > 10:
-                send_message("Maybe stop trying to come up with *more clues*, and try to solve some of the existing ones instead?")
+        # Set the globals that have the defence data
+        self.defending_message = msg.message
+        self.set_game_state(Game_state.Guessing)
+
+        self.toggle_pinning(msg.message) # Pin the new "defending" message
+
+    # Helper function to invalidate a clue
+    def remove_clue(self, clue, new_clue_state, new_game_state = None, user = None):
+        clue.set_state(new_clue_state)
+        if clue.guess_timer is not None: # No need to remind anyone about the guess any more
+            clue.guess_timer.cancel()
+        solved = (new_clue_state == Clue_state.Solved and user != None)
+        self.dead_clues.append(game.dead_clue(clue.number, clue.clue_text, clue.setter_name, user.name if solved else None, clue.guess if solved else None))
+        message = clue.message # Temporary copy of message, to be used for unstarring below
+
+        # Add this clue to the database
+        if new_clue_state == Clue_state.Solved and user != None:
+            contact_db.execute('UPDATE clue SET SolverId = ?, SolverName = ?, Solution = ?, DeathTimeUTC = ? WHERE Id = ?',
+                        (user.id, user.name, clue.guess, datetime.utcnow(), clue.db_id))
+            add_player_stats(clue.setter_id, clue.setter_name, CluesSolved=1)
+            for contacter_id, contacter_name in clue.contacts.iteritems():
+                add_player_stats(contacter_id, contacter_name, SuccessfulContacts=1)
         else:
-            send_message("The following clues are currently contacted:\n" + output)
-
-# Reset the game state.  Unstar any messages from the previous game.
-def reset():
-    global defending_message, defending_timestamp, defender, defender_id, clues, dead_clues, game_id, num_contact_guesses, pass_with_no_contact
-    for c in clues.itervalues():
-        remove_clue(c, Clue_state.Dead, Game_state.Finished)
-    if defending_message is not None:
-        defending_message.cancel_stars()
-    clues = {}
-    dead_clues = []
-    defending_message = None
-    defending_timestamp = None
-    defender = ""
-    defender_id = -1
-    pass_with_no_contact = False
-    num_contact_guesses = 0
-    game_id = -1
-
-# Move to a different game state, as defined by the Game_state enum
-def set_game_state(state):
-    global game_state
-    game_state = state
-    print("Game state changed to %s" % (state))
-
-# Post a message to the room, provided the bot has not been told to !shutup
-# By default, the message can't be more than 500 characters, or it will fail silently.  Setting length_check to False allows longer messages.
-def send_message(message, length_check=True):
-    global recent_messages
-    
-    # Prune any old entries from the list of recent messages.
-    messages_to_keep = {}
-    for old_message, time in recent_messages.iteritems():
-        if (datetime.utcnow() - time).total_seconds() <= MESSAGE_DUPE_DELAY:
-            messages_to_keep[old_message] = time
-    recent_messages = messages_to_keep
-            
-    # Don't continue if we've recently posted the same message
-    if message in recent_messages.iterkeys():
-        return;
-        
-    # Add this message to the list of recently-posted messages
-    recent_messages[message] = datetime.utcnow()
-    
-    # Post the message, if we're not muted.
-    if muted_timestamp is None or (datetime.utcnow() - muted_timestamp).total_seconds() > mute_length:
-        room.send_message(message, length_check)
-
-# Stop the bot from posting any messages to the room.
-# Can specify a time period (in minutes) or use the default of 10.
-def mute(input):
-    global muted_timestamp, mute_length
-    minutes = 10
-    if len(input) > 7: # Number of minutes has been specified
-        arg = input[8:]
-        # If number of minutes can't be converted to a float, it wasn't entered correctly.
+            contact_db.execute('UPDATE clue SET DeathTimeUTC = ? WHERE Id = ?',
+                        (datetime.utcnow(), clue.db_id))
+
+        # If the game is over, we don't bother deleting individual clues; we'll just clear the whole list.
+        if new_game_state != Game_state.Finished:
+            self.clues.remove(clue) # Remove the clue from the list of active clues
+
+        # Only cancel the star if there are no other clues in the same message (e.g. "4,5: Fifth space on a Monopoly board" for READING RAILROAD)
+        if message is not None and not message.deleted and (not self.clues.by_message(message) or new_game_state == Game_state.Finished):
+            self.outgoing.perform(message.cancel_stars)
+        clue.message = None # We don't need the chat message any more, so don't hold on to it
+        self.record(eventlog.ClueRemoved, clue.number, new_clue_state, user.id if solved else None, user.name if solved else None)
+        if new_game_state is not None:
+            self.set_game_state(new_game_state)
+
+    # The defender's word has been guessed.  End the game.
+    def end_game(self, word = None):
+        last_clue = self.last_clue_solved if self.last_clue_solved is not None else self.last_clue_guessed
+        if last_clue is not None:
+            last_clue.set_state(Clue_state.Solved)
+            if word is not None:
+                self.send_message("Game over! %s wins with the clue **%s**, guessed by %s.  The solution (and presumably %s's word) was **%s**." % (last_clue.setter_name, last_clue.markdown, last_clue.guesser_name, self.defender_name, word))
+
+        self.record(eventlog.GameEnded, word)
+        self.set_game_state(Game_state.Finished)
+
+        # Update game data in database
+        contact_db.execute('UPDATE game SET EndTimeUTC = ?, WordDefended = ? WHERE Id = ?', (datetime.utcnow(), word, self.game_id))
+        if self.game_id != -1 and self.defender_id != -1:
+            add_player_stats(self.defender_id, self.defender_name, GamesDefended=1, DefenceLetters=len(self.defending_text))
+            contact_db.execute(DEFENCE_SECONDS_UPDATE, (self.game_id, self.defender_id))
+
+        # Since we're going to remove all pinned clues, display the remaining clues so people can discuss the answers if so desired.
+        if len(self.clues) > 0:
+            self.send_message("Remaining clues (for reference):")
+            self.display_clues(False)
+
+        old_game_id = self.game_id
+
+        # "Kill" all remaining clues, and unstar them.  Also update them in the database
+        self.reset()
+        summarize_game(old_game_id)
+        self.game_stats(old_game_id)
+
+    def game_stats(self, id):
+        side_work.submit(self.report_stats, id)
+
+    # The statistics for game_stats.  Runs on the side_work pool, since working them out for a game in progress can take a while.
+    def report_stats(self, id):
+        message = ""
         try:
-            minutes = float(arg)
+            # Finished games have their statistics stored; only games in progress need to be worked out from scratch.
+            rows = contact_db.query("SELECT GameId, DefenderName, StartTimeUTC, EndTimeUTC, Players, Clues, CluesSolved, DefenceClues, Defences FROM game_summary WHERE GameId = ?", (id,))
+            if not rows:
+                rows = contact_db.query(GAME_SUMMARY_QUERY + " WHERE game.Id = ?", (id,))
+            if not rows:
+                self.post("I couldn't find a game with ID **%s**." % (id))
+                return
+            (game_id, defender_name, start_time, end_time, players, num_clues, clues_solved, defence_clues, defences) = rows[0]
+            message += "      Defender:          %s\n" % (defender_name)
+
+            end_time = datetime.utcnow() if end_time is None else parse_utc(end_time)
+            total_seconds = (end_time - parse_utc(start_time)).total_seconds()
+            hours = total_seconds // 3600
+            minutes = total_seconds % 3600 // 60
+            seconds = total_seconds % 60
+            message += "      Duration:          %s%s%s\n" % ( (("%dh " % (hours)) if hours > 0 else ""), (("%dm " % (minutes)) if hours + minutes > 0 else ""), (("%ds" % (seconds)) if seconds > 0 else "") )
+            message += "      Players:           %d\n" % (players)
+            message += "      Clues:             %d\n" % (num_clues)
+            message += "      %% clues solved:    %s\n" % (("%.1f" % (clues_solved * 100 / float(num_clues))) if num_clues > 0 else "-")
+            message += "      Avg. clues/letter: %s\n" % (("%.1f" % (defence_clues / float(defences))) if defences > 0 else "-")
         except:
-            send_message("You must specify a number of minutes, or just use **`!shutup`** on its own to default to 10 minutes.")
-            
-    mute_length = minutes * 60
-    send_message("Ok, I won't say anything else for %s minutes, unless you tell me to **`!speak`**.  I will continue to star/unstar clues as I'm able, and I'll still keep track of the game." % (minutes))
-    muted_timestamp = datetime.utcnow()
-    log("info", "Muted for %s minutes." % (minutes))
-
-# If the bot has been muted, cancel the mute.    
-def unmute():
-    global muted_timestamp, mute_length
-    muted_timestamp = None
-    mute_length = 600
-    send_message("Your wish is my command.  What can I do for you?")
-
-# Disable extraneous messages from the bot.  Only messages directly related to gameplay will be posted.
-def toggle_verbosity(setting):
-    global verbose
-    if setting == "0" or setting == "off":
-        verbose = False
-        send_message("Ok. After this, I'll only speak if you really need to know something. You can make me more chatty with **`!verbose on`**. Or you can silence me entirely with **`!shutup`**.")
-    elif setting == "1" or setting == "on":
-        verbose = True
-        send_message("Ok. I love talking!  We can talk about all sorts of things!  I love Contact.  Do you?  Do you like defending or attacking better?  I'm never sure which one I like the most, but being a bot, I'll probably never get a chance to do either.  So sad. In verbose mode, I'll make sure to inform you whenever you're out of line, keep you abreast of game developments, and maybe throw in a few witticisms here and there just for fun. I love to talk! (**`!verbose off`** turns off verbose mode.)")
-    elif setting is None or setting == "":
-        send_message("Verbose mode is currently %s. You can turn it %s with **`!verbose %s`**." % ("on" if verbose else "off", "off" if verbose else "on", "off" if verbose else "on"))
-    else:
-        send_message("Usage: **`!verbose [on|off]`**.")
-
-# Check for clues with "uncertain" status (haven't been confirmed alive/dead after a new letter has been given).
-# If it's been long enough since the new letter has been given, remind the setter that they need to indicate whether the clue is still alive.
-def check_clue_status():
-    users_to_warn = {} # Make a list so we don't give multiple warnings for multiple clues by the same user
-    for clue in clues.itervalues():
-        if clue.state == Clue_state.Schroedinger and not clue.warned and (datetime.utcnow() - clue.state_timestamp).total_seconds() > SCHROEDINGER_TIMEOUT:
-            setter = clue.setter_name.replace(" ", "") # We're pinging them, so no spaces.
-
-            # Either make a new list or add to the existing one.
-            if setter not in users_to_warn:
-                users_to_warn[setter] = [clue.number]
+            print(sys.exc_info())
+            message = "Unable to retrieve game statistics.  An error occurred: %s" % (sys.exc_info()[1],)
+
+        self.post(("Stats for game #%s:\n" % (id), message))
+
+    # The best players, by one of the LEADERBOARDS.  Worked out on the side_work pool.
+    def leaderboard(self, board):
+        board = board.lower() or "setters"
+        if board not in LEADERBOARDS:
+            self.send_message("Usage: **`!leaderboard [%s]`**" % ("|".join(LEADERBOARDS)))
+            return
+        def finish():
+            order, columns = LEADERBOARDS[board]
+            rows = contact_db.query("SELECT UserName, %s FROM player_stats WHERE %s > 0 ORDER BY %s DESC, UserName LIMIT %d" % (", ".join(sql for heading, sql in columns), order, order, LEADERBOARD_SIZE))
+            if not rows:
+                self.post("There are no statistics yet.")
+                return
+            lines = ["%-20s" % ("Player") + "".join(" %12s" % (heading) for heading, sql in columns)]
+            for row in rows:
+                lines.append("%-20s" % (row[0][:20]) + "".join(" %12s" % (format_stat(value)) for value in row[1:]))
+            self.post("\n".join("    " + line for line in lines), False) # Indented, so it's shown in a fixed-width font
+        side_work.submit(finish)
+
+    # A player's statistics, across all games.  The player is given by chat ID or name.
+    def player_stats(self, who):
+        def finish():
+            if who.isdigit():
+                rows = contact_db.query(PLAYER_STATS_QUERY + " WHERE UserId = ?", (int(who),))
             else:
-                users_to_warn[setter].append(clue.number)
-            clue.warned = True # So that we don't keep warning about the same clue
-            
-    # Send one message for each user who has outstanding clues
-    for setter in users_to_warn.iterkeys():
-        nums = users_to_warn[setter] # All clues for this user
-        # Get the proper wording for one vs. many clues
-        clue_text = "clue #%s is" % (nums[0])
-        if len(nums) > 1:
-            clue_text = "clues #%s and #%s are" % (", #".join(number for number in nums[0:len(nums) - 1]), nums[len(nums) - 1]) # Join all but the last, then put the last one after the "and"
-        send_message("@%s, it's been more than %s minutes since %s provided a new letter, and you still haven't indicated whether %s alive or dead." % (setter, SCHROEDINGER_TIMEOUT / 60.0, defender_name, clue_text))
-
-# Check for guesses that haven't been responded to.  If enough time has elapsed since the guess was made, notify the clue setter.
-def check_guess_status():
-    for clue in clues.itervalues():
-        if clue.guess != "" and clue.guess_warned == False and (datetime.utcnow() - clue.guess_timestamp).total_seconds() > GUESS_TIMEOUT:
-            send_message("@%s, %s guessed *%s* for clue #%s.  Please confirm or deny the guess." % (clue.setter_name.replace(" ", ""), clue.guesser_name, clue.guess, clue.number))
-            clue.guess_warned = True
-            
-# Monitor the "waves" ("o/", "O/", "0/", etc.) posted in the room.
-# If several people wave (indicating a desire to play) within a certain time period, intiate a "ping" (notify all users on the pinglist).
-def check_waves():
-    wavecount = 0
-    # Check how many waves occurred in the last while (wave timestamps are recorded when they are posted)
-    for wave in waves.itervalues():
-        if (datetime.utcnow() - wave).total_seconds() < WAVE_DEATH:  # Within the time specified by WAVE_DEATH
-            wavecount += 1
-    if wavecount > WAVES_FOR_PING:  # We have enough waves
-        send_message("There are %s people waiting to play Contact!  Want to join?" % (wavecount))
-        ping() # Ping everyone on the pinglist
-
-# Print a help message
-def info():
-    send_message("Hello! I'm %s, a bot to help with the game of Contact.\nI will try to keep track of the game state and keep the game moving. If you're on my whitelist, you can use the following commands to communicate with me (some are mod-only):" % (my_user.name))
-    send_message("""     !clues                      - list all active clues
-     !contacts [<clueNum>]       - list contacts for a specific clue or all clues
-     !unpass                     - undo a "pass" if you made a mistake
-     !kill                       - remove a clue from the list of active clues. This will kill anyone's clue, not just your own.
-     !gameover                   - ends a game, resetting my data
-     !uncontact <clueNum>        - remove all contacts for clue <clueNum>
-     !shutup [<minutes>]         - silence me completely for the specified amount of time (defaults to 10 min)
-     !speak                      - undo a !shutup command
-     !verbose [on|off]           - in verbose mode, I'll comment more on game events. No parameter lists the current state
-     !resume <gameNum>           - if I died or a game was otherwise interrupted, restore the game state
-     !stats <gameNum>            - displays some some statistical information for the specified game
-     !gameover                   - immediately ends the current game, removing clues and displaying statistics for the game
-     !whitelist [[+|-]<userNum>] - add/remove a user from the whitelist, or list users on the whitelist
-     !pinglist [[+|-]<userName>] - add/remove a user from the pinglist, or list users on the pinglist
-     !ping                       - ping all users on the pinglist to indicate that you want to start a game
-     !shutdown                   - shut me down permanently. I will need to be restarted by the bot owner""", False)
-
-def modify_list(list_var, param, table_name):
-    if param != "":
-        if param[0] == "+":
-            add_list(list_var, param[1:], table_name)
-        elif param[0] == "-":
-            remove_list(list_var, param[1:], table_name)
-        else:
-            add_list(list_var, param, table_name)
-    else:
-        show_list(list_var)
+                rows = contact_db.query(PLAYER_STATS_QUERY + " WHERE UserName = ? COLLATE NOCASE", (who.lstrip("@"),))
+            if not rows:
+                self.post("I don't have any statistics for %s." % (who))
+                return
+            (user_id, user_name, clues_set, clues_solved, contacts, successful_contacts, games_defended, defence_letters, defence_seconds) = rows[0]
+            message = "Stats for %s:\n" % (user_name)
+            message += "      Clues set:           %d\n" % (clues_set)
+            message += "      %% clues solved:      %s\n" % (("%.1f" % (clues_solved * 100 / float(clues_set))) if clues_set > 0 else "-")
+            message += "      Contacts:            %d\n" % (contacts)
+            message += "      Successful contacts: %d\n" % (successful_contacts)
+            message += "      Games defended:      %d\n" % (games_defended)
+            if games_defended > 0:
+                minutes = defence_seconds / games_defended // 60
+                message += "      Avg. defence:        %.1f letters, %dh %dm\n" % (defence_letters / float(games_defended), minutes // 60, minutes % 60)
+            self.post(message)
+        side_work.submit(finish)
+
+    # Load an unfinished game from the database, so it can be resumed.
+    def load_game(self, number):
 
-def add_list(list_var, param, table_name):
-    list_var.add(param)
-    try:
-        send_message("Adding %s to the %s." % (str(param) + " (" + client.get_user(int(param)).name + ")", table_name))
-    except:
-        send_message("Adding %s to the %s." % (param, table_name))
+        number = number.strip()
+        if self.game_state != Game_state.Finished and self.game_state != Game_state.None:
+            self.send_message("You can't resume a game when you're in the middle of another.  If the current game is over, you can use **`!gameover`** to let me know.")
+            return
+        elif number is None or number == "":
+            self.send_message("Command syntax: **`!resume `*`<gameNumber>`***.  You were given a game number when the game began (when the defender posted the first letter).")
+            return
+
+        # The queries run on the side_work pool, so the game's worker carries on with other events meanwhile.
+        def fetch():
+            game_rows = contact_db.query('SELECT DefenderId, DefenderName, EndTimeUTC, RoomId from game WHERE Id = ?', (number,))
+            defence_rows = clue_rows = []
+            if game_rows and game_rows[0][2] is None:
+                defence_rows = contact_db.query('SELECT Text, ChatId, Id FROM defence WHERE GameId = ? ORDER BY StartTimeUTC DESC LIMIT 1', (number,))
+                # Fetch the live clues and their contacts together; a clue with no contacts comes back as one row with NULL contact columns.
+                clue_rows = contact_db.query(RESTORE_CLUES_QUERY, (number,))
+            self.worker.submit(self.resume_game, number, game_rows, defence_rows, clue_rows)
+        side_work.submit(fetch)
+
+    # The second half of load_game: restore the game from what was read from the database.  Runs on the worker.
+    def resume_game(self, number, rows, defence_rows, clue_rows):
+        if not rows:
+            self.send_message("I couldn't find a game with ID **%s**.  Sorry, but it can't be resumed." % (number))
+        elif rows[0][3] is not None and rows[0][3] != int(self.room.id):
+            self.send_message("Game #%s was played in another room.  It can only be resumed there." % (number))
+        elif rows[0][2] is not None: #The game has an EndTime; it's already finished
+            self.send_message("Game #%s has already been completed.  It cannot be resumed." % (number))
+        elif self.game_state != Game_state.Finished and self.game_state != Game_state.None: # A game started while the queries ran
+            self.send_message("You can't resume a game when you're in the middle of another.  If the current game is over, you can use **`!gameover`** to let me know.")
+        else:
+            self.set_game_state(Game_state.Guessing)
+            self.defender_id = rows[0][0]
+            self.defender_name = rows[0][1]
+
+            if defence_rows:
+                self.defending_text = defence_rows[0][0]
+                self.defence_id = defence_rows[0][2]
+                self.send_message("%s defending: **%s**" % (self.defender_name, self.defending_text))
+
+            restored = collections.OrderedDict() # clue.Id -> clue, in the order the clues were set
+            for clue_id, clue_number, setter_id, setter_name, text, post_time, contacter_id, contacter_name in clue_rows:
+                c = restored.get(clue_id)
+                if c is None:
+                    c = restored[clue_id] = clue()
+                    c.number = clue_number
+                    c.setter_id = setter_id
+                    c.setter_name = setter_name
+                    c.clue_text = text
+                    if post_time is not None: # Chat timestamps are seconds since the epoch
+                        c.timestamp = calendar.timegm(parse_utc(post_time).utctimetuple())
+                    c.db_id = clue_id
+                if contacter_id is not None:
+                    c.contacts[contacter_id] = contacter_name
+
+            # The clues are reposted in a single message.  When it comes back to us, it's attached to the clues and starred (see on_restored_clues).
+            self.record(eventlog.GameResumed, number, self.defender_id, self.defender_name, self.defending_text)
+            clue_list = []
+            for c in restored.itervalues():
+                c.set_state(Clue_state.Set)
+                self.clues.add(c)
+                self.record(eventlog.ClueSet, c.number, c.setter_id, c.setter_name, c.clue_text, None)
+                for user_id, user_name in c.contacts.iteritems():
+                    self.record(eventlog.Contacted, c.number, user_id, user_name)
+                clue_list.append("%s: %s (by %s)" % (c.number, c.markdown, c.setter_name))
+            if clue_list:
+                self.send_message("Restored clues for game #%s:\n%s" % (number, "\n".join(clue_list)), False)
+
+            self.game_id = number
+            self.send_message("Game #%s restored.  Note that any pending passes or guesses were not restored.  Play on!" % (number))
+
+    # The bot's list of restored clues has been posted: it becomes the message for those clues, and gets starred.
+    def attach_restored_clues(self, msg):
+        restored = [c for c in self.clues.itervalues() if c.message is None]
+        if not restored:
+            return
+        for c in restored:
+            c.message = msg.message
+        #Hack to star our own message:  Pin, then unpin (the outbox spaces the two out)
+        self.toggle_pinning(msg.message)
+        self.toggle_pinning(msg.message)
+
+    # The current state of the game, as something that can be written out by snapshot.save().  Called holding the game's lock.
+    def capture_snapshot(self):
+        # Any rows still waiting to be committed are left out, so take another snapshot soon, once they have been.
+        if any(isinstance(value, database.future) and not value.done() for value in [self.game_id, self.defence_id] + [c.db_id for c in self.clues.itervalues()]):
+            self.snapshots.mark()
+        last_clues = [capture_clue(c) if c is not None else None for c in (self.last_clue_solved, self.last_clue_guessed)]
+        return {
+            "version": SNAPSHOT_VERSION,
+            "game_state": self.game_state, "game_id": row_id(self.game_id), "defence_id": row_id(self.defence_id),
+            "defender_id": self.defender_id, "defender_name": self.defender_name, "defending_text": self.defending_text,
+            "defending_message": self.defending_message.id if self.defending_message is not None else None, "defending_timestamp": self.defending_timestamp,
+            "clues": [capture_clue(c) for c in self.clues.itervalues()], "dead_clues": list(self.dead_clues),
+            "last_clue_solved": last_clues[0], "last_clue_guessed": last_clues[1],
+            "pass_with_no_contact": self.pass_with_no_contact, "num_contact_guesses": self.num_contact_guesses,
+            "verbose": self.verbose, "muted_timestamp": snapshot_time(self.muted_timestamp), "mute_length": self.mute_length,
+            "waves": [(user_id, snapshot_time(timestamp)) for user_id, timestamp in self.waves.iteritems()],
+        }
+
+    # Put the game back the way it was when the snapshot was saved.  Called holding the game's lock, before we start watching the room.
+    def restore_snapshot(self, state):
+        if state is None or state.get("version") != SNAPSHOT_VERSION:
+            return
+
+        self.verbose = state["verbose"]
+        self.muted_timestamp = restored_time(state["muted_timestamp"])
+        self.mute_length = state["mute_length"]
+        now = datetime.utcnow()
+        for user_id, timestamp in state["waves"]:
+            timestamp = restored_time(timestamp)
+            remaining = WAVE_DEATH - (now - timestamp).total_seconds()
+            if remaining > 0:
+                self.waves[user_id] = timestamp
+                self.call_later(remaining, self.expire_wave, user_id, timestamp)
+
+        if state["game_state"] in (Game_state.None, Game_state.Finished):
+            return
+        self.game_id = state["game_id"]
+        self.defence_id = state["defence_id"]
+        self.defender_id = state["defender_id"]
+        self.defender_name = state["defender_name"]
+        self.defending_text = state["defending_text"]
+        if state["defending_message"] is not None:
+            self.defending_message = client.get_message(state["defending_message"])
+        self.defending_timestamp = state["defending_timestamp"]
+        self.pass_with_no_contact = state["pass_with_no_contact"]
+        self.num_contact_guesses = state["num_contact_guesses"]
+        self.dead_clues.extend(game.dead_clue(*record) for record in state["dead_clues"])
+
+        for data in state["clues"]:
+            c = restore_clue(data)
+            self.clues.add(c)
+            # Start the reminders over, as if the clue had just entered its state (and the guess had just been made).
+            self.clue_state_changed(c, None)
+            self.clue_guess_changed(c)
+
+        # The last clue solved/guessed is usually still active; if so, it has to be the same clue object.
+        def restore_last(data):
+            if data is None:
+                return None
+            active = self.clues.get(data["number"])
+            return active if active is not None and active.db_id == data["db_id"] else restore_clue(data)
+        self.last_clue_solved = restore_last(state["last_clue_solved"])
+        self.last_clue_guessed = restore_last(state["last_clue_guessed"])
+
+        self.set_game_state(state["game_state"])
+        log('info', "Restored game #%s from %s, with %s active clues." % (self.game_id, self.snapshot_file, len(self.clues)))
+        self.send_message("I'm back!  Game #%s has been restored, and you can carry on where you left off." % (self.game_id))
+
+    # List active clues, along with their status
+    def display_clues(self, only_unstarred):
+        clue_list = []
+        for c in sorted(self.clues.itervalues(), key=lambda cl: cl.timestamp, reverse=True):
+            # Loop through all clues, or only those without a star, depending on the value of only_unstarred
+            if c.message is None or c.message.stars == 0 or not only_unstarred:
+                this_clue = "%s : %s (by %s)" % (c.number, c.markdown, c.setter_name)
+                if c.guess != "":
+                    this_clue += " (waiting for confirmation of guess %s by %s)" % (c.guess, c.guesser_name)
+                if len(c.contacts) > 0: # Clue has been contacted
+                    this_clue += " (contacted by %s)" % (", ".join(user for user in c.contacts.values()))
+                if c.state == Clue_state.Schroedinger: # Clue owner hasn't confirmed alive/dead.
+                    this_clue += " (status uncertain)"
+                clue_list.append(this_clue)
+        if len(clue_list) > 0:
+            self.send_message("\n".join(clue_list), False) # No length check; message could easily be over 500 chars, and that's ok.
+        elif only_unstarred:
+            self.send_message("There are no active unstarred clues.  (Good work!)")
+        else:
+            self.send_message("There are no active clues." )
+
+    # Report how many words in the dictionary start with the letters being defended.
+    def count_words(self):
+        if word_list is None:
+            self.send_message("I don't have a dictionary.")
+        elif self.game_state == Game_state.Finished or self.game_state == Game_state.None or not self.defending_text:
+            self.send_message("No word is being defended right now.")
+        else:
+            count = word_list.count(self.defending_text)
+            if count is None:
+                self.send_message("I can't read my dictionary.")
+            else:
+                self.send_message("%s word%s in my dictionary start%s with **%s**." % (count, "" if count == 1 else "s", "s" if count == 1 else "", self.defending_text))
+
+    # List the contacts for a given clue (or for all clues, if number is empty)
+    def display_contacts(self, number):
+
+        #Display contacts for a specific clue.
+        if number != "":
+            # Try converting the text after "!contacts" (minus apostrophes) into a number. If it doesn't work, the command is invalid.
+            try: 
+                c = float(number.replace("'", "")) # Remove apostrophes before trying to convert to float
+            except:
+                c = None
+                self.send_message("Syntax of the **`!contacts`** command:  **`!contacts <optional clue number>`**")
+
+            if c is not None: # We got a valid number
+                if TESTING: print(self.clues.keys())
+                if TESTING: print(number)
+                if number not in self.clues.keys():
+                    self.send_message("There is no active clue with the number %s" % (number))
+                elif len(self.clues[number].contacts) == 0:
+                    self.send_message("There are no current contacts for clue number %s" % (number))
+                else:
+                    self.send_message("Clue #%s is currently contacted by: %s" % (number, ", ".join(user for user in self.clues[number].contacts.values())))
+
+        else: #Display all clues and contacts
+            output = ""
+            for c in self.clues.keys():
+                if len(self.clues[c].contacts) > 0:
+                    output += "  #%s by %s\n" % (c, ", ".join(user for user in self.clues[c].contacts.values()))
+            # Add a message if there are no contacts
+            if output == "":
+                snark = ""
+                if len(self.clues) == 0:
+                    snark = ", which makes sense, since there are *no active clues*"
+                self.send_message("There are currently **no** contacted clues%s!  C'mon, people!  Pick it up!" % (snark))
+                if len(self.clues) > 10:
+                    self.send_message("Maybe stop trying to come up with *more clues*, and try to solve some of the existing ones instead?")
+            else:
+                self.send_message("The following clues are currently contacted:\n" + output)
+
+    # Reset the game state.  Unstar any messages from the previous game.
+    def reset(self):
+        for c in self.clues.itervalues():
+            self.remove_clue(c, Clue_state.Dead, Game_state.Finished)
+        if self.defending_message is not None:
+            self.outgoing.perform(self.defending_message.cancel_stars)
+        self.clues.clear()
+        self.dead_clues.clear()
+        self.defending_message = None
+        self.defending_timestamp = None
+        self.defender_id = -1
+        self.pass_with_no_contact = False
+        self.num_contact_guesses = 0
+        self.game_id = -1
+        self.record(eventlog.GameReset)
+
+    # Record a change to the game state in the event log
+    def record(self, event_type, *fields):
+        if self.events is not None:
+            self.events.record(event_type, *fields)
+
+    # Move to a different game state, as defined by the Game_state enum
+    def set_game_state(self, state):
+        self.game_state = state
+        self.record(eventlog.GameStateChanged, state)
+        print("Game state changed to %s" % (state))
+
+    # Post a message to the room, provided the bot has not been told to !shutup
+    # By default, the message can't be more than 500 characters, or it will fail silently.  Setting length_check to False allows longer messages.
+    def send_message(self, message, length_check=True):
+        # Don't continue if we've recently posted the same message (otherwise, it's added to the list of recently-posted messages)
+        if self.recent_messages.seen(message):
+            return
+
+        # Post the message, if we're not muted.
+        if self.muted_timestamp is None or (datetime.utcnow() - self.muted_timestamp).total_seconds() > self.mute_length:
+            self.outgoing.send_message(message, length_check)
+
+    # Post a message from outside the worker (e.g. from side_work), once the worker gets to it.
+    # A tuple of messages is posted together, with nothing else in between.
+    def post(self, message, length_check=True):
+        def send():
+            for part in (message if isinstance(message, tuple) else (message,)):
+                self.send_message(part, length_check)
+        self.worker.submit(send)
+
+    # Call fn(*args) on the worker after the given number of seconds.  Returns the timer, so that it can be cancelled.
+    def call_later(self, delay, fn, *args):
+        return reminders.call_later(delay, self.worker.submit, fn, *args)
+
+    # Stop the bot from posting any messages to the room.
+    # Can specify a time period (in minutes) or use the default of 10.
+    def mute(self, arg):
+        minutes = 10
+        if arg != "": # Number of minutes has been specified
+            # If number of minutes can't be converted to a float, it wasn't entered correctly.
+            try:
+                minutes = float(arg)
+            except:
+                self.send_message("You must specify a number of minutes, or just use **`!shutup`** on its own to default to 10 minutes.")
+
+        self.mute_length = minutes * 60
+        self.send_message("Ok, I won't say anything else for %s minutes, unless you tell me to **`!speak`**.  I will continue to star/unstar clues as I'm able, and I'll still keep track of the game." % (minutes))
+        self.muted_timestamp = datetime.utcnow()
+        log("info", "Muted for %s minutes." % (minutes))
+
+    # If the bot has been muted, cancel the mute.    
+    def unmute(self):
+        self.muted_timestamp = None
+        self.mute_length = 600
+        self.send_message("Your wish is my command.  What can I do for you?")
+
+    # Disable extraneous messages from the bot.  Only messages directly related to gameplay will be posted.
+    def toggle_verbosity(self, setting):
+        if setting == "0" or setting == "off":
+            self.verbose = False
+            self.send_message("Ok. After this, I'll only speak if you really need to know something. You can make me more chatty with **`!verbose on`**. Or you can silence me entirely with **`!shutup`**.")
+        elif setting == "1" or setting == "on":
+            self.verbose = True
+            self.send_message("Ok. I love talking!  We can talk about all sorts of things!  I love Contact.  Do you?  Do you like defending or attacking better?  I'm never sure which one I like the most, but being a bot, I'll probably never get a chance to do either.  So sad. In verbose mode, I'll make sure to inform you whenever you're out of line, keep you abreast of game developments, and maybe throw in a few witticisms here and there just for fun. I love to talk! (**`!verbose off`** turns off verbose mode.)")
+        elif setting is None or setting == "":
+            self.send_message("Verbose mode is currently %s. You can turn it %s with **`!verbose %s`**." % ("on" if self.verbose else "off", "off" if self.verbose else "on", "off" if self.verbose else "on"))
+        else:
+            self.send_message("Usage: **`!verbose [on|off]`**.")
+
+    # Called whenever an active clue changes state.
+    def clue_state_changed(self, clue, old_state):
+        if TESTING: print("Clue #%s: state changed to %s" % (clue.number, clue.state))
+
+        # If the setter needs to say whether the clue is still alive, remind them if they haven't done so in time.
+        if clue.state_timer is not None:
+            clue.state_timer.cancel()
+            clue.state_timer = None
+        if clue.state == Clue_state.Schroedinger:
+            clue.state_timer = self.call_later(SCHROEDINGER_TIMEOUT, self.remind_clue_status)
+
+    # Called whenever a guess is made (or cleared) for an active clue.
+    def clue_guess_changed(self, clue):
+        # Remind the setter to confirm or deny the guess, if they haven't done so in time.
+        if clue.guess_timer is not None:
+            clue.guess_timer.cancel()
+            clue.guess_timer = None
+        if clue.guess != "":
+            clue.guess_timer = self.call_later(GUESS_TIMEOUT, self.remind_guess, clue)
+
+    # Timer callback: a clue has had "uncertain" status for SCHROEDINGER_TIMEOUT seconds.
+    def remind_clue_status(self):
+        if self.verbose: self.check_clue_status()
+
+    # Check for clues with "uncertain" status (haven't been confirmed alive/dead after a new letter has been given).
+    # If it's been long enough since the new letter has been given, remind the setter that they need to indicate whether the clue is still alive.
+    # Clues that became uncertain at (almost) the same time are all included, so each setter only gets one reminder for them.
+    def check_clue_status(self):
+        users_to_warn = {} # Make a list so we don't give multiple warnings for multiple clues by the same user
+        for clue in self.clues.in_state(Clue_state.Schroedinger):
+            if not clue.warned and (datetime.utcnow() - clue.state_timestamp).total_seconds() >= SCHROEDINGER_TIMEOUT - TIMER_SLACK:
+                setter = clue.setter_name.replace(" ", "") # We're pinging them, so no spaces.
+
+                # Either make a new list or add to the existing one.
+                if setter not in users_to_warn:
+                    users_to_warn[setter] = [clue.number]
+                else:
+                    users_to_warn[setter].append(clue.number)
+                clue.warned = True # So that we don't keep warning about the same clue
+
+        # Send one message for each user who has outstanding clues
+        for setter in users_to_warn.iterkeys():
+            nums = users_to_warn[setter] # All clues for this user
+            # Get the proper wording for one vs. many clues
+            clue_text = "clue #%s is" % (nums[0])
+            if len(nums) > 1:
+                clue_text = "clues #%s and #%s are" % (", #".join(number for number in nums[0:len(nums) - 1]), nums[len(nums) - 1]) # Join all but the last, then put the last one after the "and"
+            self.send_message("@%s, it's been more than %s minutes since %s provided a new letter, and you still haven't indicated whether %s alive or dead." % (setter, SCHROEDINGER_TIMEOUT / 60.0, self.defender_name, clue_text))
+
+    # Timer callback: a guess hasn't been responded to within GUESS_TIMEOUT seconds.  Notify the clue setter.
+    def remind_guess(self, clue):
+        if self.verbose and self.clues.get(clue.number) is clue and clue.guess != "" and not clue.guess_warned:
+            self.send_message("@%s, %s guessed *%s* for clue #%s.  Please confirm or deny the guess." % (clue.setter_name.replace(" ", ""), clue.guesser_name, clue.guess, clue.number))
+            clue.guess_warned = True
 
-    db = sqlite3.connect('temp.db')
-    db.execute('INSERT INTO {} (user) values (?)'.format(table_name), (param,))
-    db.commit()
-    db.close()
-    
-def remove_list(list_var, param, table_name):
-    if param not in list_var:
-        send_message("%s is not on the %s." % (param, table_name))
-    else:
-        list_var.remove(param)
-        try:
-            send_message("Removing %s from the %s." % (str(param) + " (" + client.get_user(int(param)).name + ")", table_name))
-        except:
-            send_message("Removing %s from the %s." % (param, table_name))
+    # Timer callback: a wave is WAVE_DEATH seconds old, so it no longer counts (unless the same person has waved again since).
+    def expire_wave(self, user_id, timestamp):
+        if self.waves.get(user_id) == timestamp:
+            del self.waves[user_id]
+
+    # Monitor the "waves" ("o/", "O/", "0/", etc.) posted in the room.
+    # If several people wave (indicating a desire to play) within a certain time period, intiate a "ping" (notify all users on the pinglist).
+    def check_waves(self):
+        wavecount = len(self.waves) # Waves are removed from the list when they expire (see expire_wave)
+        if wavecount > WAVES_FOR_PING:  # We have enough waves
+            self.send_message("There are %s people waiting to play Contact!  Want to join?" % (wavecount))
+            self.ping() # Ping everyone on the pinglist
+
+    # Print a help message
+    def info(self):
+        self.send_message("Hello! I'm %s, a bot to help with the game of Contact.\nI will try to keep track of the game state and keep the game moving. If you're on my whitelist, you can use the following commands to communicate with me (some are mod-only):" % (my_user.name))
+        self.send_message(bot_commands.help_text(), False)
+
+    def modify_list(self, list_var, param, table_name):
+        if param != "":
+            if param[0] == "+":
+                self.add_list(list_var, param[1:], table_name)
+            elif param[0] == "-":
+                self.remove_list(list_var, param[1:], table_name)
+            else:
+                self.add_list(list_var, param, table_name)
+        else:
+            self.show_list(list_var)
 
-        db = sqlite3.connect('temp.db')
-        db.execute('DELETE FROM {} WHERE user = ?'.format(table_name), (param,))
-        db.commit()
-        db.close()
+    # Looking up user names (and writing to temp.db) can be slow, so the lists are updated on the side_work pool.
+    def add_list(self, list_var, param, table_name):
+        list_var.add(param)
+        def finish():
+            self.post("Adding %s to the %s." % (user_labels([param])[0], table_name))
 
-def cooldown(seconds):
-    def inner(fn):
-        def ret_fn(*args, **kwargs):
-            if time.time() > ret_fn.last_time_stamp + seconds:
-                fn(*args, **kwargs)
-                ret_fn.last_time_stamp = time.time()
+            db = sqlite3.connect('temp.db')
+            db.execute('INSERT INTO {} (user) values (?)'.format(table_name), (param,))
+            db.commit()
+            db.close()
+        side_work.submit(finish)
 
-        ret_fn.last_time_stamp = 0
-        return ret_fn
-    return inner
-    
-def html_to_markdown(text):
-    return text.replace("<b>", "**") \
-               .replace("</b>", "**") \
-               .replace("<i>", "*") \
-               .replace("</i>", "*") \
-               .replace("<code>", "`") \
-               .replace("</code>", "`") \
-               .replace("<strike>", "---") \
-               .replace("</strike>", "---")
-
-@cooldown(1)
-def toggle_pinning(msg):
-    ret_val = msg._client._br.toggle_pinning(msg.id)
-    if TESTING: print("Toggle: %s" % (ret_val))
-
-@cooldown(1)
-def add_star(msg):
-    ret_val = msg.message._client._br.toggle_starring(msg.id)
-    if TESTING: print("Add star: %s" % (ret_val))
-
-@cooldown(10)
-def ping():
-    to_ping = list(pinglist)
-    for x in range(0, len(to_ping), 10):
-        send_message( " ".join('@'+name.replace(" ", "") for name in to_ping[x:x+10]) )
-
-@cooldown(10)
-def show_list(list_var):
-    list = ""
+    def remove_list(self, list_var, param, table_name):
+        if param not in list_var:
+            self.send_message("%s is not on the %s." % (param, table_name))
+        else:
+            list_var.remove(param)
+            def finish():
+                self.post("Removing %s from the %s." % (user_labels([param])[0], table_name))
+
+                db = sqlite3.connect('temp.db')
+                db.execute('DELETE FROM {} WHERE user = ?'.format(table_name), (param,))
+                db.commit()
+                db.close()
+            side_work.submit(finish)
+
+    # Star/pin requests are queued in the outbox, which sends them in order and no faster than chat allows.
+    def toggle_pinning(self, msg):
+        self.outgoing.perform(msg._client._br.toggle_pinning, msg.id)
+
+    @cooldown(10)
+    def ping(self):
+        to_ping = list(pinglist)
+        for x in range(0, len(to_ping), 10):
+            self.send_message( " ".join('@'+name.replace(" ", "") for name in to_ping[x:x+10]) )
+
+    @cooldown(10)
+    def show_list(self, list_var):
+        entries = sorted(list_var) # A copy, since the list may change before the names have been looked up
+        def finish():
+            list = ", ".join(user_labels(entries))
+            self.post(list, False) #Allow more than 500 chars
+            if len(list) > 500:
+                self.post("That list is getting kind of long.  You might want to consider pruning those who are no longer active...")
+        side_work.submit(finish)
+
+# Summary statistics for each game, in the same column order as the game_summary table.  Add a WHERE clause on game.Id to select games.
+GAME_SUMMARY_QUERY = """SELECT game.Id, game.DefenderName, game.StartTimeUTC, game.EndTimeUTC,
+    (SELECT COUNT(DISTINCT Id) FROM
+        (SELECT SetterId AS Id FROM clue WHERE GameId = game.Id
+            UNION ALL SELECT SolverId FROM clue WHERE GameId = game.Id
+            UNION ALL SELECT ContacterId FROM contact INNER JOIN clue ON contact.ClueId = clue.Id WHERE GameId = game.Id
+            UNION ALL SELECT game.DefenderId)
+        WHERE Id IS NOT NULL),
+    (SELECT COUNT(*) FROM clue WHERE GameId = game.Id),
+    (SELECT COUNT(Solution) FROM clue WHERE GameId = game.Id),
+    (SELECT COUNT(*) FROM clue INNER JOIN defence ON clue.DefenceId = defence.Id WHERE defence.GameId = game.Id),
+    (SELECT COUNT(DISTINCT defence.Id) FROM clue INNER JOIN defence ON clue.DefenceId = defence.Id WHERE defence.GameId = game.Id)
+    FROM game"""
+
+# Store the summary statistics of a finished game, so they don't need to be worked out again.
+def summarize_game(id):
+    contact_db.execute("INSERT OR REPLACE INTO game_summary " + GAME_SUMMARY_QUERY + " WHERE game.Id = ?", (id,))
+
+# Parse a UTC timestamp, as stored in the database
+def parse_utc(text):
+    return datetime.strptime(text, "%Y-%m-%d %H:%M:%S.%f" if "." in text else "%Y-%m-%d %H:%M:%S")
+
+# Each player's totals across all games are kept in the player_stats table, which is updated as the games are played,
+# so that looking them up doesn't mean going through every game ever played.
+
+# Add to a player's totals, e.g. add_player_stats(user_id, user_name, CluesSet=1)
+def add_player_stats(user_id, user_name, **counts):
+    columns = sorted(counts)
+    contact_db.execute("INSERT OR IGNORE INTO player_stats (UserId, UserName) VALUES (?, ?)", (user_id, user_name))
+    contact_db.execute("UPDATE player_stats SET UserName = ?, %s WHERE UserId = ?" % (", ".join("%s = %s + ?" % (column, column) for column in columns)),
+                       (user_name,) + tuple(counts[column] for column in columns) + (user_id,))
+
+# Add the length of a finished game (by game ID) to its defender's (by chat ID) total time spent defending.
+DEFENCE_SECONDS_UPDATE = """UPDATE player_stats SET DefenceSeconds = DefenceSeconds +
+    IFNULL((SELECT (julianday(EndTimeUTC) - julianday(StartTimeUTC)) * 86400 FROM game WHERE Id = ?), 0) WHERE UserId = ?"""
+
+# The totals for every player, worked out from all the games played so far.  Used to fill in player_stats when it is created.
+PLAYER_STATS_HISTORY_QUERY = """SELECT Id, MAX(Name), SUM(CluesSet), SUM(CluesSolved), SUM(Contacts), SUM(SuccessfulContacts), SUM(GamesDefended), SUM(DefenceLetters), SUM(DefenceSeconds)
+    FROM (SELECT SetterId AS Id, SetterName AS Name, 1 AS CluesSet, Solution IS NOT NULL AS CluesSolved, 0 AS Contacts, 0 AS SuccessfulContacts,
+                0 AS GamesDefended, 0 AS DefenceLetters, 0 AS DefenceSeconds FROM clue
+        UNION ALL SELECT ContacterId, ContacterName, 0, 0, 1, clue.Solution IS NOT NULL, 0, 0, 0 FROM contact INNER JOIN clue ON contact.ClueId = clue.Id
+        UNION ALL SELECT DefenderId, DefenderName, 0, 0, 0, 0, 1, IFNULL((SELECT MAX(LENGTH(Text)) FROM defence WHERE GameId = game.Id), 0),
+                IFNULL((julianday(EndTimeUTC) - julianday(StartTimeUTC)) * 86400, 0) FROM game WHERE EndTimeUTC IS NOT NULL)
+    WHERE Id IS NOT NULL GROUP BY Id"""
+
+PLAYER_STATS_QUERY = "SELECT UserId, UserName, CluesSet, CluesSolved, Contacts, SuccessfulContacts, GamesDefended, DefenceLetters, DefenceSeconds FROM player_stats"
+
+# The leaderboards: name -> (ORDER BY expression, [(column heading, SQL)])
+LEADERBOARD_SIZE = 10
+LEADERBOARDS = collections.OrderedDict([
+    ("setters", ("CluesSolved", [("Clues set", "CluesSet"), ("Solved", "CluesSolved"), ("% solved", "CluesSolved * 100.0 / CluesSet")])),
+    ("contacters", ("SuccessfulContacts", [("Contacts", "Contacts"), ("Successful", "SuccessfulContacts"), ("% successful", "SuccessfulContacts * 100.0 / Contacts")])),
+    ("defenders", ("GamesDefended", [("Defended", "GamesDefended"), ("Avg. letters", "DefenceLetters * 1.0 / GamesDefended")])),
+])
+
+def format_stat(value):
+    return "-" if value is None else "%.1f" % (value) if isinstance(value, float) else str(value)
+
+# The live clues of a game, with one row per contact (or a single row, if the clue hasn't been contacted).
+RESTORE_CLUES_QUERY = """SELECT clue.Id, clue.ClueNumber, clue.SetterId, clue.SetterName, clue.Text, clue.PostTimeUTC, contact.ContacterId, contact.ContacterName
+    FROM clue LEFT JOIN contact ON contact.ClueId = clue.Id
+    WHERE clue.GameId = ? AND clue.DeathTimeUTC IS NULL
+    ORDER BY clue.Id, contact.Id"""
+
+### Snapshots ###
+
+# Snapshots hold everything needed to carry on with a game: the clues (with their contacts, guesses and states), the defence,
+# pass and mute state, and recent waves.  Chat messages are saved by id, and times as text (see snapshot_time).
+SNAPSHOT_VERSION = 1
+
+def snapshot_time(value):
+    return str(value) if value is not None else None
+
+def restored_time(text):
+    return parse_utc(text) if text is not None else None
+
+# The database id of a row, or None if it hasn't been committed yet (or couldn't be written).  Snapshots are taken holding
+# the game's lock, so this never waits for the database.
+def row_id(value):
+    if not isinstance(value, database.future):
+        return value
+    if not value.done():
+        return None
     try:
-        list = ", ".join(str(x) + " (" + client.get_user(int(x)).name + ")" for x in list_var)
-    except:
-        list = ", ".join(x for x in list_var)
-    send_message(list, False) #Allow more than 500 chars
-    if len(list) > 500:
-        send_message("That list is getting kind of long.  You might want to consider pruning those who are no longer active...")
-
-def get_next_id(table_name):
-    db = sqlite3.connect('Contact.db')
-    results = db.execute("SELECT MAX(Id) FROM %s" % (table_name))
-    max = results.fetchall()[0][0]
-    if not max:
-        return 1
-    else:
-        return max + 1
-    db.close()
+        return value.result()
+    except Exception:
+        return None
+
+def capture_clue(c):
+    return {
+        "number": c.number, "message": c.message.id if c.message is not None else None,
+        "setter_id": c.setter_id, "setter_name": c.setter_name, "text": c.clue_text,
+        "guess": c.guess, "guesser_name": c.guesser_name, "guess_timestamp": snapshot_time(c.guess_timestamp), "guess_warned": c.guess_warned,
+        "contacts": c.contacts.items(), "state": c.state, "state_timestamp": snapshot_time(c.state_timestamp),
+        "timestamp": c.timestamp, "db_id": row_id(c.db_id), "warned": c.warned,
+    }
+
+def restore_clue(data):
+    c = clue()
+    c.number = data["number"]
+    if data["message"] is not None:
+        c.message = client.get_message(data["message"])
+    c.setter_id = data["setter_id"]
+    c.setter_name = data["setter_name"]
+    c.clue_text = data["text"]
+    c.guess = data["guess"]
+    c.guesser_name = data["guesser_name"]
+    c.guess_timestamp = restored_time(data["guess_timestamp"])
+    c.guess_warned = data["guess_warned"]
+    c.contacts = dict(data["contacts"])
+    c.state = data["state"]
+    c.state_timestamp = restored_time(data["state_timestamp"])
+    c.timestamp = data["timestamp"]
+    c.db_id = data["db_id"]
+    c.warned = data["warned"]
+    return c
+
+# A snapshot rebuilt from a game's event log (see eventlog.replay), for when there's no snapshot file.  The log doesn't hold
+# the database ids of the defence and clues, or the mute and wave state, so those start over.
+def replayed_snapshot(state):
+    def replayed_clue(c):
+        if c is None:
+            return None
+        data = capture_clue(c)
+        data["message"] = state.message_ids.get(c.number)
+        return data
+    return {
+        "version": SNAPSHOT_VERSION,
+        "game_state": state.game_state, "game_id": state.game_id, "defence_id": None,
+        "defender_id": state.defender_id, "defender_name": state.defender_name, "defending_text": state.defending_text,
+        "defending_message": state.defending_message_id, "defending_timestamp": state.defending_timestamp,
+        "clues": [replayed_clue(c) for c in state.clues.itervalues()], "dead_clues": [list(record) for record in state.dead_clues],
+        "last_clue_solved": replayed_clue(state.last_clue_solved), "last_clue_guessed": replayed_clue(state.last_clue_guessed),
+        "pass_with_no_contact": state.pass_with_no_contact, "num_contact_guesses": state.num_contact_guesses,
+        "verbose": True, "muted_timestamp": None, "mute_length": DEFAULT_MUTE_LENGTH, "waves": [],
+    }
+
+# Decode the HTML entities in a message.  Most messages have none, and are returned as they are.
+html_parser = HTMLParser.HTMLParser()
+def unescape(text):
+    if "&" not in text:
+        return text
+    return html_parser.unescape(text)
+
+# How whitelist/pinglist entries are shown: "id (name)" for user IDs whose names we can find, otherwise just the entry.
+# Names that aren't known (or are out of date) are looked up, so call this from side_work.
+def user_labels(entries):
+    names = user_names.names([int(x) for x in entries if x.isdigit()])
+    return [("%s (%s)" % (x, names[int(x)])) if x.isdigit() and int(x) in names else x for x in entries]
+
+# Star a message, unless it has already been starred.  Sometimes a single message contains several clues (e.g. 4,5: Fifth space on a Monopoly board = READING RAILROAD).
+def star_once(msg):
+    if TESTING: print("Message has %s stars" % (msg.stars))
+    if msg.stars == 0:
+        msg.star()
 
 def init_db():
-    db = sqlite3.connect('Contact.db')
+    db = database.connect('Contact.db')
+    db.execute("PRAGMA journal_mode = WAL") # Stored in the database file, so only needs to be set once
     
     init_table(db, "clue", "Id INTEGER PRIMARY KEY AUTOINCREMENT, ClueNumber TEXT, SetterId INT, SetterName TEXT, SolverId INT, SolverName TEXT, Solution TEXT, Text TEXT, GameId INT, DefenceId INT, ChatId INT, PostTimeUTC DATETIME, DeathTimeUTC DATETIME")
     init_table(db, "contact", "Id INTEGER PRIMARY KEY AUTOINCREMENT, ContacterId INT, ContacterName TEXT, ClueId INT, ChatId INT, ContactTimeUTC DATETIME")
     init_table(db, "defence", "Id INTEGER PRIMARY KEY AUTOINCREMENT, Text TEXT, GameId INT, ChatId INT, StartTimeUTC DATETIME")
     init_table(db, "game", "Id INTEGER PRIMARY KEY AUTOINCREMENT, DefenderId INT, DefenderName TEXT, WordDefended TEXT, StartTimeUTC DATETIME, EndTimeUTC DATETIME")
+    migrate_db(db)
         
     db.close()
+
+# Changes to the database schema, in order.  Each entry is the list of statements that bring the database up to the next version.
+# The current version is stored in the database itself (PRAGMA user_version), so each change is applied exactly once.
+# Never edit an entry once it has been released; add a new one instead.
+MIGRATIONS = [
+    # 1: Indexes for the lookups made during play, and by !stats and !resume
+    [
+        "CREATE INDEX IF NOT EXISTS clue_game ON clue (GameId, DeathTimeUTC)",
+        "CREATE INDEX IF NOT EXISTS clue_defence ON clue (DefenceId)",
+        "CREATE INDEX IF NOT EXISTS contact_clue ON contact (ClueId, ContacterId)",
+        "CREATE INDEX IF NOT EXISTS contact_contacter ON contact (ContacterId)",
+        "CREATE INDEX IF NOT EXISTS defence_game ON defence (GameId, StartTimeUTC)",
+        "ANALYZE",
+    ],
+    # 2: Stored statistics for finished games (see GAME_SUMMARY_QUERY)
+    [
+        "CREATE TABLE IF NOT EXISTS game_summary (GameId INTEGER PRIMARY KEY, DefenderName TEXT, StartTimeUTC DATETIME, EndTimeUTC DATETIME, Players INT, Clues INT, CluesSolved INT, DefenceClues INT, Defences INT)",
+        "INSERT OR REPLACE INTO game_summary " + GAME_SUMMARY_QUERY + " WHERE game.EndTimeUTC IS NOT NULL",
+    ],
+    # 3: The chat room each game is played in (games from before this have none)
+    [
+        "ALTER TABLE game ADD COLUMN RoomId INT",
+    ],
+    # 4: Each player's totals across all games (see add_player_stats), starting with the games played so far
+    [
+        "CREATE TABLE IF NOT EXISTS player_stats (UserId INTEGER PRIMARY KEY, UserName TEXT, CluesSet INT DEFAULT 0, CluesSolved INT DEFAULT 0, Contacts INT DEFAULT 0, SuccessfulContacts INT DEFAULT 0, GamesDefended INT DEFAULT 0, DefenceLetters INT DEFAULT 0, DefenceSeconds REAL DEFAULT 0)",
+        "INSERT OR REPLACE INTO player_stats " + PLAYER_STATS_HISTORY_QUERY,
+    ],
+]
+
+def migrate_db(db):
+    version = db.execute("PRAGMA user_version").fetchall()[0][0]
+    for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+        for statement in statements:
+            db.execute(statement)
+        db.execute("PRAGMA user_version = %d" % (number))
+        db.commit()
+        log('info', "Upgraded Contact.db to schema version %s" % (number))
     
 def init_table(db, table_name, fields):
     results = db.execute("SELECT * FROM sqlite_master WHERE type='table' AND name='%s'" % (table_name))
@@ -1251,5 +1759,6 @@ def init_list(list_var, table_name):
 
     db.close()
     return list_var
-    
-main()
+
+if __name__ == "__main__":
+    main()
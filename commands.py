@@ -0,0 +1,63 @@
+# A registry of the bot's "!" commands, keyed by the command token (e.g. "!clues").
+#
+# Each command records who may use it, how its argument is parsed, and the text shown for it by !help,
+# so the help output is generated from the same table that is used to run the commands.
+from helpers import enum
+
+# Who may use a command.  Higher values include the lower ones.
+Access = enum("Anyone", "Trusted", "Super")
+
+# Argument parsers.  Each takes the (stripped) text following the command token, and returns a tuple
+# of arguments for the command handler.  Raise ValueError if the argument is invalid.
+def no_args(arg):
+    if arg != "":
+        raise ValueError(arg)
+    return ()
+
+def optional_arg(arg):
+    return (arg,)
+
+def required_arg(arg):
+    if arg == "":
+        raise ValueError(arg)
+    return (arg,)
+
+# Split input into a lower-case command token and the (stripped) text following it.
+def split(input):
+    parts = input.strip().split(None, 1)
+    if not parts:
+        return "", ""
+    return parts[0].lower(), (parts[1].strip() if len(parts) > 1 else "")
+
+class command(object):
+    def __init__(self, name, handler, access, parser, usage, description):
+        self.name = name # The command token, including the leading "!"
+        self.handler = handler # Called as handler(context, *parser(arg))
+        self.access = access # One of the values in enum Access
+        self.parser = parser
+        self.usage = usage # Shown by !help, and when the argument can't be parsed
+        self.description = description # Shown by !help.  Commands without a description are not listed.
+
+class registry(object):
+    def __init__(self):
+        self.commands = {}
+        self.order = [] # Commands in the order they were registered, for !help
+
+    # Decorator to register a command handler.
+    def command(self, name, access=Access.Trusted, parser=no_args, usage=None, description=None):
+        def inner(fn):
+            entry = command(name.lower(), fn, access, parser, usage or name, description)
+            self.commands[entry.name] = entry
+            self.order.append(entry)
+            return fn
+        return inner
+
+    def lookup(self, token):
+        return self.commands.get(token)
+
+    # One line per documented command, with the descriptions lined up.
+    def help_text(self):
+        documented = [c for c in self.order if c.description is not None]
+        width = max(len(c.usage) for c in documented) if documented else 0
+        return "\n".join("     %s - %s%s" % (c.usage.ljust(width), c.description, " (mod-only)" if c.access == Access.Super else "")
+                         for c in documented)
@@ -0,0 +1,187 @@
+# Access to an SQLite database (Contact.db) that doesn't tie up the chat event thread.
+#
+# Writes are queued and run, in order, by a single writer thread that commits them in batches.  Anyone who
+# needs the row id of an INSERT gets it back through a future.  A future can also be passed as a parameter
+# to a later write; since writes run in order, it is resolved by the time that write runs.
+# Reads use a long-lived, read-only connection per thread, after waiting for any queued writes to be committed.  With WAL
+# journaling, a long read (e.g. statistics for a big game) doesn't hold up the writer, so run them on a thread of their
+# own (see side_work in bot.py) and the game carries on meanwhile.
+import collections
+import sqlite3
+import sys
+import threading
+import time
+import Queue
+from helpers import log_exception
+from perf import clock, stages
+
+# The result of a queued write, which will be available once the writer thread has run it.
+class future(object):
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    # Wait for the write to run, and return its result (the row id, for INSERTs)
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for a database write")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+# Replace any futures in a list of query parameters with their results.  `written` has the results of writes that have
+# run but haven't been committed yet (so their futures aren't resolved), by future.
+def resolve(params, written={}):
+    return tuple((written[p] if p in written else p.result()) if isinstance(p, future) else p for p in params)
+
+# Settings applied to every connection.  With WAL journaling (see init_db in bot.py), synchronous=NORMAL only
+# syncs at checkpoints, and readers don't block the writer (or vice versa).
+PRAGMAS = [
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -8000", # In KiB
+    "PRAGMA temp_store = MEMORY",
+]
+
+def connect(path):
+    db = sqlite3.connect(path)
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    return db
+
+_flush = object() # Queue marker: commit everything before this point now
+_stop = object() # Queue marker: commit everything and stop the writer
+
+class database(object):
+    def __init__(self, path, batch_interval=0.05, max_batch=200):
+        self.path = path
+        self.batch_interval = batch_interval # Seconds to wait for more writes before committing a batch
+        self.max_batch = max_batch # Maximum number of writes per commit
+        self.writes = 0 # Number of write statements run
+        self.commits = 0 # Number of batches committed
+        self._queue = Queue.Queue()
+        self._closed = False # Set by close(); nothing more can be queued after that
+        self._closing = threading.Lock() # Held while checking _closed and queueing, so nothing is queued behind the stop marker
+        self._local = threading.local()
+        self._writer = threading.Thread(target=self._write_loop, name="db-writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def connect(self):
+        return connect(self.path)
+
+    # The calling thread's read connection.  Only the writer thread writes to the database.
+    def connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self.connect()
+            db.execute("PRAGMA query_only = ON")
+        return db
+
+    # Queue a write.  Returns a future for the row id of the last row inserted.  Once the database is closed, the future
+    # fails straight away.
+    def execute(self, sql, params=()):
+        result = future()
+        with self._closing:
+            if not self._closed:
+                self._queue.put((sql, params, result))
+                return result
+        result.set_exception(RuntimeError("Can't write to %s: the database has been closed" % (self.path)))
+        return result
+
+    # Run a read query and return all rows.  Any queued writes are committed first, so they are visible.
+    def query(self, sql, params=()):
+        self.flush()
+        start = clock()
+        rows = self.connection().execute(sql, resolve(params)).fetchall()
+        stages.add("sqlite query", clock() - start)
+        return rows
+
+    # Wait until all writes queued so far have been committed.
+    def flush(self, timeout=None):
+        if threading.current_thread() is self._writer:
+            return
+        marker = future()
+        with self._closing:
+            if self._closed:
+                return
+            self._queue.put((_flush, None, marker))
+        marker.result(timeout)
+
+    # Commit all queued writes and stop the writer thread.
+    def close(self):
+        with self._closing:
+            stop, self._closed = not self._closed, True
+            if stop:
+                self._queue.put((_stop, None, None))
+        if stop and threading.current_thread() is not self._writer:
+            self._writer.join()
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def _write_loop(self):
+        db = self.connect()
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.batch_interval
+            # Gather up whatever else arrives in the next moment, unless someone is waiting for the commit.
+            while len(batch) < self.max_batch and batch[-1][0] is not _flush and batch[-1][0] is not _stop:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+
+            stages.count("sqlite batch size", len(batch))
+            markers = []
+            written = collections.OrderedDict() # The future for each write that ran -> its row id, to be resolved once it's committed
+            for sql, params, result in batch:
+                if sql is _flush:
+                    markers.append(result)
+                elif sql is _stop:
+                    running = False
+                else:
+                    try:
+                        start = clock()
+                        cursor = db.execute(sql, resolve(params, written))
+                        stages.add("sqlite write", clock() - start)
+                        self.writes += 1
+                        written[result] = cursor.lastrowid
+                    except Exception as e:
+                        log_exception(*sys.exc_info())
+                        result.set_exception(e)
+            # Only tell anyone their write worked once it has been committed.
+            try:
+                start = clock()
+                db.commit()
+                stages.add("sqlite commit", clock() - start)
+                self.commits += 1
+                for result, row_id in written.iteritems():
+                    result.set_result(row_id)
+            except Exception as e:
+                log_exception(*sys.exc_info())
+                try:
+                    db.rollback()
+                except Exception:
+                    pass
+                for result in written:
+                    result.set_exception(e)
+            for marker in markers:
+                marker.set_result(None)
+        db.close()
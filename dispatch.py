@@ -0,0 +1,79 @@
+# Routes chat input to the first handler whose pattern matches it.
+#
+# Each rule may declare cheap preconditions (the characters the input can start with, substrings it
+# must contain, or a guard on the message context).  Rules are tried in the order they were added,
+# and the regular expression is only run once all of a rule's preconditions pass, so most chatter
+# is rejected without running any regex at all.
+from perf import clock
+
+DIGITS = "0123456789"
+
+# A single input rule: a compiled pattern and the handler to call with its match.
+class rule(object):
+    def __init__(self, name, pattern, handler, starts=None, contains=None, guard=None):
+        self.name = name
+        self.pattern = pattern # Compiled regex, or None to accept anything that passes the preconditions
+        self.handler = handler # Called as handler(context, match)
+        self.starts = starts # Lower-case characters the (left-stripped) input may start with, or None for any
+        self.contains = contains # Lower-case substrings, at least one of which must appear in the input, or None
+        self.guard = guard # Called as guard(context); the rule is skipped if it returns False
+
+    def accepts(self, first_char):
+        return self.starts is None or first_char in self.starts
+
+class dispatcher(object):
+    # If timings (a perf.timings) is given, the time spent matching and handling is recorded for each rule.
+    def __init__(self, timings=None):
+        self.rules = []
+        self.timings = timings
+        self._candidates = {} # First character -> ordered list of rules that could match input starting with it
+
+    def add(self, rule):
+        self.rules.append(rule)
+        self._candidates = {}
+        return rule
+
+    # Decorator form of add().  Rules are tried in the order they are declared.
+    def on(self, pattern, starts=None, contains=None, guard=None):
+        def inner(fn):
+            self.add(rule(fn.__name__, pattern, fn, starts, contains, guard))
+            return fn
+        return inner
+
+    def candidates(self, first_char):
+        rules = self._candidates.get(first_char)
+        if rules is None:
+            rules = [r for r in self.rules if r.accepts(first_char)]
+            self._candidates[first_char] = rules
+        return rules
+
+    # Run the handler of the first rule that matches the text.  Returns that rule, or None if nothing matched.
+    def dispatch(self, text, context):
+        first_char = text.lstrip()[:1].lower()
+        lowered = None
+        for r in self.candidates(first_char):
+            if r.guard is not None and not r.guard(context):
+                continue
+            if r.contains is not None:
+                if lowered is None:
+                    lowered = text.lower()
+                if not any(s in lowered for s in r.contains):
+                    continue
+            if self.timings is None:
+                match = r.pattern.match(text) if r.pattern is not None else True
+                if match:
+                    r.handler(context, match)
+                    return r
+                continue
+
+            start = clock()
+            match = r.pattern.match(text) if r.pattern is not None else True
+            matched = clock()
+            self.timings.add("match " + r.name, matched - start)
+            if match:
+                try:
+                    r.handler(context, match)
+                finally:
+                    self.timings.add("handle " + r.name, clock() - matched)
+                return r
+        return None
@@ -0,0 +1,271 @@
+# A record of everything that happens in a game, kept in an append-only log file, and a way to play it back.
+#
+# Each change to the game state is recorded as a typed event (one of the record types below), written as one line of JSON.
+# Events are written by a background thread, which syncs the file once per batch rather than once per event.
+#
+# Each game starts a new log file: when a GameStarted event is written, the file so far is renamed to <path>.1 (and
+# <path>.1 to <path>.2, and so on, keeping `backups` of them), so the logs don't grow forever.
+#
+# Playing the events back with replay() rebuilds the game state (a game.GameState plus the state of the game as a whole).
+# It doesn't wait between events, so months of games can be replayed in seconds: the bot restores a game from its log
+# if there's no snapshot to restore it from (see ContactGame.start in bot.py), and `python bench.py --replay <log>`
+# times the replay and shows the state it ends in, e.g. to check what really happened in a disputed game.
+import collections
+import json
+import os
+import sys
+import threading
+import time
+import Queue
+import game
+from game import clue, Clue_state, Game_state
+from helpers import log, log_exception, rotate
+
+# Event types, by name.  Every event has the time (time.time()) it happened as its first field.
+EVENT_TYPES = collections.OrderedDict()
+
+def event_type(name, fields):
+    record = collections.namedtuple(name, ["time"] + fields.split())
+    EVENT_TYPES[name] = record
+    return record
+
+GameStarted = event_type("GameStarted", "game_id defender_id defender_name") # A defender posted the first letter
+GameResumed = event_type("GameResumed", "game_id defender_id defender_name defending_text") # A game was loaded with !resume
+Defended = event_type("Defended", "defending_text message_id") # The defender posted a (new) letter
+ClueSet = event_type("ClueSet", "number setter_id setter_name text message_id")
+ClueEdited = event_type("ClueEdited", "number text")
+Contacted = event_type("Contacted", "number user_id user_name")
+Uncontacted = event_type("Uncontacted", "number user_id") # user_id is None when all contacts are removed
+Passed = event_type("Passed", "number no_contact") # no_contact: the clue hadn't been contacted
+Unpassed = event_type("Unpassed", "number")
+GuessMade = event_type("GuessMade", "number guess guesser_id guesser_name by_contact") # by_contact: a contacter's guess after a pass
+GuessDenied = event_type("GuessDenied", "number")
+ClueLives = event_type("ClueLives", "number")
+ClueRemoved = event_type("ClueRemoved", "number state solver_id solver_name") # Solved, killed, or deleted
+GameStateChanged = event_type("GameStateChanged", "state")
+GameEnded = event_type("GameEnded", "word")
+GameReset = event_type("GameReset", "")
+
+def encode(event):
+    return json.dumps([type(event).__name__] + list(event), separators=(",", ":"))
+
+def decode(line):
+    fields = json.loads(line)
+    return EVENT_TYPES[fields[0]](*fields[1:])
+
+# Read the events in a log file, in order.  A damaged last line (from a crash part way through writing it) is ignored.
+def read(path):
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                yield decode(line)
+            except (ValueError, KeyError, TypeError):
+                log('warning', "Stopped reading %s at a damaged event: %r" % (path, line[:80]))
+                return
+
+# Appends events to a log file from a background thread.
+class eventlog(object):
+    def __init__(self, path, sync_interval=0.5, backups=3):
+        self.path = path
+        self.sync_interval = sync_interval # Seconds to gather events before writing and syncing them
+        self.backups = backups # The number of earlier games' logs to keep
+        self.written = 0 # Number of events written
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="event-log")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Record an event of the given type that happened just now.
+    def record(self, event_type, *fields):
+        self._queue.put(event_type(time.time(), *fields))
+
+    # Write all recorded events, then stop.
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        f = open(self.path, "ab")
+        has_game = os.fstat(f.fileno()).st_size > 0 # Whether the file may already hold a game (not just a reset before one)
+        try:
+            running = True
+            while running:
+                batch = [self._queue.get()]
+                deadline = time.time() + self.sync_interval
+                while batch[-1] is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=remaining))
+                    except Queue.Empty:
+                        break
+                if batch[-1] is None:
+                    batch.pop()
+                    running = False
+                try:
+                    for event in batch:
+                        if isinstance(event, GameStarted) and has_game: # A new game gets a new file
+                            f.close()
+                            try:
+                                rotate(self.path, self.backups)
+                            finally:
+                                f = open(self.path, "ab")
+                        if isinstance(event, (GameStarted, GameResumed)):
+                            has_game = True
+                        f.write(encode(event) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self.written += len(batch)
+                except Exception:
+                    log_exception(*sys.exc_info())
+        finally:
+            f.close()
+
+# The state of a game, as rebuilt from its events.
+class replay_state(object):
+    def __init__(self):
+        self.clues = game.GameState()
+        self.dead_clues = []
+        self.game_state = Game_state.None
+        self.game_id = -1
+        self.defender_id = -1
+        self.defender_name = ""
+        self.defending_text = ""
+        self.defending_message_id = None
+        self.defending_timestamp = None
+        self.pass_with_no_contact = False
+        self.num_contact_guesses = 0
+        self.last_clue_solved = None
+        self.last_clue_guessed = None
+        self.message_ids = {} # Clue number -> the ID of the chat message it was set in
+        self.events = 0 # Number of events applied
+        self.skipped = 0 # Events about clues that weren't in play (e.g. the log starts part way through a game)
+
+    def apply(self, event):
+        getattr(self, "on_" + type(event).__name__)(event)
+        self.events += 1
+
+    # The clue an event is about, or None (with a warning) if there's no such clue
+    def _clue(self, event):
+        c = self.clues.get(event.number)
+        if c is None:
+            self.skipped += 1
+            log('warning', "Skipped a %s event for clue %s, which isn't in play" % (type(event).__name__, event.number))
+        return c
+
+    def on_GameStarted(self, event):
+        self.on_GameReset(event)
+        self.game_id, self.defender_id, self.defender_name = event.game_id, event.defender_id, event.defender_name
+
+    def on_GameResumed(self, event):
+        self.game_id, self.defender_id, self.defender_name = event.game_id, event.defender_id, event.defender_name
+        self.defending_text = event.defending_text
+
+    def on_Defended(self, event):
+        self.defending_text = event.defending_text
+        self.defending_message_id = event.message_id
+        self.defending_timestamp = int(event.time)
+        for c in self.clues.values():
+            c.set_state(Clue_state.Schroedinger)
+
+    def on_ClueSet(self, event):
+        c = clue()
+        c.number = event.number
+        c.setter_id = event.setter_id
+        c.setter_name = event.setter_name
+        c.clue_text = event.text
+        c.timestamp = event.time
+        c.set_state(Clue_state.Set)
+        self.clues.add(c)
+        self.message_ids[c.number] = event.message_id
+
+    def on_ClueEdited(self, event):
+        c = self._clue(event)
+        if c is not None:
+            c.clue_text = event.text
+
+    def on_Contacted(self, event):
+        c = self._clue(event)
+        if c is not None:
+            c.contacts[event.user_id] = event.user_name
+
+    def on_Uncontacted(self, event):
+        c = self._clue(event)
+        if c is None:
+            return
+        if event.user_id is None:
+            c.contacts = {}
+        else:
+            c.contacts.pop(event.user_id, None)
+
+    def on_Passed(self, event):
+        c = self._clue(event)
+        if c is None:
+            return
+        c.set_state(Clue_state.Passed)
+        if event.no_contact:
+            self.pass_with_no_contact = True
+
+    def on_Unpassed(self, event):
+        c = self._clue(event)
+        if c is not None:
+            c.set_state(Clue_state.Set)
+
+    def on_GuessMade(self, event):
+        c = self._clue(event)
+        if c is None:
+            return
+        c.set_guess(event.guess, event.guesser_name)
+        if event.by_contact:
+            self.num_contact_guesses += 1
+            self.last_clue_guessed = c
+            self.last_clue_solved = None
+
+    def on_GuessDenied(self, event):
+        c = self._clue(event)
+        if c is not None:
+            c.set_guess("", "")
+
+    def on_ClueLives(self, event):
+        c = self._clue(event)
+        if c is not None:
+            c.set_state(Clue_state.Set)
+
+    def on_ClueRemoved(self, event):
+        c = self.clues.get(event.number)
+        if c is None:
+            return
+        if event.state == Clue_state.Solved and c.state == Clue_state.Passed:
+            # The contacters solved the passed clue
+            self.num_contact_guesses = 0
+            self.last_clue_solved = c
+            self.pass_with_no_contact = False
+        c.set_state(event.state)
+        self.clues.remove(c)
+        self.message_ids.pop(c.number, None)
+        self.dead_clues.append(game.dead_clue(c.number, c.clue_text, c.setter_name, event.solver_name, c.guess if event.solver_name is not None else None))
+
+    def on_GameStateChanged(self, event):
+        self.game_state = event.state
+
+    def on_GameEnded(self, event):
+        self.game_state = Game_state.Finished
+
+    def on_GameReset(self, event):
+        self.clues.clear()
+        self.message_ids = {}
+        self.dead_clues = []
+        self.defender_id = -1
+        self.defending_message_id = None
+        self.pass_with_no_contact = False
+        self.num_contact_guesses = 0
+        self.game_id = -1
+
+# Apply events (e.g. from read()) in order, and return the resulting state.
+def replay(events, state=None):
+    if state is None:
+        state = replay_state()
+    for event in events:
+        state.apply(event)
+    return state
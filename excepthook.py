@@ -1,10 +1,11 @@
 import os
 import threading
 import sys
-from helpers import log_exception
+from helpers import log_exception, flush_log
 
 def uncaught_exception(exctype, value, tb):
     log_exception(exctype, value, tb)
+    flush_log() # os._exit doesn't wait for the log to be written
     os._exit(1)
 
 def install_thread_excepthook():
@@ -0,0 +1,171 @@
+# Exports the game history in Contact.db (the game, defence, clue and contact tables) for analysis elsewhere.
+#
+#   python export.py [--db Contact.db] [--out export] [--format csv|columns|both] [--chunk 500] [--full]
+#
+# Each table is written to <out>/<table>.csv and/or <out>/<table>.columns.gz.  The columnar file is gzipped JSON lines,
+# one line per chunk of rows:  {"columns": [names], "rows": count, "data": [[values of the first column], ...]}
+#
+# Exports are incremental: only finished games that haven't been exported yet are written (along with their defences,
+# clues and contacts), and the files are appended to.  What has been exported, and how long each file was at the end of
+# the last export, is kept in <out>/export-state.json.  If an export is interrupted, the next one cuts the files back to
+# those lengths before it starts, so no game is written twice.  --full starts again from scratch.
+#
+# The rows are read in chunks, inside a single read transaction.  The database uses WAL journaling (see init_db in bot.py),
+# so the bot can carry on writing to it while the export runs.
+from __future__ import print_function
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO)
+
+import database
+import snapshot
+
+STATE_FILE = "export-state.json"
+MAX_VARIABLES = 999 # The most parameters SQLite allows in a statement
+
+# The tables, in the order they are written, and how to select the rows for a chunk of games (given by their IDs).
+TABLES = [
+    ("game", "SELECT * FROM game WHERE Id IN (%s) ORDER BY Id"),
+    ("defence", "SELECT * FROM defence WHERE GameId IN (%s) ORDER BY Id"),
+    ("clue", "SELECT * FROM clue WHERE GameId IN (%s) ORDER BY Id"),
+    ("contact", "SELECT contact.* FROM contact INNER JOIN clue ON contact.ClueId = clue.Id WHERE clue.GameId IN (%s) ORDER BY contact.Id"),
+]
+
+def encode(value):
+    return value.encode("utf-8") if isinstance(value, unicode) else value
+
+# Appends rows to a CSV file, with a header row if the file is new.
+class csv_writer(object):
+    def __init__(self, path, columns):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab")
+        self.writer = csv.writer(self.file)
+        if new:
+            self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows([[encode(value) for value in row] for row in rows])
+
+    def close(self):
+        self.file.close()
+
+# Appends chunks of rows to a gzipped file, column by column.  Each chunk is a gzip member of its own, so the file can be
+# appended to by later exports, and read back with a single gzip stream.
+class column_writer(object):
+    def __init__(self, path, columns):
+        self.columns = columns
+        self.file = gzip.open(path, "ab")
+
+    def write(self, rows):
+        if rows:
+            chunk = {"columns": self.columns, "rows": len(rows), "data": [list(column) for column in zip(*rows)]}
+            self.file.write(json.dumps(chunk, separators=(",", ":")) + "\n")
+
+    def close(self):
+        self.file.close()
+
+# Read back a columnar export as a list of rows (a list of dicts), e.g. to check it.
+def read_columns(path):
+    rows = []
+    with gzip.open(path, "rb") as f:
+        for line in f:
+            chunk = json.loads(line)
+            rows.extend(dict(zip(chunk["columns"], values)) for values in zip(*chunk["data"]))
+    return rows
+
+# The names of the files a table can be written to
+def table_files(table):
+    return [table + ".csv", table + ".columns.gz"]
+
+# Run sql, which selects rows for a list of IDs (the "%s"), for all of ids, a chunk at a time.  Yields a cursor per chunk.
+def select_chunks(db, sql, ids, chunk):
+    chunk = max(1, min(chunk, MAX_VARIABLES))
+    for start in range(0, len(ids), chunk):
+        part = ids[start:start + chunk]
+        yield db.execute(sql % (", ".join("?" * len(part))), part)
+
+# Write the given games (and their defences, clues and contacts) to the export files.  Returns the number of rows written per table.
+def export_games(db, game_ids, out, formats, chunk):
+    counts = {}
+    for table, sql in TABLES:
+        counts[table] = 0
+        writers = None
+        for cursor in select_chunks(db, sql, game_ids, chunk):
+            columns = [d[0] for d in cursor.description]
+            if writers is None:
+                writers = []
+                if "csv" in formats:
+                    writers.append(csv_writer(os.path.join(out, table_files(table)[0]), columns))
+                if "columns" in formats:
+                    writers.append(column_writer(os.path.join(out, table_files(table)[1]), columns))
+            while True:
+                rows = cursor.fetchmany(chunk)
+                if not rows:
+                    break
+                for writer in writers:
+                    writer.write(rows)
+                counts[table] += len(rows)
+        for writer in writers or []:
+            writer.close()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the finished games in Contact.db to CSV and/or columnar files, for analysis.")
+    parser.add_argument("--db", default="Contact.db", help="the database to export from")
+    parser.add_argument("--out", default="export", help="the directory to write the export files to")
+    parser.add_argument("--format", choices=("csv", "columns", "both"), default="both", help="which kind of files to write")
+    parser.add_argument("--chunk", type=int, default=500, help="the number of games (and rows) to read at a time")
+    parser.add_argument("--full", action="store_true", help="export every finished game, replacing any earlier export")
+    args = parser.parse_args()
+    formats = ("csv", "columns") if args.format == "both" else (args.format,)
+
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    state_path = os.path.join(args.out, STATE_FILE)
+    state = None if args.full else snapshot.load(state_path)
+    if state is None or "sizes" not in state:
+        # The highest game ID looked at, the games up to it that hadn't finished, and the length of each file afterwards
+        state = {"last_game": 0, "unfinished": [], "sizes": {}}
+    # Cut each file back to where the last complete export left it (removing it, if that export didn't write it).
+    for table, sql in TABLES:
+        for name in table_files(table):
+            path, size = os.path.join(args.out, name), state["sizes"].get(name, 0)
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                if size:
+                    with open(path, "r+b") as f:
+                        f.truncate(size)
+                else:
+                    os.remove(path)
+
+    db = database.connect(args.db)
+    db.isolation_level = None # We start and end the transaction ourselves
+    db.execute("PRAGMA query_only = ON")
+    try:
+        db.execute("BEGIN") # One read transaction, so the tables are exported as they were at a single moment
+        # The new games, and the ones that hadn't finished last time (which may have been abandoned, so there can be a lot of them)
+        rows = db.execute("SELECT Id, EndTimeUTC IS NOT NULL FROM game WHERE Id > ?", (state["last_game"],)).fetchall()
+        for cursor in select_chunks(db, "SELECT Id, EndTimeUTC IS NOT NULL FROM game WHERE Id IN (%s)", state["unfinished"], args.chunk):
+            rows.extend(cursor.fetchall())
+        rows.sort()
+        game_ids = [game_id for game_id, finished in rows if finished]
+        counts = export_games(db, game_ids, args.out, formats, args.chunk)
+        db.execute("COMMIT")
+    finally:
+        db.close()
+
+    if rows:
+        state["last_game"] = max(state["last_game"], rows[-1][0])
+    state["unfinished"] = [game_id for game_id, finished in rows if not finished]
+    state["sizes"] = dict((name, os.path.getsize(os.path.join(args.out, name))) for table, sql in TABLES for name in table_files(table)
+                          if os.path.exists(os.path.join(args.out, name)))
+    snapshot.save(state_path, state)
+    print("Exported %s games to %s: %s" % (len(game_ids), args.out, ", ".join("%s %s rows" % (counts[table], table) for table, sql in TABLES)))
+
+if __name__ == "__main__":
+    main()
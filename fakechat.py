@@ -0,0 +1,150 @@
+# A stand-in for ChatExchange, for running the bot without logging in to StackExchange (see bench.py).
+#
+# It has the parts of the client, room, message and event classes that the bot uses.  Nothing is sent anywhere:
+# the messages the bot posts, and the stars/pins it makes, are recorded in client.sent instead.
+#
+# The module can take the place of the chatexchange package itself:  bot.chatexchange = fakechat
+import itertools
+import sys
+import time
+
+class User(object):
+    def __init__(self, id, name, is_moderator=False):
+        self.id = id
+        self.name = name
+        self.is_moderator = is_moderator
+
+    def __eq__(self, other):
+        return isinstance(other, User) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+class Message(object):
+    def __init__(self, client, id, owner, content):
+        self._client = client
+        self.id = id
+        self.owner = owner
+        self.content = content
+        self.time_stamp = int(time.time())
+        self.stars = 0
+        self.pinned = False
+        self.deleted = False
+
+    def star(self):
+        self.stars += 1
+        self._client.sent.append(("star", self.id))
+
+    def cancel_stars(self):
+        self.stars = 0
+        self.pinned = False
+        self._client.sent.append(("cancel_stars", self.id))
+
+# Chat events.  Each one is about a single message, in a single room.
+class Event(object):
+    def __init__(self, room, message):
+        self.room = room
+        self.message = message
+        self.user = message.owner
+        self.content = message.content
+        self.time_stamp = message.time_stamp
+
+class MessagePosted(Event):
+    pass
+
+class MessageEdited(Event):
+    pass
+
+class MessageDeleted(Event):
+    pass
+
+class Room(object):
+    def __init__(self, client, id):
+        self._client = client
+        self.id = id
+        self.owners = []
+        self.watchers = []
+
+    def join(self):
+        pass
+
+    def watch(self, callback):
+        self.watchers.append(callback)
+
+    def send_message(self, text, length_check=True):
+        self._client.sent.append(("message", text))
+        return self._client.new_message(self._client.me, text)
+
+# The low-level requests the bot makes directly (through message._client._br)
+class Browser(object):
+    def __init__(self, client):
+        self._client = client
+
+    def toggle_pinning(self, message_id):
+        self._client.sent.append(("toggle_pinning", message_id))
+
+    def toggle_starring(self, message_id):
+        self._client.sent.append(("toggle_starring", message_id))
+
+class Client(object):
+    def __init__(self, host="stackexchange.com"):
+        self.host = host
+        self.me = User(-1, "Lens")
+        self.sent = [] # Everything the bot has done, in order, as (kind, message text or id)
+        self._br = Browser(self)
+        self._ids = itertools.count(1)
+        self._users = {}
+        self._messages = {}
+        self._rooms = {}
+
+    def login(self, email, password):
+        pass
+
+    def logout(self):
+        pass
+
+    def get_me(self):
+        return self.me
+
+    def get_user(self, id, name=None):
+        user = self._users.get(id)
+        if user is None:
+            user = self._users[id] = User(id, name if name is not None else "user%s" % (id))
+        return user
+
+    def get_room(self, id):
+        room = self._rooms.get(id)
+        if room is None:
+            room = self._rooms[id] = Room(self, id)
+        return room
+
+    def get_message(self, id):
+        return self._messages[id]
+
+    def new_message(self, user, content):
+        message = Message(self, next(self._ids), user, content)
+        self._messages[message.id] = message
+        return message
+
+    # Post a message to a room as the given user, and deliver the event to the room's watchers.  Returns the event.
+    def post(self, room, user, content):
+        return self._deliver(room, MessagePosted(room, self.new_message(user, content)))
+
+    def edit(self, room, message, content):
+        message.content = content
+        return self._deliver(room, MessageEdited(room, message))
+
+    def delete(self, room, message):
+        message.deleted = True
+        return self._deliver(room, MessageDeleted(room, message))
+
+    def _deliver(self, room, event):
+        for callback in room.watchers:
+            callback(event, self)
+        return event
+
+# So that the module can stand in for the chatexchange package (chatexchange.client.Client, chatexchange.events.MessagePosted, ...)
+client = events = sys.modules[__name__]
@@ -0,0 +1,184 @@
+# The clues in play in a game of Contact, with indexes to find them by chat message, state or setter.
+import collections
+import re
+from datetime import datetime
+from helpers import enum
+
+# Enums to keep track of the clue state and the game state.
+Clue_state = enum("None", "Set", "Passed", "Schroedinger", "Solved", "Dead") # Schroedinger means a pass happened, and the clue hasn't been declared alive or dead.
+Game_state = enum("None", "Guessing", "Passed", "WaitingForLetter", "Finished")
+
+# Chat's HTML for bold, italic, code and strikethrough, and the markdown for each
+MARKDOWN = {"b": "**", "i": "*", "code": "`", "strike": "---"}
+markup_pattern = re.compile(r"</?(%s)>" % ("|".join(MARKDOWN)))
+
+# Convert a clue's text (as chat sends it) back to the markdown it was written in, so it can be posted again.
+def html_to_markdown(text):
+    return markup_pattern.sub(lambda match: MARKDOWN[match.group(1)], text)
+
+# Holds all info related to a single clue
+class clue(object):
+    # Games can run for a long time, with a lot of clues, so don't give each one a __dict__.
+    __slots__ = ("game", "number", "_message", "setter_id", "setter_name", "_clue_text", "markdown", "guess", "guesser_name", "guess_timestamp", "guess_warned",
+                 "contacts", "state_timer", "guess_timer", "state", "state_timestamp", "timestamp", "db_id", "warned")
+
+    def __init__(self):
+        self.game = None # The GameState this clue has been added to, if any
+        self.number = -1  # The clue number as chosen by the setter
+        self._message = None # A reference to the chat message containing the clue (see the message property)
+        self.setter_id = -1 # The SE chat ID of the setter of the clue
+        self.setter_name = "" # The SE chat name of the setter of the clue
+        self.clue_text = "" # The actual text of the clue (bare text).  Setting it also sets markdown, the text as it's posted by the bot.
+        self.guess = "" # The guess (if any) currently awaiting confimation
+        self.guesser_name = "" # The username of the user who made the guess
+        self.guess_timestamp = None # The UTC time that the guess was made
+        self.guess_warned = False # Indicates whether the bot has already reminded the setter about the guess
+        self.contacts = {} # A dictionary of players who have contacted this clue (id:timestamp)
+        self.state_timer = None # The pending reminder (if any) for the current state
+        self.guess_timer = None # The pending reminder (if any) for the current guess
+        self.state = Clue_state.None # The state of the clue starts out as None.
+        self.state_timestamp = datetime.utcnow() # The UTC time that the clue entered this state
+        self.timestamp = None # The time the clue was set (UTC)
+        self.db_id = None # The Id of the clue in the database (a future, until the new row has been written)
+        self.warned = False # Indicates whether the bot has already prompted the user to declare this clue alive/dead after a letter has been given up.
+
+    # The clue is shown again and again (!clues, passes...), so it's converted to markdown once, whenever it's set or edited.
+    @property
+    def clue_text(self):
+        return self._clue_text
+
+    @clue_text.setter
+    def clue_text(self, text):
+        self._clue_text = text
+        self.markdown = html_to_markdown(text)
+
+    @property
+    def message(self):
+        return self._message
+
+    @message.setter
+    def message(self, message):
+        old_message, self._message = self._message, message
+        if self.game is not None:
+            self.game._message_changed(self, old_message)
+
+    # Sets the state to one of the values in enum Clue_state
+    def set_state(self, state):
+        old_state, self.state = self.state, state
+        self.state_timestamp = datetime.utcnow() # The UTC time that the clue entered this state
+        self.warned = False # If the clue changes state, it's eligible for another warning.
+        if self.game is not None:
+            self.game._state_changed(self, old_state)
+
+    def set_guess(self, guess, user_name):
+        self.guess = guess.upper()
+        self.guesser_name = user_name
+        self.guess_timestamp = datetime.utcnow() # The UTC time that the guess was made
+        self.guess_warned = False
+        if self.game is not None and self.game.on_guess is not None:
+            self.game.on_guess(self)
+
+# What we keep of a clue once it is no longer active: enough to describe it, but no references to chat objects.
+dead_clue = collections.namedtuple("dead_clue", "number text setter solver solution")
+
+# The active clues in a game, indexed by clue number.  Behaves like a (read-only) dictionary of clue number -> clue.
+# Also keeps track of the clues in each chat message, in each state and by each setter, so those can be found without searching.
+# The indexes are kept up to date when clues are added or removed, and when a clue's message or state changes.
+class GameState(object):
+    def __init__(self, on_state_change=None, on_guess=None):
+        self.clues = {}
+        self._by_message = {} # Chat message id -> set of clues
+        self._by_state = {} # Clue_state -> set of clues
+        self._by_setter = {} # Setter's chat id -> set of clues
+        self.on_state_change = on_state_change # Called as on_state_change(clue, old_state) when a clue changes state
+        self.on_guess = on_guess # Called as on_guess(clue) when a guess for a clue is made or cleared
+
+    def __contains__(self, number):
+        return number in self.clues
+
+    def __getitem__(self, number):
+        return self.clues[number]
+
+    def __len__(self):
+        return len(self.clues)
+
+    def __iter__(self):
+        return iter(self.clues)
+
+    def get(self, number, default=None):
+        return self.clues.get(number, default)
+
+    def keys(self):
+        return self.clues.keys()
+
+    def values(self):
+        return self.clues.values()
+
+    def itervalues(self):
+        return self.clues.itervalues()
+
+    def iteritems(self):
+        return self.clues.iteritems()
+
+    def add(self, clue):
+        if clue.number in self.clues:
+            self.remove(self.clues[clue.number])
+        self.clues[clue.number] = clue
+        clue.game = self
+        self._index(self._by_message, self._message_key(clue.message), clue)
+        self._index(self._by_state, clue.state, clue)
+        self._index(self._by_setter, clue.setter_id, clue)
+
+    def remove(self, clue):
+        del self.clues[clue.number]
+        clue.game = None
+        self._unindex(self._by_message, self._message_key(clue.message), clue)
+        self._unindex(self._by_state, clue.state, clue)
+        self._unindex(self._by_setter, clue.setter_id, clue)
+
+    def clear(self):
+        for c in self.clues.itervalues():
+            c.game = None
+        self.clues = {}
+        self._by_message = {}
+        self._by_state = {}
+        self._by_setter = {}
+
+    # The active clues posted in the given chat message (there can be several, e.g. "4,5: Fifth space on a Monopoly board")
+    def by_message(self, message):
+        return list(self._by_message.get(self._message_key(message), ()))
+
+    # The active clues in the given Clue_state
+    def in_state(self, state):
+        return list(self._by_state.get(state, ()))
+
+    # The active clues set by the given user
+    def by_setter(self, setter_id):
+        return list(self._by_setter.get(setter_id, ()))
+
+    def _state_changed(self, clue, old_state):
+        self._unindex(self._by_state, old_state, clue)
+        self._index(self._by_state, clue.state, clue)
+        if self.on_state_change is not None:
+            self.on_state_change(clue, old_state)
+
+    def _message_changed(self, clue, old_message):
+        self._unindex(self._by_message, self._message_key(old_message), clue)
+        self._index(self._by_message, self._message_key(clue.message), clue)
+
+    @staticmethod
+    def _message_key(message):
+        return message.id if message is not None else None
+
+    @staticmethod
+    def _index(index, key, clue):
+        if key is not None:
+            index.setdefault(key, set()).add(clue)
+
+    @staticmethod
+    def _unindex(index, key, clue):
+        clues = index.get(key)
+        if clues is not None:
+            clues.discard(clue)
+            if not clues:
+                del index[key]
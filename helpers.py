@@ -1,6 +1,15 @@
 from __future__ import print_function
 from datetime import datetime
+import atexit
+import os
+import threading
 import traceback
+import Queue
+
+# Define an enum structure that we can use to define our own enums
+def enum(*sequential, **named):
+    enums = dict(zip(sequential, range(len(sequential))), **named)
+    return type('Enum', (), enums)
 
 try:
     from colorama import init, Fore, Style 
@@ -15,26 +24,124 @@ try:
             'default': (Fore.WHITE, Style.NORMAL)
         }
         color = (colors[log_level] if log_level in colors else colors['default'])
-        print(color[0], end='')
-        print(color[1], end='')
-        print(s)
-        print(Style.RESET_ALL)
+        print(color[0] + color[1] + s + Style.RESET_ALL)
 except:
     def cprint(s, log_level):
         print(s)
 
-# noinspection PyMissingTypeHints
-def log(log_level, *args):
-    log_str = u"[{}] {}".format(datetime.now().isoformat()[11:-7],
-                              u"  ".join([str(x) for x in args]))
-    with open("errorLogs.txt", "a") as f:
-        f.write(log_str + '\n')
+# Logging.  log() and log_exception() only queue the message; a background thread formats it, prints it to the console
+# and appends it to the log file, so the caller never waits on disk (or console) I/O.
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
 
-    cprint(log_str, log_level)
+log_file = "errorLogs.txt"
+log_max_bytes = 1024 * 1024 # When the log file gets bigger than this, it is renamed to errorLogs.txt.1 (and so on) and a new one is started
+log_backups = 3 # The number of old log files to keep
+log_threshold = LOG_LEVELS['debug'] # Messages below this level are dropped
+log_console = True # Whether messages are also printed to the console (in colour, if colorama is installed)
 
-def log_exception(exctype, value, tb, log_level='error'):
-    now = datetime.utcnow()
+# Change the logging settings.  Any that aren't given stay as they are.
+def configure_logging(level=None, console=None, path=None, max_bytes=None, backups=None):
+    global log_threshold, log_console, log_file, log_max_bytes, log_backups
+    if level is not None:
+        log_threshold = LOG_LEVELS[level]
+    if console is not None:
+        log_console = console
+    if path is not None:
+        log_file = path
+    if max_bytes is not None:
+        log_max_bytes = max_bytes
+    if backups is not None:
+        log_backups = backups
+
+class log_writer(object):
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # Queue a message: format(*args) will be called to produce the text.
+    def put(self, log_level, format, *args):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="log-writer")
+                    self._thread.daemon = True
+                    self._thread.start()
+        self._queue.put((log_level, datetime.now(), format, args))
+
+    # Wait until everything logged so far has been written.
+    def flush(self):
+        if self._thread is not None and self._thread.is_alive() and threading.current_thread() is not self._thread:
+            self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Take whatever else is waiting, and write it all at once.
+            while len(batch) < 100:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            lines = []
+            for log_level, now, format, args in batch:
+                try:
+                    text = format(now, *args)
+                except Exception:
+                    text = u"[%s] (unprintable log message) %r" % (now.isoformat()[11:19], args)
+                lines.append(text)
+                if log_console:
+                    try:
+                        cprint(text, log_level)
+                    except Exception:
+                        pass
+            try:
+                self._write(u"\n".join(lines) + u"\n")
+            except Exception:
+                pass # There's nowhere left to report it
+            for i in range(len(batch)):
+                self._queue.task_done()
+
+    def _write(self, text):
+        with open(log_file, "ab") as f:
+            f.write(text.encode("utf-8"))
+            size = f.tell()
+        if size > log_max_bytes:
+            rotate(log_file, log_backups)
+
+# Rename path to path.1, path.1 to path.2 and so on, dropping the oldest.
+def rotate(path, backups):
+    for n in range(backups, 0, -1):
+        older = "%s.%s" % (path, n)
+        newer = "%s.%s" % (path, n - 1) if n > 1 else path
+        if os.path.exists(newer):
+            if os.path.exists(older):
+                os.remove(older) # Windows won't rename over an existing file
+            os.rename(newer, older)
+    if backups == 0:
+        os.remove(path)
+
+_writer = log_writer()
+atexit.register(_writer.flush)
+
+# Wait until everything logged so far has been written (e.g. before exiting with os._exit).
+def flush_log():
+    _writer.flush()
+
+def format_message(now, *args):
+    return u"[{}] {}".format(now.isoformat()[11:19], u"  ".join([x if isinstance(x, unicode) else str(x) for x in args]))
+
+# utc_now is when the exception was caught, which may be a while before the log writer gets to it.
+def format_exception(now, exctype, value, tb, utc_now):
     tr = '\n'.join((traceback.format_tb(tb)))
     exception_only = ''.join(traceback.format_exception_only(exctype, value)).strip()
-    logged_msg = "{exception}\n{now} UTC\n{row}\n\n".format(exception=exception_only, now=now, row=tr)
-    log(log_level, logged_msg)
\ No newline at end of file
+    return format_message(now, "{exception}\n{now} UTC\n{row}\n\n".format(exception=exception_only, now=utc_now, row=tr))
+
+# noinspection PyMissingTypeHints
+def log(log_level, *args):
+    if LOG_LEVELS.get(log_level, LOG_LEVELS['error']) >= log_threshold:
+        _writer.put(log_level, format_message, *args)
+
+def log_exception(exctype, value, tb, log_level='error'):
+    if LOG_LEVELS.get(log_level, LOG_LEVELS['error']) >= log_threshold:
+        _writer.put(log_level, format_exception, exctype, value, tb, datetime.utcnow())
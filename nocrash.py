@@ -2,30 +2,55 @@
 # coding=utf-8
 
 # This script replaces the original nocrash.sh functionality with a pure Python approach.
+#
+# It runs bot.py, and restarts it when it crashes or stops working:
+#  - The bot writes a heartbeat file every couple of seconds (see write_heartbeat in bot.py).  If the heartbeat stops,
+#    or a game has been stuck on the same message for too long, the bot is asked to stop, killed if it doesn't, and
+#    restarted.  (A long time without chat events isn't taken as a sign of trouble: the room is often quiet for hours.)
+#  - The first restart is immediate.  If the bot keeps crashing soon after starting, each restart waits longer
+#    (exponential backoff, with some randomness), so a bot that can't start doesn't keep logging in to chat.
+#  - The new bot is told where the game snapshots are, so it picks up the games where the last one left off.
+#  - Every start, exit and restart is recorded in RESTART_LOG, one JSON object per line.
 
 import platform
 import os
+import json
+import random
 import subprocess as sp
-from time import sleep
+from time import sleep, time
 import logging
 import sys
 
 # Set the Python Executable based on this being stored - we refer to this later on for subprocess calls.
 PY_EXECUTABLE = sys.executable
 
+HEARTBEAT_FILE = os.path.abspath('heartbeat.json') # Written by the bot (passed to it as ContactHeartbeat)
+SNAPSHOT_FILES = os.path.abspath('GameState-%s.json') # The bot's game snapshots, by room ID (passed to it as ContactSnapshots)
+RESTART_LOG = 'nocrashrestarts.jsonl'
+CHECK_INTERVAL = 5 # Seconds between health checks
+START_GRACE = 120 # Seconds to give the bot to log in before expecting a heartbeat
+HEARTBEAT_TIMEOUT = 30 # The bot is stuck if its heartbeat is older than this
+HANG_TIMEOUT = 300 # ...or a game has been handling the same message for this long
+STOP_GRACE = 15 # Seconds to wait for the bot to stop when asked, before killing it
+BACKOFF_BASE = 2 # Seconds to wait before the second quick restart; doubled for each one after that
+BACKOFF_MAX = 600
+STABLE_TIME = 600 # A bot that has run for this long has started properly, and the backoff starts over
+
 # Log to errorlog.txt so that !!/errorlogs shows us restarts
 logging.basicConfig(
     filename='nocrashlog.txt',
     level=logging.INFO,
     format='%(asctime)s:%(levelname)s:%(message)s')
 
-count = 0
-crashcount = 0
+count = 0 # Restarts so far
+crashcount = 0 # Restarts since the bot last ran for STABLE_TIME
 stoprunning = False
 ecode = None  # Define this to prevent errors
 
 # Make a clean copy of existing environment variables, to pass down to subprocess.
 environ = os.environ.copy()
+environ['ContactHeartbeat'] = HEARTBEAT_FILE
+environ['ContactSnapshots'] = SNAPSHOT_FILES
 
 def log(message):
     logging.info('[NoCrash] {}'.format(message))
@@ -42,22 +67,102 @@ def error(message):
     print '[NoCrash] {}'.format(message)
 
 
+# Add a line to the restart log
+def record(event, **fields):
+    fields.update(time=time(), event=event, restarts=count, crashes=crashcount)
+    try:
+        with open(RESTART_LOG, 'a') as f:
+            f.write(json.dumps(fields, sort_keys=True) + '\n')
+    except IOError as e:
+        error('Unable to write to {}: {}'.format(RESTART_LOG, e))
+
+
+def read_heartbeat():
+    try:
+        with open(HEARTBEAT_FILE, 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+# Returns the reason the bot seems to be stuck, or None if it seems fine.
+def check_health(started):
+    now = time()
+    if now - started < START_GRACE:
+        return None
+    heartbeat = read_heartbeat()
+    if heartbeat is None or now - heartbeat['time'] > HEARTBEAT_TIMEOUT:
+        return 'no heartbeat'
+    if heartbeat['busy'] > HANG_TIMEOUT:
+        return 'stuck on a message for {:.0f}s'.format(heartbeat['busy'])
+    return None
+
+
+# Ask the bot to stop (so that it saves the games), and kill it if it doesn't.
+def stop(process):
+    if process.poll() is not None:
+        return
+    process.terminate()
+    for i in range(STOP_GRACE):
+        if process.poll() is not None:
+            return
+        sleep(1)
+    warn('Killing process {}'.format(process.pid))
+    process.kill()
+
+
+# Seconds to wait before restarting after the given number of crashes in a row.
+def backoff(crashes):
+    if crashes <= 1:
+        return 0
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (crashes - 2)) * random.uniform(0.5, 1.0)
+
+
 while stoprunning is False:
     log('Starting')
     
     command = (PY_EXECUTABLE + ' bot.py').split()
+    if os.path.exists(HEARTBEAT_FILE):
+        os.remove(HEARTBEAT_FILE)
 
+    started = time()
+    reason = None # Why we stopped the bot, if we did
+    process = sp.Popen(command, env=environ)
+    record('start', pid=process.pid)
     try:
-        ecode = sp.call(command, env=environ)
+        while process.poll() is None:
+            sleep(CHECK_INTERVAL)
+            reason = check_health(started)
+            if reason is not None:
+                error('Bot seems to be stuck ({}) -- stopping it'.format(reason))
+                stop(process)
+                break
+        ecode = process.wait()
     except KeyboardInterrupt:
         # print "[NoCrash] KeyBoard Interrupt received.."
+        stop(process)
         ecode = 6
 
+    uptime = time() - started
     log('Exited with ecode {}'.format(ecode))
+    record('exit', pid=process.pid, exit_code=ecode, uptime=round(uptime, 1), reason=reason)
 
-    if ecode == 6:
+    if reason is None and ecode in (0, 6): # !shutdown, or Ctrl-C
         log('Stopping')
         stoprunning = True
     else:
-        error('Died for unknown reason -- check logs.  Sleeping before restart')
-        sleep(5)
\ No newline at end of file
+        if uptime >= STABLE_TIME:
+            crashcount = 0
+        count += 1
+        crashcount += 1
+        delay = backoff(crashcount)
+        if reason is None:
+            error('Died for unknown reason -- check logs.  Restarting in {:.0f}s'.format(delay))
+        else:
+            log('Restarting in {:.0f}s'.format(delay))
+        record('restart', delay=round(delay, 1))
+        try:
+            sleep(delay)
+        except KeyboardInterrupt:
+            log('Stopping')
+            stoprunning = True
@@ -0,0 +1,197 @@
+# Sends messages and star/pin actions to a chat room from a background thread, in the order they were queued.
+#
+# Chat limits how quickly a user can post or star/pin, so each kind of request is paced by a token bucket.
+# If a message has to wait for the bucket, any other short messages queued behind it are combined into the same post,
+# as long as none of them uses markdown: chat doesn't format messages of more than one line.
+# A request that fails before it reaches chat (chat is throttling us, or we couldn't connect) is retried with increasing
+# delays, rather than dropped.  Any other failure isn't: the request may have got through, and posting a message twice,
+# or toggling a pin back, would be worse than losing it.
+import collections
+import sys
+import threading
+import time
+import Queue
+import requests
+try:
+    from requests.packages.urllib3.exceptions import NewConnectionError
+except ImportError: # Older versions of requests don't tell us whether the connection was ever made
+    NewConnectionError = ()
+from helpers import log, log_exception
+from perf import clock, stages
+
+MAX_MESSAGE_LENGTH = 500 # Longer messages are rejected by chat, unless length checking is turned off
+MARKDOWN_CHARACTERS = "*_`[]" # A message with any of these may need formatting, so it isn't combined with others
+
+# Whether a message can go in a post of more than one line
+def plain(text):
+    return not any(c in text for c in MARKDOWN_CHARACTERS) and "---" not in text
+
+# Whether a failed request certainly never reached chat, so it's safe to make it again.
+def never_sent(error):
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code == 409 # Throttled: "You can perform this action again in..."
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError): # Refused, or the name couldn't be looked up
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+# Allows `rate` requests per second on average, with bursts of up to `capacity` requests.
+class token_bucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # The number of seconds until a token will be available (0 if one is available now)
+    def delay(self):
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    # Wait for a token, and use it.
+    def take(self):
+        wait = self.delay()
+        if wait > 0:
+            time.sleep(wait)
+            self._refill()
+        self.tokens -= 1
+
+# Remembers the messages sent in the last `window` seconds, so that the same message isn't posted twice in quick succession.
+# Messages that differ only in whitespace count as the same message.  Only a hash of each message is kept.
+class dedupe_cache(object):
+    def __init__(self, window, max_size=256):
+        self.window = window
+        self.max_size = max_size
+        self.hits = 0 # Messages found to be duplicates
+        self.misses = 0 # Messages that weren't
+        self._entries = collections.OrderedDict() # Message hash -> time first sent, oldest first
+
+    @staticmethod
+    def key(message):
+        return hash(u" ".join(message.split()))
+
+    # Returns True if the message was already sent within the window.  Otherwise, remembers it and returns False.
+    def seen(self, message):
+        now = time.time()
+        # Entries are in the order they were added, so expired ones are all at the front.
+        while self._entries:
+            oldest = next(iter(self._entries))
+            if now - self._entries[oldest] <= self.window:
+                break
+            del self._entries[oldest]
+
+        key = self.key(message)
+        if key in self._entries:
+            self.hits += 1
+            return True
+        self.misses += 1
+        self._entries[key] = now
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return False
+
+    def __len__(self):
+        return len(self._entries)
+
+class outbox(object):
+    def __init__(self, room, message_rate=1.0, message_burst=4, action_rate=0.9, action_burst=1, retries=5):
+        self.room = room
+        self.messages = token_bucket(message_rate, message_burst)
+        self.actions = token_bucket(action_rate, action_burst) # Stars and pins
+        self.retries = retries
+        self.sent = 0 # Number of posts made
+        self.combined = 0 # Number of messages that were combined into an earlier post
+        self._queue = Queue.Queue()
+        self._held = None # A request taken off the queue that couldn't be combined with the previous message
+        self._thread = threading.Thread(target=self._run, name="outbox")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Queue a message to be posted.  If length_check is False, it may be more than MAX_MESSAGE_LENGTH characters.
+    def send_message(self, text, length_check=True):
+        self._queue.put(("message", text, length_check))
+
+    # Queue a star/pin action: fn(*args) will be called in turn with the other requests.
+    def perform(self, fn, *args):
+        self._queue.put(("action", fn, args))
+
+    # The number of requests waiting to be sent
+    def pending(self):
+        return self._queue.qsize() + (1 if self._held is not None else 0)
+
+    # Wait until everything queued so far has been sent.
+    def flush(self):
+        self._queue.join()
+
+    # Send everything that has been queued, then stop.
+    def close(self):
+        self._queue.put(("stop", None, None))
+        self._thread.join()
+
+    # Take the next request, waiting up to timeout seconds (or forever) for one to be queued.
+    def _next(self, timeout=None):
+        if self._held is not None:
+            request, self._held = self._held, None
+            return request
+        return self._queue.get(True, timeout)
+
+    def _run(self):
+        while True:
+            kind, first, second = self._next()
+            stages.count("chat queue depth", self.pending())
+            done = 1 # Number of queue entries taken care of by this request
+            if kind == "stop":
+                self._queue.task_done()
+                return
+            elif kind == "action":
+                self.actions.take()
+                start = clock()
+                self._attempt(first, *second)
+                stages.add("chat action", clock() - start)
+            else:
+                text, length_check = first, second
+                # While we wait for chat to let us post, gather up any short messages that are queued behind this one.
+                while length_check and plain(text):
+                    wait = self.messages.delay()
+                    if wait <= 0:
+                        break
+                    try:
+                        following = self._next(wait)
+                    except Queue.Empty:
+                        break
+                    if following[0] == "message" and following[2] and plain(following[1]) and len(text) + 1 + len(following[1]) <= MAX_MESSAGE_LENGTH:
+                        text += "\n" + following[1]
+                        done += 1
+                        self.combined += 1
+                    else:
+                        self._held = following
+                        break
+                self.messages.take()
+                start = clock()
+                self._attempt(self.room.send_message, text, length_check)
+                stages.add("chat send", clock() - start)
+                self.sent += 1
+            for i in range(done):
+                self._queue.task_done()
+
+    # Call fn(*args), retrying with increasing delays if it fails without reaching chat.
+    def _attempt(self, fn, *args):
+        delay = 1
+        for attempt in range(self.retries + 1):
+            try:
+                fn(*args)
+                return
+            except Exception as e:
+                if attempt == self.retries or not never_sent(e):
+                    log_exception(*sys.exc_info())
+                    return
+                log('warning', "Chat request failed (attempt %s); retrying in %s seconds" % (attempt + 1, delay))
+                time.sleep(delay)
+                delay *= 2
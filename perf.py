@@ -0,0 +1,90 @@
+# Timing of the bot's work, by stage (matching input against patterns, handling it, SQLite statements, chat requests...),
+# so that when the room is slow, we can see where the time goes.
+#
+# Each stage keeps its most recent samples in a fixed-size ring buffer, so recording a sample is cheap and memory use
+# doesn't grow.  Percentiles are only worked out when someone asks for them (!perf).
+import json
+import threading
+import timeit
+
+clock = timeit.default_timer # The most precise clock available
+
+# The most recent `size` values of something, plus a count and total of all values ever added.
+class histogram(object):
+    def __init__(self, unit, size=1024):
+        self.unit = unit # "s" for durations in seconds, or "" for counts
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self._samples = []
+        self._next = 0 # Index in _samples of the next one to overwrite, once the buffer is full
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        with self._lock:
+            if len(self._samples) < self.size:
+                self._samples.append(value)
+            else:
+                self._samples[self._next] = value
+                self._next = (self._next + 1) % self.size
+            self.count += 1
+            self.total += value
+
+    # The values below which the given fractions of the recent samples fall
+    def percentiles(self, *fractions):
+        with self._lock:
+            values = sorted(self._samples)
+        if not values:
+            return [0] * len(fractions)
+        return [values[int(round(f * (len(values) - 1)))] for f in fractions]
+
+# A histogram for each stage, created when the stage first records something.
+class timings(object):
+    def __init__(self, size=1024):
+        self.size = size
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def _histogram(self, name, unit):
+        h = self.histograms.get(name)
+        if h is None:
+            with self._lock:
+                h = self.histograms.setdefault(name, histogram(unit, self.size))
+        return h
+
+    # Record how long (in seconds) a stage took
+    def add(self, name, seconds):
+        self._histogram(name, "s").add(seconds)
+
+    # Record a value that isn't a duration (e.g. a queue length)
+    def count(self, name, value):
+        self._histogram(name, "").add(value)
+
+    # Count and percentiles of every stage: (name, unit, count, p50, p95, p99), ordered by name.
+    def summary(self):
+        with self._lock: # Other threads may be adding stages
+            histograms = self.histograms.items()
+        rows = []
+        for name, h in sorted(histograms):
+            rows.append((name, h.unit, h.count) + tuple(h.percentiles(0.5, 0.95, 0.99)))
+        return rows
+
+    # A fixed-width table of the summary, with durations in milliseconds.
+    def report(self):
+        summary = self.summary()
+        width = max([len(row[0]) for row in summary] + [5])
+        lines = ["%-*s %8s %9s %9s %9s" % (width, "stage", "count", "p50", "p95", "p99")]
+        for name, unit, count, p50, p95, p99 in summary:
+            if unit == "s":
+                values = tuple("%.2fms" % (p * 1000) for p in (p50, p95, p99))
+            else:
+                values = tuple("%g" % (p) for p in (p50, p95, p99))
+            lines.append("%-*s %8s %9s %9s %9s" % ((width, name, count) + values))
+        return lines
+
+    def dump(self, path):
+        with open(path, "wb") as f:
+            json.dump([dict(zip(("stage", "unit", "count", "p50", "p95", "p99"), row)) for row in self.summary()], f, indent=1)
+
+# The timings for the whole bot
+stages = timings()
@@ -0,0 +1,68 @@
+# Runs functions at a given time on a background thread, so that timed events (like reminders) happen on time,
+# without anything having to poll for them.
+#
+# Pending calls are kept in a heap ordered by due time.  Cancelled calls are simply skipped when they come due.
+import heapq
+import itertools
+import sys
+import threading
+import time
+from helpers import log_exception
+
+# A pending call.  Returned by scheduler.call_later(), so that it can be cancelled.
+class timer(object):
+    def __init__(self, when, fn, args):
+        self.when = when # time.time() at which the call is due
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class scheduler(object):
+    # If a lock is given, it is held while each call runs.
+    def __init__(self, lock=None):
+        self.lock = lock
+        self._heap = []
+        self._sequence = itertools.count() # Keeps calls due at the same time in the order they were scheduled
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Call fn(*args) after the given number of seconds.
+    def call_later(self, delay, fn, *args):
+        return self.call_at(time.time() + delay, fn, *args)
+
+    def call_at(self, when, fn, *args):
+        t = timer(when, fn, args)
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._sequence), t))
+            # Wake the thread up if this is now the next call due.
+            if self._heap[0][2] is t:
+                self._condition.notify()
+        return t
+
+    # The number of calls that are waiting to run (including cancelled ones that haven't been skipped yet)
+    def pending(self):
+        with self._condition:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._condition.wait(self._heap[0][0] - time.time() if self._heap else None)
+                t = heapq.heappop(self._heap)[2]
+            if t.cancelled:
+                continue
+            try:
+                if self.lock is not None:
+                    with self.lock:
+                        if not t.cancelled: # It may have been cancelled while we were waiting for the lock
+                            t.fn(*t.args)
+                else:
+                    t.fn(*t.args)
+            except Exception:
+                log_exception(*sys.exc_info())
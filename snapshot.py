@@ -0,0 +1,83 @@
+# Saves the game state to disk every so often, so that after a crash or restart the bot can carry on where it left off.
+#
+# A snapshot is a single JSON document.  It is written to a temporary file, which then replaces the previous snapshot,
+# so a crash part way through writing never leaves a damaged snapshot behind.
+import json
+import os
+import sys
+import threading
+import time
+from helpers import log, log_exception
+
+# Write the state (anything json can encode) to path.
+def save(path, state):
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        json.dump(state, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    if os.name == "nt" and os.path.exists(path): # On Windows, rename won't replace an existing file
+        os.remove(path)
+    os.rename(temp, path)
+
+# Read the state saved at path.  Returns None if there isn't a usable snapshot.
+def load(path):
+    # If we were stopped between removing the old snapshot and renaming the new one (Windows only), the new one is still in the temporary file.
+    for candidate in (path, path + ".tmp"):
+        try:
+            with open(candidate, "rb") as f:
+                return json.load(f)
+        except IOError:
+            continue
+        except ValueError:
+            log('warning', "Ignoring damaged snapshot %s" % (candidate))
+    return None
+
+# Saves snapshots from a background thread: shortly after mark() is called, and at least every `interval` seconds.
+# capture() is called (holding `lock`, if given) to get the state to save.  Several marks in quick succession only cause one save.
+class snapshotter(object):
+    def __init__(self, path, capture, lock=None, delay=1, interval=60):
+        self.path = path
+        self.capture = capture
+        self.lock = lock
+        self.delay = delay # Seconds to wait after a change before saving, so that a burst of changes is saved once
+        self.interval = interval # Maximum seconds between saves
+        self.saves = 0 # Number of snapshots written
+        self._changed = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="snapshot")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Note that the state has changed, so a snapshot should be saved soon.
+    def mark(self):
+        self._changed.set()
+
+    # Save a snapshot right away (on the calling thread).
+    def save(self):
+        try:
+            if self.lock is not None:
+                with self.lock:
+                    state = self.capture()
+            else:
+                state = self.capture()
+            save(self.path, state)
+            self.saves += 1
+        except Exception:
+            log_exception(*sys.exc_info())
+
+    # Stop saving in the background, and save one last snapshot.
+    def close(self):
+        self._stopping = True
+        self._changed.set()
+        self._thread.join()
+        self.save()
+
+    def _run(self):
+        while True:
+            if self._changed.wait(self.interval) and not self._stopping:
+                time.sleep(self.delay)
+            if self._stopping:
+                return
+            self._changed.clear()
+            self.save()
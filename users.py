@@ -0,0 +1,117 @@
+# Display names of chat users, by user id, so that listing the whitelist or pinglist doesn't cost a request to chat per user.
+#
+# Names are noted for free from the messages the bot sees.  Users who haven't been seen lately (the entry is older than
+# `ttl` seconds, or missing) are looked up when their names are needed, several at a time in parallel.  Only the `max_size`
+# most recently used entries are kept.  The names are saved to a file, so they survive a restart.
+import collections
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import snapshot
+from helpers import log, log_exception
+from perf import clock, stages
+
+class directory(object):
+    # lookup(user_id) fetches a user's name from chat.
+    def __init__(self, lookup, path=None, ttl=7 * 24 * 3600, max_size=2000, threads=4):
+        self.lookup = lookup
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.threads = threads # The number of lookups made at once
+        self.hits = 0 # Names found up to date in the directory
+        self.lookups = 0 # Names fetched from chat
+        self._entries = collections.OrderedDict() # User id -> (name, time.time() it was noted), least recently used first
+        self._lock = threading.Lock()
+        self._saving = threading.Lock() # Held while the file is being written
+        self._pool = None # Started when the first lookup is needed
+        if path is not None:
+            self.load()
+
+    # Remember a user's name (e.g. from a message they posted).
+    def note(self, user_id, name):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (name, time.time())
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    # The name of a user, as last noted (however long ago), or None.
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return entry[0] if entry is not None else None
+
+    # The names of the given users, as a dict.  Users whose names are missing or out of date are looked up first, in parallel.
+    # If a lookup fails, the old name is used; users we have never found a name for are left out.
+    def names(self, user_ids):
+        now = time.time()
+        result = {}
+        stale = []
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is not None:
+                    result[user_id] = entry[0]
+                    del self._entries[user_id] # Move it to the most recently used end
+                    self._entries[user_id] = entry
+                if entry is None or now - entry[1] > self.ttl:
+                    stale.append(user_id)
+                else:
+                    self.hits += 1
+
+        if stale:
+            start = clock()
+            for user_id, name in zip(stale, self._pool_map(self._fetch, stale)):
+                if name is not None:
+                    self.note(user_id, name)
+                    result[user_id] = name
+            stages.add("user lookup", clock() - start)
+            if self.path is not None:
+                self.save()
+        return result
+
+    def _pool_map(self, fn, values):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+        return self._pool.map(fn, values)
+
+    def _fetch(self, user_id):
+        try:
+            self.lookups += 1
+            return self.lookup(user_id)
+        except Exception:
+            log('warning', "Couldn't look up the name of user %s: %s" % (user_id, sys.exc_info()[1]))
+            return None
+
+    def load(self):
+        state = snapshot.load(self.path)
+        if state is None:
+            return
+        with self._lock:
+            for user_id, name, noted in state:
+                self._entries[user_id] = (name, noted)
+            while len(self._entries) > self.max_size: # The file was saved with a bigger max_size
+                self._entries.popitem(last=False)
+
+    def save(self):
+        with self._lock:
+            state = [(user_id, name, noted) for user_id, (name, noted) in self._entries.iteritems()]
+        try:
+            with self._saving:
+                snapshot.save(self.path, state)
+        except Exception:
+            log_exception(*sys.exc_info())
+
+    # Stop the lookup threads, once any lookups in progress are done.
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def __len__(self):
+        return len(self._entries)
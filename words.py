@@ -0,0 +1,106 @@
+# A dictionary of words, for checking the defender's letters and guesses against.  Optional: see WORDS_FILE in bot.py.
+#
+# The dictionary is a file built from a word list (see build), holding the words in upper case, without spaces or
+# punctuation, in sorted order, one per line, each padded with spaces to the same length.  Since every line is the same
+# length, word i starts at i * width, so the file can be binary searched where it is: it's memory-mapped when first
+# used, and only the pages a search touches are read.  Finding the words that start with a prefix takes two binary
+# searches, and the number of them is the difference between the two positions.
+#
+#   python words.py <word list> <dictionary file>
+import codecs
+import mmap
+import re
+import sys
+import threading
+from helpers import log
+
+NON_LETTERS = re.compile(r"[\W\d_]+", re.UNICODE)
+END = "\xff" # Sorts after every UTF-8 string, so prefix + END comes after every word starting with prefix
+
+# A word or prefix as it's stored in the dictionary: letters only, upper case, UTF-8.
+def key(text):
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    return NON_LETTERS.sub(u"", text.upper()).encode("utf-8")
+
+class dictionary(object):
+    def __init__(self, path):
+        self.path = path
+        self.size = None # The number of words, once the file has been opened
+        self._map = None
+        self._width = 0 # The length of each line, including the newline
+        self._failed = False
+        self._lock = threading.Lock()
+
+    # Open the file, the first time it's needed.  Returns False if there is no usable dictionary.
+    def _open(self):
+        if self._map is not None or self._failed:
+            return not self._failed
+        with self._lock:
+            if self._map is None and not self._failed:
+                try:
+                    with open(self.path, "rb") as f:
+                        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    width = m.find("\n") + 1
+                    if width <= 1 or len(m) % width != 0:
+                        raise ValueError("the lines aren't all the same length; rebuild it with words.py")
+                    self._width = width
+                    self.size = len(m) // width
+                    self._map = m
+                    log('info', "Opened the dictionary %s (%s words)" % (self.path, self.size))
+                except (IOError, OSError, ValueError, mmap.error):
+                    self._failed = True
+                    log('warning', "Can't use the dictionary %s: %s" % (self.path, sys.exc_info()[1]))
+        return not self._failed
+
+    def _word(self, i):
+        start = i * self._width
+        return self._map[start:start + self._width - 1].rstrip(" ")
+
+    # The position of the first word that isn't less than k
+    def _lower_bound(self, k):
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word(mid) < k:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # The number of words starting with prefix, or None if there's no dictionary.
+    def count(self, prefix):
+        if not self._open():
+            return None
+        k = key(prefix)
+        return self._lower_bound(k + END) - self._lower_bound(k)
+
+    # Whether word is in the dictionary, or None if there's no dictionary.
+    def contains(self, word):
+        if not self._open():
+            return None
+        k = key(word)
+        i = self._lower_bound(k)
+        return i < self.size and self._word(i) == k
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+
+# Build a dictionary file from a word list (UTF-8, one word or phrase per line).  Returns the number of words.
+def build(source, path):
+    with codecs.open(source, "r", "utf-8") as f:
+        words = sorted(set(key(line) for line in f) - set([""]))
+    width = max(len(word) for word in words) + 1 if words else 1
+    with open(path, "wb") as f:
+        for word in words:
+            f.write(word.ljust(width - 1) + "\n")
+    return len(words)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python words.py <word list> <dictionary file>")
+        sys.exit(2)
+    print("%s words written to %s" % (build(sys.argv[1], sys.argv[2]), sys.argv[2]))
@@ -0,0 +1,102 @@
+# Background threads for handling chat events, so that the thread chat delivers events on is never held up.
+#
+# Each game has a worker: a queue of calls that a single thread runs in the order they were submitted, so the game's
+# events are handled one at a time and in order, while other rooms carry on.  Work that doesn't change any game's state
+# (looking up user names, running statistics queries...) goes to a pool of threads shared by all the games instead.
+import sys
+import threading
+import time
+import Queue
+from helpers import log_exception
+from perf import clock, stages
+
+_stop = object() # Queue marker: stop the thread(s)
+
+# Runs calls one at a time, in order, on its own thread.  If a lock is given, it is held while each call runs.
+class worker(object):
+    def __init__(self, name, lock=None):
+        self.name = name
+        self.lock = lock
+        self.busy_since = None # time.time() when the call being run started, or None if the worker is idle
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Call fn(*args) once everything submitted before it has run.
+    def submit(self, fn, *args):
+        self._queue.put((fn, args, clock()))
+
+    # The number of calls waiting to run
+    def pending(self):
+        return self._queue.qsize()
+
+    # Wait until everything submitted so far has run.
+    def flush(self):
+        if threading.current_thread() is self._thread or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self.submit(done.set)
+        done.wait()
+
+    # Run everything submitted so far, then stop.
+    def close(self):
+        if self._thread.is_alive() and threading.current_thread() is not self._thread:
+            self._queue.put((_stop, None, None))
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            fn, args, submitted = self._queue.get()
+            if fn is _stop:
+                break
+            stages.add("worker queue wait", clock() - submitted)
+            self.busy_since = time.time()
+            try:
+                if self.lock is not None:
+                    with self.lock:
+                        fn(*args)
+                else:
+                    fn(*args)
+            except Exception:
+                log_exception(*sys.exc_info())
+            finally:
+                self.busy_since = None
+
+# Runs calls on any of `size` threads, in no particular order.
+class pool(object):
+    def __init__(self, size=4, name="pool"):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._run, name="%s-%s" % (name, i + 1))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args):
+        self._queue.put((fn, args, clock()))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    # Run everything submitted so far, then stop.
+    def close(self):
+        for thread in self._threads:
+            self._queue.put((_stop, None, None))
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def _run(self):
+        while True:
+            fn, args, submitted = self._queue.get()
+            if fn is _stop:
+                break
+            stages.add("pool queue wait", clock() - submitted)
+            try:
+                start = clock()
+                fn(*args)
+                stages.add("pool work", clock() - start)
+            except Exception:
+                log_exception(*sys.exc_info())